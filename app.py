@@ -1,14 +1,29 @@
 from flask import Flask, render_template
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
-from models import init_supabase
 from routes import redirect_bp, webhook_bp, admin_bp, affiliate_bp
 from routes.home import home_bp
+from commands import init_commands
+from services.profiler import init_profiler
+from services.resilience import db_breaker, set_deadline
+from services.warmup import warm_up, get_startup_report
+from services.assets import asset_url
+from services.rate_limit import counters as rate_limit_counters, prometheus_metrics
 
 app = Flask(__name__)
 app.secret_key = Config.SECRET_KEY
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = Config.STATIC_MAX_AGE  # /static/ 沒有 hash，只快取較短時間
+app.jinja_env.globals['asset_url'] = asset_url
 
-# 初始化 Supabase
-init_supabase()
+# 在反向代理後面時，request.remote_addr 改用 X-Forwarded-For 中由代理加上的訪客 IP（限流與點擊記錄都依此計算）
+if Config.PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.PROXY_FIX_HOPS, x_proto=Config.PROXY_FIX_HOPS)
+
+# 效能分析掛鉤（手動或慢請求自動取樣）
+init_profiler(app)
+
+# CLI 指令（flask --app app <指令>）
+init_commands(app)
 
 # 註冊 Blueprints（順序重要！首頁要先註冊）
 app.register_blueprint(home_bp)  # 首頁
@@ -18,10 +33,23 @@ app.register_blueprint(webhook_bp, url_prefix='/webhook')  # Shopify Webhook
 app.register_blueprint(redirect_bp)  # 短網址重新導向（放最後，避免攔截其他路由）
 
 
+@app.before_request
+def limit_db_budget():
+    """每個請求的資料庫時間預算（各 Blueprint 可再縮短）"""
+    set_deadline(Config.DB_BUDGET_MS)
+
+
 @app.route('/health')
 def health_check():
     """健康檢查 endpoint"""
-    return {'status': 'ok'}, 200
+    return {'status': 'ok', 'database': db_breaker.state, 'startup': get_startup_report(),
+            'rate_limits': rate_limit_counters()}, 200
+
+
+@app.route('/metrics')
+def metrics():
+    """監控用計數（Prometheus 文字格式）"""
+    return prometheus_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 
 @app.errorhandler(404)
@@ -35,4 +63,5 @@ def server_error(e):
 
 
 if __name__ == '__main__':
+    warm_up(app)
     app.run(debug=True, host='0.0.0.0', port=5000)
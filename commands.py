@@ -0,0 +1,358 @@
+"""
+Flask CLI 指令
+
+使用方式：flask --app app <指令>
+"""
+import time
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+from config import Config
+from models import (ensure_click_partitions, get_affiliates_for_index, get_campaigns_for_index,
+                    rebuild_stats_buckets, refresh_leaderboards, run_attribution, seed_commission_openings,
+                    take_commission_snapshots)
+from services import affiliate_versions
+from services.affiliate_index import build_index, consume_rebuild_request
+from services.affiliate_import import ImportFormatError, import_affiliates, parse_rows, report_csv
+from services.assets import build_static
+from services.backfill import (BackfillError, backfill_orders, read_lines, start_bulk_export,
+                               stream_lines, wait_for_bulk_export)
+from services.click_enrichment import enrich_clicks
+from services.click_retention import MONTHS_AHEAD, PARTITION_CHECK_INTERVAL, RetentionError, run_retention
+from services.fraud import run_fraud_scoring
+from services.reconciliation import reconcile
+from services.redirect_map import build_redirect_map, map_path
+from services.click_ingest import ingest_click_logs
+from services.webhook_payload import benchmark, sample_order_payload
+
+
+def build_affiliate_index_once():
+    """從資料庫重建共用索引（含活動連結），回傳 (代購業者筆數, 活動連結筆數)"""
+    affiliates = get_affiliates_for_index()
+    campaigns = get_campaigns_for_index()
+    build_index(affiliates, campaigns=campaigns)
+    # 同一批資料順便更新獨立轉址程序的對照檔
+    build_redirect_map(affiliates, campaigns)
+    return len(affiliates), len(campaigns)
+
+
+@click.command('build-affiliate-index')
+@click.option('--loop', is_flag=True, help='持續執行，定期或收到重建請求時重建')
+@click.option('--interval', default=Config.AFFILIATE_INDEX_REFRESH, show_default=True,
+              help='定期重建的秒數')
+def build_affiliate_index_command(loop, interval):
+    """建立跨 worker 共用的代購業者索引（--loop 時也定期預先建立點擊的月份分區）"""
+    last_built = 0
+    last_partitioned = None
+    while True:
+        if loop and (last_partitioned is None or time.monotonic() - last_partitioned >= PARTITION_CHECK_INTERVAL):
+            created = ensure_click_partitions(MONTHS_AHEAD)
+            if created:
+                click.echo(f"Created {created} click partitions")
+            last_partitioned = time.monotonic()
+
+        if not loop or consume_rebuild_request() or time.monotonic() - last_built >= interval:
+            started = time.perf_counter()
+            try:
+                count, campaigns = build_affiliate_index_once()
+                click.echo(f"Affiliate index rebuilt: {count} affiliates, {campaigns} campaigns in "
+                           f"{(time.perf_counter() - started) * 1000:.0f} ms")
+            except Exception as e:
+                click.echo(f"Error building affiliate index: {e}", err=True)
+                if not loop:
+                    raise SystemExit(1)
+            last_built = time.monotonic()
+        
+        if not loop:
+            return
+        time.sleep(1)
+
+
+@click.command('build-redirect-map')
+@click.option('--output', default=None, help='對照檔路徑（預設 REDIRECT_MAP_PATH 或 SHARED_DIR/redirect_map.bin）')
+@click.option('--loop', is_flag=True, help='持續執行，定期重建（轉址程序在其他主機時使用）')
+@click.option('--interval', default=Config.AFFILIATE_INDEX_REFRESH, show_default=True,
+              help='定期重建的秒數')
+def build_redirect_map_command(output, loop, interval):
+    """編譯獨立轉址程序（redirector.py）使用的短網址對照檔"""
+    output = output or map_path()
+    while True:
+        started = time.perf_counter()
+        try:
+            version, count = build_redirect_map(get_affiliates_for_index(), get_campaigns_for_index(), output)
+            click.echo(f"Redirect map {output} rebuilt: {count} entries (version {version}) in "
+                       f"{(time.perf_counter() - started) * 1000:.0f} ms")
+        except Exception as e:
+            click.echo(f"Error building redirect map: {e}", err=True)
+            if not loop:
+                raise SystemExit(1)
+        
+        if not loop:
+            return
+        time.sleep(interval)
+
+
+@click.command('ingest-clicks')
+@click.option('--log-dir', default=Config.CLICK_LOG_DIR, show_default=True, help='轉址程序的點擊記錄目錄')
+@click.option('--batch-size', default=1000, show_default=True)
+def ingest_clicks_command(log_dir, batch_size):
+    """把獨立轉址程序記錄的點擊寫入資料庫"""
+    started = time.perf_counter()
+    stats = ingest_click_logs(log_dir, batch_size=batch_size)
+    if stats is None:
+        click.echo("Click ingestion failed; unfinished files will resume from their last offset", err=True)
+        raise SystemExit(1)
+    
+    for affiliate_id in stats['affiliate_ids']:
+        affiliate_versions.touch(affiliate_id)
+    click.echo(f"Ingested {stats['inserted']} clicks from {stats['files']} files "
+               f"({stats['duplicates']} duplicates, {stats['skipped']} malformed lines, "
+               f"{stats['files_done']} files finished) in {time.perf_counter() - started:.1f} s")
+
+
+@click.command('build-static')
+@with_appcontext
+def build_static_command():
+    """預先渲染首頁並產生帶 hash、預先壓縮的靜態檔"""
+    manifest = build_static(current_app)
+    click.echo(f"Built {len(manifest['assets'])} assets and home page (build {manifest['build_id']})")
+
+
+@click.command('attribute-orders')
+@click.option('--window-days', default=Config.COOKIE_DAYS, show_default=True, help='歸因回溯天數')
+@click.option('--batch-size', default=5000, show_default=True)
+def attribute_orders_command(window_days, batch_size):
+    """把訂單歸因到點擊，並更新各來源轉換統計"""
+    total = 0
+    affected = set()
+    while True:
+        result = run_attribution(window_days=window_days, batch_size=batch_size)
+        if result is None:
+            raise SystemExit(1)
+        total += result['attributed']
+        affected.update(result['affiliate_ids'] or [])
+        if result['attributed'] < batch_size:
+            break
+    
+    for affiliate_id in affected:
+        affiliate_versions.touch(affiliate_id)
+    click.echo(f"Attributed {total} orders, refreshed {len(affected)} affiliates")
+
+
+@click.command('reconcile')
+@click.option('--repair', is_flag=True, help='把差異寫回 affiliates')
+@click.option('--full', is_flag=True, help='忽略 checkpoint，檢查所有代購業者')
+@click.option('--batch-size', default=1000, show_default=True)
+def reconcile_command(repair, full, batch_size):
+    """核對代購業者的銷售額與佣金欄位"""
+    started = time.perf_counter()
+    report = reconcile(full=full, repair=repair, batch_size=batch_size)
+    if report is None:
+        click.echo("Reconciliation failed, checkpoint not advanced", err=True)
+        raise SystemExit(1)
+
+    for item in report['discrepancies']:
+        click.echo(f"{item['id']} {item['name']}")
+        for field, diff in item['diffs'].items():
+            click.echo(f"    {field}: {diff['stored']:.2f} -> {diff['expected']:.2f}")
+
+    click.echo(f"Checked {report['checked']} affiliates since {report['since'] or 'the beginning'}: "
+               f"{len(report['discrepancies'])} mismatched, {report['repaired']} repaired "
+               f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+    if report['discrepancies'] and not repair:
+        raise SystemExit(2)
+
+
+@click.command('snapshot-ledger')
+@click.option('--settle-seconds', default=60, show_default=True, help='最近幾秒的帳本記錄留到下一輪')
+@click.option('--seed-openings', is_flag=True, help='先為既有的代購業者寫入期初餘額（導入帳本時執行一次）')
+def snapshot_ledger_command(settle_seconds, seed_openings):
+    """為有新帳本記錄的代購業者寫入佣金餘額快照"""
+    if seed_openings:
+        seeded = seed_commission_openings()
+        if seeded is None:
+            raise SystemExit(1)
+        click.echo(f"Seeded {seeded} opening balances")
+    count = take_commission_snapshots(settle_seconds=settle_seconds)
+    if count is None:
+        raise SystemExit(1)
+    click.echo(f"Wrote {count} commission snapshots")
+
+
+@click.command('backfill-orders')
+@click.option('--since', help='開始日期（含），例如 2024-01-01')
+@click.option('--until', help='結束日期（不含），例如 2024-02-01')
+@click.option('--file', 'path', type=click.Path(exists=True, dir_okay=False),
+              help='處理已下載的 bulk operation JSONL，不向 Shopify 重新匯出')
+@click.option('--batch-size', default=500, show_default=True)
+def backfill_orders_command(since, until, path, batch_size):
+    """從 Shopify 匯出指定期間的訂單，補登漏掉的推薦訂單"""
+    started = time.perf_counter()
+
+    def report(stats):
+        click.echo(f"  {stats['orders']} orders read, {stats['referral']} referral, "
+                   f"{stats['created']} created, {stats['status_updates']} status updates, {stats['held']} held")
+
+    try:
+        if path:
+            lines = read_lines(path)
+        else:
+            if not since or not until:
+                raise click.UsageError('--since and --until are required without --file')
+            operation_id = start_bulk_export(since, until)
+            click.echo(f"Started bulk operation {operation_id}")
+            url = wait_for_bulk_export(progress=lambda op: click.echo(
+                f"  {op['status']}: {op.get('objectCount') or 0} objects"))
+            if not url:
+                click.echo("No orders in range")
+                return
+            lines = stream_lines(url)
+        stats = backfill_orders(lines, batch_size=batch_size, progress=report)
+    except BackfillError as e:
+        click.echo(f"Backfill failed: {e}", err=True)
+        raise SystemExit(1)
+
+    click.echo(f"Backfilled {stats['created']} of {stats['referral']} referral orders "
+               f"({stats['orders']} orders scanned) in {time.perf_counter() - started:.0f} s")
+
+
+@click.command('import-affiliates')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='只驗證不寫入')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False), help='把每列結果寫成 CSV')
+@click.option('--chunk-size', default=500, show_default=True)
+def import_affiliates_command(path, dry_run, report_path, chunk_size):
+    """從 CSV / JSON 批次匯入代購業者"""
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        report = import_affiliates(parse_rows(data, path), chunk_size=chunk_size, dry_run=dry_run)
+    except ImportFormatError as e:
+        click.echo(f"Import failed: {e}", err=True)
+        raise SystemExit(1)
+
+    for result in report['results']:
+        if result['status'] == 'error':
+            click.echo(f"  row {result['row']}: {'; '.join(result['errors'])}")
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(report_csv(report['results']))
+
+    valid = len(report['results']) - report['errors']
+    click.echo(f"{'Validated' if dry_run else 'Imported'} {valid if dry_run else report['created']} affiliates, "
+               f"{report['errors']} errors in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+@click.command('rebuild-stats-buckets')
+def rebuild_stats_buckets_command():
+    """從點擊與訂單重建每小時、每日統計表"""
+    started = time.perf_counter()
+    if not rebuild_stats_buckets():
+        raise SystemExit(1)
+    click.echo(f"Rebuilt stats buckets in {time.perf_counter() - started:.1f} s")
+
+
+@click.command('refresh-leaderboards')
+@click.option('--top-k', default=Config.LEADERBOARD_SIZE, show_default=True)
+def refresh_leaderboards_command(top_k):
+    """重算最近 7 / 30 天的排行榜"""
+    count = refresh_leaderboards(top_k=top_k)
+    if count is None:
+        raise SystemExit(1)
+    click.echo(f"Wrote {count} leaderboard rows")
+
+
+@click.command('enrich-clicks')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--max-batches', type=int, default=None, help='最多處理幾批（預設處理到沒有新點擊為止）')
+def enrich_clicks_command(batch_size, max_batches):
+    """解析新點擊的 User-Agent 與來源網址，寫回裝置 / 瀏覽器 / 作業系統 / 來源網站維度"""
+    total = enrich_clicks(batch_size=batch_size, max_batches=max_batches,
+                          progress=lambda count: click.echo(f"Enriched {count} clicks"))
+    if total is None:
+        raise SystemExit(1)
+    click.echo(f"Done: {total} clicks enriched")
+
+
+@click.command('score-fraud')
+@click.option('--lookback-days', default=Config.COOKIE_DAYS, show_default=True, help='掃描點擊的天數')
+@click.option('--window-minutes', default=Config.FRAUD_BURST_MINUTES, show_default=True)
+@click.option('--min-clicks', default=Config.FRAUD_BURST_CLICKS, show_default=True,
+              help='同一時段內達到此點擊數視為暴增')
+@click.option('--batch-size', default=1000, show_default=True)
+def score_fraud_command(lookback_days, window_minutes, min_clicks, batch_size):
+    """偵測自我推薦與點擊暴增，為待確認訂單評分"""
+    stats = run_fraud_scoring(lookback_days, window_minutes, min_clicks, batch_size=batch_size,
+                              progress=lambda count: click.echo(f"Scanned {count} clicks"))
+    if stats is None:
+        raise SystemExit(1)
+    click.echo(f"Found {stats['bursts']} click bursts, scored {stats['scored']} orders, "
+               f"{stats['flagged']} held for review")
+
+
+@click.command('retain-clicks')
+@click.option('--months', default=Config.CLICK_RETENTION_MONTHS, show_default=True, help='點擊保留的月數')
+@click.option('--anonymize-days', default=Config.CLICK_IP_ANONYMIZE_DAYS, show_default=True,
+              help='超過天數的點擊 IP 匿名化')
+@click.option('--archive-dir', default=Config.CLICK_ARCHIVE_DIR, show_default=True, help='封存檔目錄')
+@click.option('--dry-run', is_flag=True, help='只列出會被封存的分區')
+def retain_clicks_command(months, anonymize_days, archive_dir, dry_run):
+    """匿名化舊點擊的 IP，並把保存期限外的點擊分區封存後刪除"""
+    def progress(archived):
+        click.echo(f"Archived {archived['name']}: {archived['rows']} rows -> {archived['path']}")
+
+    try:
+        stats = run_retention(months, anonymize_days, archive_dir, dry_run=dry_run, progress=progress)
+    except RetentionError as e:
+        click.echo(f"Error: {e}", err=True)
+        raise SystemExit(1)
+
+    if dry_run:
+        for archived in stats['archived']:
+            click.echo(f"Would archive {archived['name']} (~{archived['rows']} rows)")
+        return
+    click.echo(f"Created {stats['partitions_created']} partitions, anonymized {stats['ips_anonymized']} IPs, "
+               f"archived {len(stats['archived'])} partitions")
+
+
+@click.command('bench-webhook')
+@click.option('--file', 'path', type=click.Path(exists=True, dir_okay=False),
+              help='實際的訂單 Webhook JSON（預設產生測試資料）')
+@click.option('--line-items', default=50, show_default=True, help='測試資料的商品明細數')
+@click.option('--iterations', default=200, show_default=True)
+def bench_webhook_command(path, line_items, iterations):
+    """比較原本與精簡的訂單 Webhook 解析流程（每個 Webhook 的 CPU 時間與記憶體）"""
+    if path:
+        with open(path, 'rb') as f:
+            body = f.read()
+    else:
+        body = sample_order_payload(line_items)
+    
+    results = benchmark(body, iterations=iterations)
+    click.echo(f"Payload {results['payload_kb']} KB, parser {results['parser']}")
+    for name in ('legacy', 'lean'):
+        result = results[name]
+        click.echo(f"{name:>6}: {result['cpu_us']:>9.1f} us CPU  {result['peak_kb']:>9.1f} KB peak  "
+                   f"{result['retained_kb']:>9.1f} KB retained")
+
+
+def init_commands(app: Flask):
+    """註冊所有 CLI 指令"""
+    app.cli.add_command(build_affiliate_index_command)
+    app.cli.add_command(build_redirect_map_command)
+    app.cli.add_command(ingest_clicks_command)
+    app.cli.add_command(build_static_command)
+    app.cli.add_command(attribute_orders_command)
+    app.cli.add_command(reconcile_command)
+    app.cli.add_command(snapshot_ledger_command)
+    app.cli.add_command(backfill_orders_command)
+    app.cli.add_command(import_affiliates_command)
+    app.cli.add_command(rebuild_stats_buckets_command)
+    app.cli.add_command(refresh_leaderboards_command)
+    app.cli.add_command(retain_clicks_command)
+    app.cli.add_command(enrich_clicks_command)
+    app.cli.add_command(score_fraud_command)
+    app.cli.add_command(bench_webhook_command)
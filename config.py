@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,3 +27,69 @@ class Config:
     # Admin
     ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
     ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin')
+    
+    # 效能分析（超過 PROFILE_SLOW_MS 毫秒的請求自動保存，0 表示只在手動要求時分析）
+    PROFILE_SLOW_MS = int(os.getenv('PROFILE_SLOW_MS', 0))
+    PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 10))
+    PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/goyoulink/profiles')
+    PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))
+    
+    # 資料庫保護（熔斷器、每個請求的時間預算、短網址快取秒數）
+    DB_BREAKER_FAILURES = int(os.getenv('DB_BREAKER_FAILURES', 5))
+    DB_BREAKER_COOLDOWN = float(os.getenv('DB_BREAKER_COOLDOWN', 30))
+    DB_BUDGET_MS = int(os.getenv('DB_BUDGET_MS', 10000))
+    REDIRECT_DB_BUDGET_MS = int(os.getenv('REDIRECT_DB_BUDGET_MS', 800))
+    REDIRECT_CACHE_TTL = float(os.getenv('REDIRECT_CACHE_TTL', 60))
+    REDIRECT_CACHE_SIZE = int(os.getenv('REDIRECT_CACHE_SIZE', 10000))
+    
+    # 跨 worker 共用檔案的目錄（優先放在 /dev/shm，即記憶體中）
+    SHARED_DIR = os.getenv('SHARED_DIR', '/dev/shm/goyoulink' if os.path.isdir('/dev/shm')
+                           else os.path.join(tempfile.gettempdir(), 'goyoulink'))
+    AFFILIATE_INDEX_REFRESH = float(os.getenv('AFFILIATE_INDEX_REFRESH', 60))
+    
+    # 每個 worker 同時最多幾條管理後台 SSE 連線（需遠小於 GUNICORN_THREADS）
+    SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 2))
+    
+    # 獨立轉址程序（redirector.py）：短網址對照檔（預設 SHARED_DIR/redirect_map.bin）與本機點擊記錄目錄
+    REDIRECT_MAP_PATH = os.getenv('REDIRECT_MAP_PATH', '')
+    CLICK_LOG_DIR = os.getenv('CLICK_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clicklog'))
+    
+    # 預先建置的首頁與靜態檔（flask --app app build-static）
+    BUILD_DIR = os.getenv('BUILD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build'))
+    HOME_MAX_AGE = int(os.getenv('HOME_MAX_AGE', 300))
+    STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', 3600))
+    
+    # 排行榜（最近 7 / 30 天前幾名），超過 LEADERBOARD_REFRESH 秒就在背景重算
+    LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+    LEADERBOARD_REFRESH = float(os.getenv('LEADERBOARD_REFRESH', 300))
+    
+    # 點擊保存期限（retain-clicks）：超過月數的分區封存到 CLICK_ARCHIVE_DIR 後刪除，超過天數的 IP 匿名化
+    CLICK_RETENTION_MONTHS = int(os.getenv('CLICK_RETENTION_MONTHS', 13))
+    CLICK_IP_ANONYMIZE_DAYS = int(os.getenv('CLICK_IP_ANONYMIZE_DAYS', 30))
+    CLICK_ARCHIVE_DIR = os.getenv('CLICK_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive', 'clicks'))
+    
+    # 詐騙偵測（score-fraud）：分數達 FRAUD_HOLD_SCORE 的訂單不會自動確認；
+    # 同一代購業者、IP 與 User-Agent 在 FRAUD_BURST_MINUTES 分鐘內點擊達 FRAUD_BURST_CLICKS 次視為暴增
+    FRAUD_HOLD_SCORE = int(os.getenv('FRAUD_HOLD_SCORE', 60))
+    FRAUD_BURST_MINUTES = int(os.getenv('FRAUD_BURST_MINUTES', 10))
+    FRAUD_BURST_CLICKS = int(os.getenv('FRAUD_BURST_CLICKS', 20))
+    
+    # 前面有幾層反向代理（Zeabur ingress 為 1）：依 X-Forwarded-For / X-Forwarded-Proto 取得訪客 IP 與協定，
+    # 限流、點擊記錄與轉址程序都用這個 IP；直接對外服務時設為 0
+    PROXY_FIX_HOPS = int(os.getenv('PROXY_FIX_HOPS', 1))
+    
+    # 限流（次數/秒數，各 worker 共用）：短網址依 IP 與短網址代碼、商品搜尋依 IP 與登入的代購業者
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_REDIRECT_IP = os.getenv('RATE_LIMIT_REDIRECT_IP', '120/60')
+    RATE_LIMIT_REDIRECT_AFFILIATE = os.getenv('RATE_LIMIT_REDIRECT_AFFILIATE', '3000/60')
+    RATE_LIMIT_SEARCH_IP = os.getenv('RATE_LIMIT_SEARCH_IP', '30/60')
+    RATE_LIMIT_SEARCH_AFFILIATE = os.getenv('RATE_LIMIT_SEARCH_AFFILIATE', '30/60')
+    RATE_LIMIT_SHARE_IP = os.getenv('RATE_LIMIT_SHARE_IP', '60/60')
+    
+    # 代購業者專屬分享圖與 QR code：依內容 hash 快取在 SHARE_IMAGE_DIR；
+    # SHARE_IMAGE_FONT 為中文字型檔路徑（未設定時嘗試常見的 Noto Sans CJK 位置）
+    SHARE_IMAGE_DIR = os.getenv('SHARE_IMAGE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'share'))
+    SHARE_IMAGE_FONT = os.getenv('SHARE_IMAGE_FONT', '')
+    SHARE_IMAGE_MAX_AGE = int(os.getenv('SHARE_IMAGE_MAX_AGE', 86400))
+    # 快取檔數上限，超過時刪除最久沒用到的圖片（商品連結 ?p= 各自一張）
+    SHARE_IMAGE_MAX_FILES = int(os.getenv('SHARE_IMAGE_MAX_FILES', 5000))
@@ -0,0 +1,35 @@
+"""
+Gunicorn 設定（gunicorn 會自動讀取目前目錄的 gunicorn.conf.py）
+
+master 啟動完成後先建置預先渲染的首頁與靜態檔，再開一個 refresher 程序維護共用的代購業者索引，
+所有 worker 都從同一份 memory-mapped 索引讀取（refresher 同時更新獨立轉址程序 redirector.py 的對照檔）。
+每個 worker 在開始接請求之前先執行預熱（services/warmup.py）。
+"""
+import os
+import subprocess
+import sys
+
+# 使用 gthread（每個 worker 固定 threads 條執行緒處理請求）：SSE 長連線各佔一條執行緒，
+# 每個 worker 最多 SSE_MAX_STREAMS 條（config.py），其餘執行緒保留給轉址與 webhook
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+
+def when_ready(server):
+    # 先建置首頁與靜態檔，worker 啟動時就能直接讀取
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'build-static'], check=False)
+    server.affiliate_index_refresher = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'build-affiliate-index', '--loop']
+    )
+
+
+def post_worker_init(worker):
+    from services.warmup import warm_up
+    warm_up(worker.wsgi)
+
+
+def on_exit(server):
+    refresher = getattr(server, 'affiliate_index_refresher', None)
+    if refresher and refresher.poll() is None:
+        refresher.terminate()
@@ -1,15 +1,23 @@
-from supabase import create_client, Client
 from config import Config
+from services.resilience import db_breaker
+from services.affiliate_index import affiliate_index, campaign_key, request_rebuild
+from services.commission_rules import compute_commission, notify_rules_changed
+from services.events import publish
+from services import affiliate_versions
+from collections import OrderedDict
 import shortuuid
+import threading
+import time
 from datetime import datetime, timezone
 
-# 初始化 Supabase client
-supabase: Client = None
+# 初始化 Supabase client（supabase / httpx 套件較重，第一次使用時才 import）
+supabase = None
 
 def init_supabase():
     global supabase
     if Config.SUPABASE_URL and Config.SUPABASE_KEY:
-        supabase = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+        from services.db_transport import create_instrumented_client
+        supabase = create_instrumented_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
     return supabase
 
 def get_supabase():
@@ -19,10 +27,43 @@ def get_supabase():
     return supabase
 
 
+def _select_all(build_query, page_size: int = 1000):
+    """分頁取得查詢的所有資料（Supabase 單次最多回傳 1000 筆）"""
+    rows = []
+    start = 0
+    while True:
+        result = build_query().range(start, start + page_size - 1).execute()
+        batch = result.data or []
+        rows.extend(batch)
+        if len(batch) < page_size:
+            return rows
+        start += page_size
+
+
 # ============================================
 # Affiliate（代購業者）操作
 # ============================================
 
+REF_CODE_LENGTH = 8
+SHORT_CODE_LENGTH = 6
+CODE_ALPHABET = '23456789abcdefghijkmnopqrstuvwxyz'
+CODE_RETRIES = 5
+
+
+def new_ref_code():
+    """產生隨機推薦碼"""
+    return shortuuid.ShortUUID(alphabet=CODE_ALPHABET).random(length=REF_CODE_LENGTH)
+
+
+def new_short_code():
+    """產生隨機短網址代碼"""
+    return shortuuid.ShortUUID(alphabet=CODE_ALPHABET).random(length=SHORT_CODE_LENGTH)
+
+
+def _is_unique_violation(error):
+    return getattr(error, 'code', None) == '23505' or 'duplicate key' in str(error)
+
+
 def create_affiliate(name: str, email: str = None, domain: str = None, 
                      ref_code: str = None, commission_rate: float = None,
                      affiliate_type: str = 'affiliate',
@@ -33,11 +74,12 @@ def create_affiliate(name: str, email: str = None, domain: str = None,
     db = get_supabase()
     
     # 自動產生 ref_code 如果沒提供
-    if not ref_code:
-        ref_code = shortuuid.uuid()[:8].lower()
+    generate_ref_code = not ref_code
+    if generate_ref_code:
+        ref_code = new_ref_code()
     
     # 產生短網址代碼
-    short_code = shortuuid.uuid()[:6].lower()
+    short_code = new_short_code()
     
     # 使用預設佣金比例
     if commission_rate is None:
@@ -59,11 +101,51 @@ def create_affiliate(name: str, email: str = None, domain: str = None,
         'social_tiktok': social_tiktok
     }
     
+    for attempt in range(CODE_RETRIES):
+        try:
+            result = db.table('affiliates').insert(data).execute()
+            if result.data:
+                request_rebuild()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            # 自動產生的代碼撞到既有代碼時換一個重試
+            message = str(e)
+            if attempt + 1 < CODE_RETRIES and 'short_code' in message and _is_unique_violation(e):
+                data['short_code'] = new_short_code()
+            elif attempt + 1 < CODE_RETRIES and generate_ref_code and 'ref_code' in message and _is_unique_violation(e):
+                data['ref_code'] = new_ref_code()
+            else:
+                print(f"Error in create_affiliate: {e}")
+                return None
+    return None
+
+
+def get_affiliate_codes():
+    """取得所有已使用的 email、ref_code 與 short_code（含活動連結的短網址，批次匯入檢查重複用）"""
+    db = get_supabase()
     try:
-        result = db.table('affiliates').insert(data).execute()
-        return result.data[0] if result.data else None
+        rows = _select_all(lambda: db.table('affiliates').select('email, ref_code').order('id'))
+        short_codes = _select_all(lambda: db.table('short_codes').select('code').order('code'))
     except Exception as e:
-        print(f"Error in create_affiliate: {e}")
+        print(f"Error in get_affiliate_codes: {e}")
+        return None
+    return {
+        'emails': {row['email'].lower() for row in rows if row.get('email')},
+        'ref_codes': {row['ref_code'] for row in rows},
+        'short_codes': {row['code'] for row in short_codes}
+    }
+
+
+def bulk_insert_affiliates(rows: list):
+    """一次寫入多筆代購業者，回傳建立的資料；任一筆失敗時整批不寫入並回傳 None"""
+    db = get_supabase()
+    try:
+        result = db.table('affiliates').insert(rows).execute()
+        if result.data:
+            request_rebuild()
+        return result.data or []
+    except Exception as e:
+        print(f"Error in bulk_insert_affiliates: {e}")
         return None
 
 
@@ -116,11 +198,61 @@ def get_all_affiliates(status: str = None, affiliate_type: str = None):
         return []
 
 
+AFFILIATE_LIST_FIELDS = ('id, name, email, domain, type, ref_code, short_code, commission_rate, status, '
+                         'total_clicks, total_orders, total_sales, total_commission, pending_commission, created_at')
+AFFILIATE_SORT_FIELDS = ('created_at', 'name', 'commission_rate', 'total_clicks', 'total_orders',
+                         'total_sales', 'total_commission', 'pending_commission')
+
+
+def search_affiliates(q: str = None, status: str = None, affiliate_type: str = None,
+                      sort: str = 'created_at', desc: bool = True, page: int = 1, per_page: int = 50):
+    """搜尋代購業者（名稱 / Email / 推薦碼 / domain），只取列表需要的欄位並分頁
+    
+    回傳 {'items': [...], 'total': 總筆數, 'page': 頁數, 'per_page': 每頁筆數, 'pages': 總頁數}
+    """
+    db = get_supabase()
+    if sort not in AFFILIATE_SORT_FIELDS:
+        sort = 'created_at'
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 200)
+    start = (page - 1) * per_page
+    
+    try:
+        query = db.table('affiliates').select(AFFILIATE_LIST_FIELDS, count='exact')
+        # 去掉 PostgREST 篩選語法用到的字元，避免組出錯誤的 or 條件
+        keyword = ''.join(ch for ch in (q or '') if ch not in ',()*\\"').strip()
+        if keyword:
+            query = query.or_(','.join(f"{field}.ilike.*{keyword}*"
+                                       for field in ('name', 'email', 'ref_code', 'domain')))
+        if status:
+            query = query.eq('status', status)
+        if affiliate_type:
+            query = query.eq('type', affiliate_type)
+        # 排序值相同時以 id 決定順序，分頁才不會重複或漏掉
+        result = query.order(sort, desc=desc).order('id').range(start, start + per_page - 1).execute()
+        total = result.count or 0
+        return {
+            'items': result.data or [],
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'pages': max((total + per_page - 1) // per_page, 1)
+        }
+    except Exception as e:
+        print(f"Error in search_affiliates: {e}")
+        return {'items': [], 'total': 0, 'page': page, 'per_page': per_page, 'pages': 1}
+
+
 def update_affiliate(affiliate_id: str, **kwargs):
     """更新代購業者資料"""
     db = get_supabase()
     try:
         result = db.table('affiliates').update(kwargs).eq('id', affiliate_id).execute()
+        if result.data:
+            # 點擊、訂單、發放最後都會更新 affiliate 統計，所以在這裡統一標記資料已變更
+            affiliate_versions.touch(affiliate_id)
+            if set(kwargs) & {'name', 'ref_code', 'short_code', 'status', 'commission_rate'}:
+                request_rebuild()
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"Error in update_affiliate: {e}")
@@ -146,14 +278,189 @@ def update_affiliate_stats(affiliate_id: str, clicks: int = 0, orders: int = 0,
     return update_affiliate(affiliate_id, **update_data)
 
 
+# ============================================
+# 短網址查詢快取（Stale-While-Revalidate）
+# ============================================
+
+# short_code 或活動連結 key -> (affiliate 或 None, 取得時間)
+_redirect_cache = OrderedDict()
+_redirect_cache_lock = threading.Lock()
+_redirect_refreshing = set()
+
+REDIRECT_FIELDS = 'id, name, ref_code, short_code, status, commission_rate'
+# 共用索引超過 AFFILIATE_INDEX_REFRESH 的這個倍數沒有重建，視為 refresher 已停止，查無資料時改查資料庫
+INDEX_STALE_FACTOR = 5
+CAMPAIGN_REDIRECT_FIELDS = 'id, affiliate_id, slug, short_code, source, target_path'
+
+
+def get_affiliates_for_index():
+    """取得建立共用索引所需的所有代購業者欄位"""
+    db = get_supabase()
+    return _select_all(lambda: db.table('affiliates').select(REDIRECT_FIELDS).order('id'))
+
+
+def get_campaigns_for_index():
+    """取得建立共用索引所需的所有啟用中活動連結"""
+    db = get_supabase()
+    return _select_all(lambda: db.table('campaign_links').select(CAMPAIGN_REDIRECT_FIELDS)
+                       .eq('status', 'active').order('id'))
+
+
+def preload_redirect_cache():
+    """預先把所有啟用中的代購業者載入短網址快取，回傳筆數"""
+    db = get_supabase()
+    affiliates = _select_all(lambda: db.table('affiliates').select(REDIRECT_FIELDS)
+                             .eq('status', 'active').order('id'))
+    now = time.monotonic()
+    with _redirect_cache_lock:
+        for affiliate in affiliates[:Config.REDIRECT_CACHE_SIZE]:
+            _redirect_cache[affiliate['short_code']] = (affiliate, now)
+    return len(affiliates)
+
+
+def _with_campaign(affiliate: dict, campaign: dict):
+    """把活動連結的欄位併入代購業者資料（與共用索引 lookup_campaign 的格式相同）"""
+    return {
+        **affiliate,
+        'campaign_id': campaign['id'],
+        'campaign_source': campaign.get('source'),
+        'target_path': campaign.get('target_path')
+    }
+
+
+def _fetch_redirect_entry(short_code: str, slug: str = None):
+    """從資料庫查詢短網址（或活動連結）對應的代購業者（失敗時丟出例外）
+
+    活動連結不存在或已封存時回傳代購業者本身，點擊算在主要短網址
+    """
+    db = get_supabase()
+    result = db.table('affiliates').select(REDIRECT_FIELDS).eq('short_code', short_code).execute()
+    affiliate = result.data[0] if result.data else None
+
+    if affiliate and slug:
+        result = db.table('campaign_links').select(CAMPAIGN_REDIRECT_FIELDS)\
+            .eq('affiliate_id', affiliate['id']).eq('slug', slug).eq('status', 'active').execute()
+        if result.data:
+            affiliate = _with_campaign(affiliate, result.data[0])
+    elif not affiliate and not slug:
+        # 活動自己的短網址（已封存的活動算在代購業者本身）
+        result = db.table('campaign_links').select(f"{CAMPAIGN_REDIRECT_FIELDS}, status")\
+            .eq('short_code', short_code).execute()
+        if result.data:
+            campaign = result.data[0]
+            owner = db.table('affiliates').select(REDIRECT_FIELDS).eq('id', campaign['affiliate_id']).execute()
+            if owner.data:
+                affiliate = owner.data[0]
+                if campaign['status'] == 'active':
+                    affiliate = _with_campaign(affiliate, campaign)
+    return affiliate
+
+
+def _fetch_affiliate_for_redirect(key: str, short_code: str, slug: str = None):
+    """從資料庫取得短網址對應的代購業者並寫入快取（失敗時丟出例外）"""
+    affiliate = _fetch_redirect_entry(short_code, slug)
+    
+    with _redirect_cache_lock:
+        _redirect_cache[key] = (affiliate, time.monotonic())
+        _redirect_cache.move_to_end(key)
+        while len(_redirect_cache) > Config.REDIRECT_CACHE_SIZE:
+            _redirect_cache.popitem(last=False)
+    return affiliate
+
+
+def _refresh_affiliate_for_redirect(key: str, short_code: str, slug: str = None):
+    """背景重新整理過期的快取項目"""
+    try:
+        _fetch_affiliate_for_redirect(key, short_code, slug)
+    except Exception as e:
+        print(f"Error in _refresh_affiliate_for_redirect: {e}")
+    finally:
+        with _redirect_cache_lock:
+            _redirect_refreshing.discard(key)
+
+
+def get_affiliate_for_redirect(short_code: str, slug: str = None):
+    """短網址重新導向用的代購業者查詢
+    
+    slug 有值時查詢 /<short_code>/c/<slug> 活動連結；short_code 也可能是活動自己的短網址。
+    活動連結的結果另外帶有 campaign_id、campaign_source、target_path。
+    
+    - 共用索引中有資料：直接回傳，不碰資料庫
+    - 共用索引已載入（且仍在更新）但查無資料：視為不存在，隨機或猜測的代碼不會打到資料庫
+    - 快取未過期：直接回傳
+    - 快取已過期：先回傳舊資料，背景重新查詢
+    - 熔斷中或資料庫錯誤：回傳最後一次取得的資料（不論多舊）
+    """
+    key = campaign_key(short_code, slug) if slug else short_code
+    # 索引裡沒有的活動連結算在主要短網址（新建的活動在下一次重建索引後生效）
+    if slug:
+        affiliate = affiliate_index.lookup_campaign(key) or affiliate_index.lookup_short_code(short_code)
+    else:
+        affiliate = affiliate_index.lookup_short_code(short_code) or affiliate_index.lookup_campaign(short_code)
+    if affiliate:
+        return affiliate
+    
+    # 索引包含所有代購業者與啟用中的活動連結，變更後 refresher 會立即重建
+    stats = affiliate_index.stats()
+    if stats and time.time() - stats['built_at'] < Config.AFFILIATE_INDEX_REFRESH * INDEX_STALE_FACTOR:
+        return None
+    
+    with _redirect_cache_lock:
+        cached = _redirect_cache.get(key)
+    
+    if cached:
+        affiliate, fetched_at = cached
+        if time.monotonic() - fetched_at < Config.REDIRECT_CACHE_TTL or db_breaker.is_open():
+            return affiliate
+        
+        with _redirect_cache_lock:
+            if key in _redirect_refreshing:
+                return affiliate
+            _redirect_refreshing.add(key)
+        threading.Thread(target=_refresh_affiliate_for_redirect, args=(key, short_code, slug), daemon=True).start()
+        return affiliate
+    
+    try:
+        return _fetch_affiliate_for_redirect(key, short_code, slug)
+    except Exception as e:
+        print(f"Error in get_affiliate_for_redirect: {e}")
+        return None
+
+
 # ============================================
 # Click（點擊）操作
 # ============================================
 
+# 點擊 ID 附加在 ref 參數後面：?ref=<ref_code>.<click_id>
+CLICK_ID_LENGTH = 10
+CLICK_ID_SEPARATOR = '.'
+
+
+def new_click_id():
+    """產生一個短的點擊 ID"""
+    return shortuuid.random(length=CLICK_ID_LENGTH)
+
+
+def compose_ref_value(ref_code: str, click_id: str = None):
+    """組合帶點擊 ID 的 ref 參數值"""
+    return f"{ref_code}{CLICK_ID_SEPARATOR}{click_id}" if click_id else ref_code
+
+
+def split_ref_value(value: str):
+    """拆解 ref 參數值，回傳 (ref_code, click_id)；沒有點擊 ID 時 click_id 為 None"""
+    if not value:
+        return value, None
+    ref_code, separator, click_id = value.rpartition(CLICK_ID_SEPARATOR)
+    if separator and ref_code and len(click_id) == CLICK_ID_LENGTH and click_id.isalnum():
+        return ref_code, click_id
+    return value, None
+
+
 def record_click(affiliate_id: str, ip_address: str = None, 
                  user_agent: str = None, referer: str = None, 
-                 landed_url: str = None, source: str = None):
-    """記錄一次點擊"""
+                 landed_url: str = None, source: str = None,
+                 click_id: str = None, campaign_id: int = None):
+    """記錄一次點擊（campaign_id 為活動連結，活動統計由資料庫觸發器累加）"""
     db = get_supabase()
     
     data = {
@@ -162,7 +469,9 @@ def record_click(affiliate_id: str, ip_address: str = None,
         'user_agent': user_agent,
         'referer': referer,
         'landed_url': landed_url,
-        'source': source  # 新增來源欄位
+        'source': source,  # 新增來源欄位
+        'click_id': click_id,
+        'campaign_id': campaign_id
     }
     
     try:
@@ -171,6 +480,7 @@ def record_click(affiliate_id: str, ip_address: str = None,
         # 更新 affiliate 的點擊數
         if result.data:
             update_affiliate_stats(affiliate_id, clicks=1)
+            publish('click', {'affiliate_id': affiliate_id, 'source': source, 'campaign_id': campaign_id})
         
         return result.data[0] if result.data else None
     except Exception as e:
@@ -178,6 +488,20 @@ def record_click(affiliate_id: str, ip_address: str = None,
         return None
 
 
+def ingest_clicks(clicks: list):
+    """批次寫入獨立轉址程序記錄的點擊（已寫入的 click_id 會略過），並累加各代購業者的點擊數
+
+    回傳 {'inserted': 筆數, 'affiliate_ids': [受影響的代購業者]}
+    """
+    db = get_supabase()
+    try:
+        result = db.rpc('ingest_clicks', {'batch': clicks}).execute()
+        return result.data or {'inserted': 0, 'affiliate_ids': []}
+    except Exception as e:
+        print(f"Error in ingest_clicks: {e}")
+        return None
+
+
 def get_clicks_by_affiliate(affiliate_id: str, limit: int = 100):
     """取得代購業者的點擊記錄"""
     db = get_supabase()
@@ -212,14 +536,97 @@ def get_clicks_by_source(affiliate_id: str):
         return {}
 
 
+# ============================================
+# 活動連結
+# ============================================
+
+CAMPAIGN_STATS_FIELDS = 'campaign_id, clicks, orders, revenue, commission, last_click_at'
+
+
+def get_campaign_links(affiliate_id: str, include_archived: bool = False):
+    """取得代購業者的活動連結與各自的點擊、訂單、轉換率、營收"""
+    db = get_supabase()
+    try:
+        query = db.table('campaign_links').select('*').eq('affiliate_id', affiliate_id)
+        if not include_archived:
+            query = query.eq('status', 'active')
+        campaigns = query.order('created_at', desc=True).execute().data or []
+        if not campaigns:
+            return []
+
+        result = db.table('campaign_stats').select(CAMPAIGN_STATS_FIELDS)\
+            .in_('campaign_id', [campaign['id'] for campaign in campaigns]).execute()
+        stats = {row['campaign_id']: row for row in result.data or []}
+        for campaign in campaigns:
+            row = stats.get(campaign['id'], {})
+            campaign['clicks'] = row.get('clicks') or 0
+            campaign['orders'] = row.get('orders') or 0
+            campaign['revenue'] = float(row.get('revenue') or 0)
+            campaign['commission'] = float(row.get('commission') or 0)
+            campaign['last_click_at'] = row.get('last_click_at')
+            campaign['conversion_rate'] = round(campaign['orders'] * 100 / campaign['clicks'], 2) \
+                if campaign['clicks'] else 0
+        return campaigns
+    except Exception as e:
+        print(f"Error in get_campaign_links: {e}")
+        return []
+
+
+def create_campaign_link(affiliate_id: str, name: str, slug: str, source: str = None,
+                         target_path: str = None, own_short_code: bool = False):
+    """建立活動連結；own_short_code 時另外產生活動自己的短網址"""
+    db = get_supabase()
+    data = {
+        'affiliate_id': affiliate_id,
+        'name': name,
+        'slug': slug,
+        'source': source,
+        'target_path': target_path,
+        'status': 'active'
+    }
+    
+    for attempt in range(CODE_RETRIES):
+        try:
+            if own_short_code:
+                data['short_code'] = new_short_code()
+            result = db.table('campaign_links').insert(data).execute()
+            if result.data:
+                request_rebuild()
+                affiliate_versions.touch(affiliate_id)
+            return result.data[0] if result.data else None
+        except Exception as e:
+            # 自動產生的短網址撞到既有代碼（代購業者或其他活動，short_codes_pkey）時換一個重試
+            if attempt + 1 < CODE_RETRIES and own_short_code and 'short_code' in str(e) and _is_unique_violation(e):
+                continue
+            print(f"Error in create_campaign_link: {e}")
+            return None
+    return None
+
+
+def update_campaign_link_status(affiliate_id: str, campaign_id: int, status: str):
+    """封存或恢復活動連結（只能修改自己的）"""
+    db = get_supabase()
+    try:
+        result = db.table('campaign_links').update({'status': status})\
+            .eq('id', campaign_id).eq('affiliate_id', affiliate_id).execute()
+        if result.data:
+            request_rebuild()
+            affiliate_versions.touch(affiliate_id)
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error in update_campaign_link_status: {e}")
+        return None
+
+
 # ============================================
 # Referral Order（推薦訂單）操作
 # ============================================
 
 def create_referral_order(affiliate_id: str, shopify_order_id: str, order_number: str,
                           order_total: float, currency: str = 'JPY', 
-                          customer_email: str = None, order_created_at: str = None):
-    """建立推薦訂單記錄"""
+                          customer_email: str = None, order_created_at: str = None,
+                          click_id: str = None, line_items: list = None):
+    """建立推薦訂單記錄（有 line_items 時依佣金規則逐項計算）"""
     db = get_supabase()
     
     # 取得代購業者的佣金比例
@@ -228,7 +635,12 @@ def create_referral_order(affiliate_id: str, shopify_order_id: str, order_number
         return None
     
     commission_rate = float(affiliate.get('commission_rate') or 5)
-    commission_amount = round(order_total * commission_rate / 100, 2)
+    breakdown = None
+    if line_items:
+        commission_amount, commission_rate, breakdown = compute_commission(
+            line_items, commission_rate, at=order_created_at)
+    else:
+        commission_amount = round(order_total * commission_rate / 100, 2)
     
     data = {
         'affiliate_id': affiliate_id,
@@ -240,6 +652,8 @@ def create_referral_order(affiliate_id: str, shopify_order_id: str, order_number
         'commission_amount': commission_amount,
         'customer_email': customer_email,
         'order_created_at': order_created_at,
+        'click_id': click_id,
+        'commission_breakdown': breakdown,
         'status': 'pending'
     }
     
@@ -249,6 +663,9 @@ def create_referral_order(affiliate_id: str, shopify_order_id: str, order_number
         # 更新 affiliate 統計（但佣金先不算，等出貨確認後再算）
         if result.data:
             update_affiliate_stats(affiliate_id, orders=1, sales=order_total)
+            record_ledger_entry(affiliate_id, 'accrual', accrued=commission_amount,
+                                order_id=result.data[0]['id'])
+            publish('order', {**result.data[0], 'affiliate_name': affiliate.get('name')})
         
         return result.data[0] if result.data else None
     except Exception as e:
@@ -256,6 +673,68 @@ def create_referral_order(affiliate_id: str, shopify_order_id: str, order_number
         return None
 
 
+def bulk_create_referral_orders(orders: list, rules=None):
+    """批次建立推薦訂單（已存在的 shopify_order_id 直接略過），回傳這次新建立的訂單
+    
+    orders 的每筆需要 affiliate_id、commission_rate 與 create_referral_order 相同的訂單欄位；
+    有 line_items 時與 Webhook 一樣依佣金規則逐項計算（rules 為預先編譯好的規則）
+    """
+    db = get_supabase()
+    rows = []
+    for order in orders:
+        commission_rate = float(order.get('commission_rate') or 5)
+        order_total = float(order['order_total'])
+        commission_amount = round(order_total * commission_rate / 100, 2)
+        breakdown = None
+        if order.get('line_items'):
+            commission_amount, commission_rate, breakdown = compute_commission(
+                order['line_items'], commission_rate, at=order.get('order_created_at'), rules=rules)
+        rows.append({
+            'affiliate_id': order['affiliate_id'],
+            'shopify_order_id': order['shopify_order_id'],
+            'order_number': order.get('order_number'),
+            'order_total': order_total,
+            'currency': order.get('currency') or 'JPY',
+            'commission_rate': commission_rate,
+            'commission_amount': commission_amount,
+            'customer_email': order.get('customer_email'),
+            'order_created_at': order.get('order_created_at'),
+            'click_id': order.get('click_id'),
+            'commission_breakdown': breakdown,
+            'status': 'pending'
+        })
+    if not rows:
+        return []
+    
+    try:
+        result = db.table('referral_orders')\
+            .upsert(rows, on_conflict='shopify_order_id', ignore_duplicates=True).execute()
+        created = result.data or []
+        if not created:
+            return []
+        
+        db.table('commission_ledger').upsert([{
+            'affiliate_id': order['affiliate_id'],
+            'entry_type': 'accrual',
+            'order_id': order['id'],
+            'accrued_delta': order['commission_amount']
+        } for order in created], on_conflict='order_id,entry_type', ignore_duplicates=True).execute()
+        
+        # 每個代購業者只更新一次統計
+        totals = {}
+        for order in created:
+            count, sales = totals.get(order['affiliate_id'], (0, 0.0))
+            totals[order['affiliate_id']] = (count + 1, sales + float(order['order_total']))
+        for affiliate_id, (count, sales) in totals.items():
+            update_affiliate_stats(affiliate_id, orders=count, sales=sales)
+            affiliate_versions.touch(affiliate_id)
+        
+        return created
+    except Exception as e:
+        print(f"Error in bulk_create_referral_orders: {e}")
+        return None
+
+
 def get_order_by_shopify_id(shopify_order_id: str):
     """用 Shopify 訂單 ID 取得推薦訂單"""
     db = get_supabase()
@@ -305,46 +784,523 @@ def get_all_orders(status: str = None, limit: int = 100):
         return []
 
 
-def update_order_status(order_id: str, status: str):
-    """更新訂單狀態"""
+# update_order_status 的回傳值：可疑訂單維持待確認（與資料庫錯誤的 None 區分）
+ORDER_HELD = 'held'
+
+
+def update_order_status(order_id: str, status: str, force: bool = False):
+    """更新訂單狀態，回傳更新後的訂單；可疑訂單（詐騙分數達 FRAUD_HOLD_SCORE）需 force=True 才能確認，
+    否則回傳 ORDER_HELD；失敗時回傳 None"""
     db = get_supabase()
     
     try:
         update_data = {'status': status}
         
-        # 如果是確認（出貨），記錄確認時間並更新佣金
+        # 取得原本的訂單資訊
+        order = db.table('referral_orders').select('*').eq('id', order_id).execute()
+        order = order.data[0] if order.data else None
+        
+        # 確認前檢查詐騙分數，可疑訂單維持待確認，等管理員放行
+        if status == 'confirmed' and order:
+            if force:
+                update_data['fraud_cleared_at'] = datetime.now(timezone.utc).isoformat()
+            else:
+                score, reasons = _order_fraud_score(order)
+                if score >= Config.FRAUD_HOLD_SCORE:
+                    db.table('referral_orders').update({
+                        'fraud_score': score,
+                        'fraud_reasons': reasons,
+                        'fraud_checked_at': datetime.now(timezone.utc).isoformat()
+                    }).eq('id', order_id).execute()
+                    publish('order_held', {
+                        'id': order_id,
+                        'affiliate_id': order['affiliate_id'],
+                        'order_number': order.get('order_number'),
+                        'fraud_score': score,
+                        'fraud_reasons': reasons
+                    })
+                    return ORDER_HELD
+        
+        # 如果是確認（出貨），記錄確認時間
         if status == 'confirmed':
             update_data['confirmed_at'] = datetime.now(timezone.utc).isoformat()
-            
-            # 取得訂單資訊
-            order = db.table('referral_orders').select('*').eq('id', order_id).execute()
-            if order.data:
-                order = order.data[0]
-                # 更新 affiliate 的待發放佣金
+        
+        # 確認時加上待發放佣金，已確認的訂單取消或退款時扣回；
+        # 扣到 0 為止，帳本記錄實際變動的金額，兩邊的餘額才會一致
+        pending_change = 0.0
+        if order:
+            commission = float(order.get('commission_amount') or 0)
+            if status == 'confirmed' and order['status'] not in ('confirmed', 'paid'):
+                pending_change = commission
+            elif status in ('cancelled', 'refunded') and order['status'] == 'confirmed':
+                pending_change = -commission
+            if pending_change:
                 affiliate = get_affiliate_by_id(order['affiliate_id'])
                 if affiliate:
-                    new_pending = float(affiliate.get('pending_commission') or 0) + float(order['commission_amount'])
+                    current_pending = float(affiliate.get('pending_commission') or 0)
+                    new_pending = max(0, current_pending + pending_change)
+                    pending_change = new_pending - current_pending
                     update_affiliate(order['affiliate_id'], pending_commission=new_pending)
         
-        # 如果是退款，扣回佣金
-        elif status == 'refunded':
-            order = db.table('referral_orders').select('*').eq('id', order_id).execute()
-            if order.data:
-                order = order.data[0]
-                if order['status'] == 'confirmed':
-                    # 已確認的訂單退款，要扣回佣金
-                    affiliate = get_affiliate_by_id(order['affiliate_id'])
-                    if affiliate:
-                        new_pending = max(0, float(affiliate.get('pending_commission') or 0) - float(order['commission_amount']))
-                        update_affiliate(order['affiliate_id'], pending_commission=new_pending)
-        
         result = db.table('referral_orders').update(update_data).eq('id', order_id).execute()
+        
+        if result.data and order:
+            _record_status_change(order, status, pending_change)
+            affiliate_versions.touch(order['affiliate_id'])
+            publish('order_status', {
+                'id': order_id,
+                'affiliate_id': order['affiliate_id'],
+                'order_number': order.get('order_number'),
+                'commission_amount': order.get('commission_amount'),
+                'previous_status': order['status'],
+                'status': status
+            })
+        
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"Error in update_order_status: {e}")
         return None
 
 
+# ============================================
+# 佣金規則
+# ============================================
+
+def get_commission_rules(active_only: bool = False):
+    """取得佣金規則（依優先順序）"""
+    db = get_supabase()
+    try:
+        query = db.table('commission_rules').select('*')
+        if active_only:
+            query = query.eq('status', 'active')
+        result = query.order('priority', desc=True).order('id').execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_commission_rules: {e}")
+        return None
+
+
+def create_commission_rule(**kwargs):
+    """建立佣金規則"""
+    db = get_supabase()
+    try:
+        result = db.table('commission_rules').insert(kwargs).execute()
+        if result.data:
+            notify_rules_changed()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error in create_commission_rule: {e}")
+        return None
+
+
+def update_commission_rule(rule_id: int, **kwargs):
+    """更新佣金規則"""
+    db = get_supabase()
+    try:
+        result = db.table('commission_rules').update(kwargs).eq('id', rule_id).execute()
+        if result.data:
+            notify_rules_changed()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error in update_commission_rule: {e}")
+        return None
+
+
+# ============================================
+# 詐騙偵測
+# ============================================
+
+# 各項可疑原因的分數，加總後上限 100
+FRAUD_SCORES = {
+    'self_referral': 100,       # 顧客 Email 就是代購業者自己
+    'affiliate_customer': 40,   # 顧客 Email 是其他代購業者
+    'click_burst': 60           # 訂單的點擊來自短時間大量點擊的同一 IP / User-Agent
+}
+
+
+def normalize_email(email: str):
+    """正規化 Email 以便比對（小寫、去掉 +標籤，Gmail 另外去掉本地部分的點）"""
+    if not email:
+        return None
+    local, _, domain = email.strip().lower().partition('@')
+    if not domain:
+        return None
+    local = local.split('+', 1)[0]
+    if domain in ('gmail.com', 'googlemail.com'):
+        local = local.replace('.', '')
+        domain = 'gmail.com'
+    return f"{local}@{domain}"
+
+
+def fraud_score(reasons) -> int:
+    """可疑原因換算成分數"""
+    return min(100, sum(FRAUD_SCORES.get(reason, 0) for reason in reasons))
+
+
+def _order_fraud_score(order: dict):
+    """確認前的即時檢查：沿用批次評分的結果，再比對一次顧客與代購業者的 Email"""
+    if order.get('fraud_cleared_at'):
+        return 0, []
+    reasons = set(order.get('fraud_reasons') or [])
+    if order.get('customer_email'):
+        affiliate = get_affiliate_by_id(order['affiliate_id'])
+        if affiliate and normalize_email(affiliate.get('email')) == normalize_email(order['customer_email']):
+            reasons.add('self_referral')
+    reasons = sorted(reasons)
+    return fraud_score(reasons), reasons
+
+
+def get_affiliate_emails():
+    """取得所有有 Email 的代購業者（id, email）"""
+    db = get_supabase()
+    try:
+        return _select_all(lambda: db.table('affiliates').select('id, email')
+                           .not_.is_('email', 'null').order('id'))
+    except Exception as e:
+        print(f"Error in get_affiliate_emails: {e}")
+        return None
+
+
+def get_unscored_orders(limit: int = 1000):
+    """取得尚未評分的待確認訂單"""
+    db = get_supabase()
+    try:
+        result = db.table('referral_orders')\
+            .select('id, affiliate_id, customer_email, click_id')\
+            .is_('fraud_checked_at', 'null').eq('status', 'pending')\
+            .order('created_at').limit(limit).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_unscored_orders: {e}")
+        return None
+
+
+# in_() 的 ID 都放在網址上，每次最多查詢這麼多個
+CLICK_ID_CHUNK_SIZE = 200
+
+
+def get_clicks_by_click_ids(click_ids: list, columns: str = '*'):
+    """用點擊 ID 批次取得點擊（每 CLICK_ID_CHUNK_SIZE 個 ID 查詢一次）"""
+    if not click_ids:
+        return []
+    db = get_supabase()
+    click_ids = list(click_ids)
+    try:
+        clicks = []
+        for start in range(0, len(click_ids), CLICK_ID_CHUNK_SIZE):
+            chunk = click_ids[start:start + CLICK_ID_CHUNK_SIZE]
+            result = db.table('clicks').select(columns).in_('click_id', chunk).execute()
+            clicks.extend(result.data or [])
+        return clicks
+    except Exception as e:
+        print(f"Error in get_clicks_by_click_ids: {e}")
+        return None
+
+
+def apply_fraud_scores(scores: list):
+    """批次寫回訂單的詐騙分數，回傳更新筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('apply_fraud_scores', {'scores': scores}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in apply_fraud_scores: {e}")
+        return None
+
+
+def save_click_bursts(bursts: list):
+    """寫入偵測到的點擊暴增（同一時段重複執行時更新點擊數）"""
+    if not bursts:
+        return []
+    db = get_supabase()
+    try:
+        result = db.table('click_bursts').upsert(
+            bursts, on_conflict='affiliate_id,ip_address,ua_hash,window_start'
+        ).execute()
+        return result.data or []
+    except Exception as e:
+        print(f"Error in save_click_bursts: {e}")
+        return None
+
+
+# ============================================
+# 點擊歸因（Click → Order）
+# ============================================
+
+def run_attribution(window_days: int = None, batch_size: int = 5000):
+    """把尚未歸因的訂單對應到點擊並更新各來源轉換統計（在資料庫內以索引 join）
+    
+    回傳 {'attributed': 筆數, 'affiliate_ids': [受影響的代購業者]}
+    """
+    db = get_supabase()
+    if window_days is None:
+        window_days = Config.COOKIE_DAYS
+    try:
+        result = db.rpc('run_attribution', {'window_days': window_days, 'batch_size': batch_size}).execute()
+        return result.data or {'attributed': 0, 'affiliate_ids': []}
+    except Exception as e:
+        print(f"Error in run_attribution: {e}")
+        return None
+
+
+def get_source_conversions(affiliate_id: str):
+    """取得代購業者各來源的點擊、訂單、轉換率與營收"""
+    db = get_supabase()
+    try:
+        result = db.table('source_conversions').select('source, clicks, orders, revenue, commission')\
+            .eq('affiliate_id', affiliate_id).order('clicks', desc=True).execute()
+        rows = result.data if result.data else []
+        for row in rows:
+            row['conversion_rate'] = round(row['orders'] * 100 / row['clicks'], 2) if row['clicks'] else 0
+        return rows
+    except Exception as e:
+        print(f"Error in get_source_conversions: {e}")
+        return []
+
+
+# ============================================
+# 時間序列統計（每小時 / 每日統計表）
+# ============================================
+
+def get_stats_timeseries(affiliate_id: str, granularity: str, since: str, until: str):
+    """取得 [since, until) 期間有資料的時段統計；affiliate_id 為 None 時加總所有代購業者"""
+    db = get_supabase()
+    try:
+        result = db.rpc('stats_timeseries', {
+            'target_affiliate_id': affiliate_id,
+            'granularity': granularity,
+            'since': since,
+            'until': until
+        }).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_stats_timeseries: {e}")
+        return None
+
+
+def rebuild_stats_buckets():
+    """從點擊與訂單重建每小時、每日統計表"""
+    db = get_supabase()
+    try:
+        db.rpc('rebuild_stats_buckets', {}).execute()
+        return True
+    except Exception as e:
+        print(f"Error in rebuild_stats_buckets: {e}")
+        return False
+
+
+# ============================================
+# 點擊維度（裝置 / 瀏覽器 / 作業系統 / 來源網站）
+# ============================================
+
+CLICK_DIMENSIONS = ('device', 'browser', 'os', 'referrer')
+
+
+def get_unenriched_clicks(limit: int = 5000):
+    """取得還沒寫入維度 id 的點擊（由舊到新）"""
+    db = get_supabase()
+    try:
+        result = db.table('clicks').select('id, created_at, user_agent, referer')\
+            .is_('device_id', 'null').order('created_at').limit(limit).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_unenriched_clicks: {e}")
+        return None
+
+
+def get_click_dimensions():
+    """取得所有維度，回傳 {(kind, value): id}"""
+    db = get_supabase()
+    try:
+        rows = _select_all(lambda: db.table('click_dimensions').select('id, kind, value').order('id'))
+        return {(row['kind'], row['value']): row['id'] for row in rows}
+    except Exception as e:
+        print(f"Error in get_click_dimensions: {e}")
+        return None
+
+
+def ensure_click_dimensions(dims: list):
+    """取得（必要時建立）維度，dims 為 (kind, value) 清單，回傳 {(kind, value): id}"""
+    db = get_supabase()
+    try:
+        result = db.rpc('ensure_click_dimensions', {
+            'dims': [{'kind': kind, 'value': value} for kind, value in dims]
+        }).execute()
+        return {(row['kind'], row['value']): row['id'] for row in result.data or []}
+    except Exception as e:
+        print(f"Error in ensure_click_dimensions: {e}")
+        return None
+
+
+def apply_click_dimensions(updates: list):
+    """批次寫回點擊的維度 id，回傳更新筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('apply_click_dimensions', {'updates': updates}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in apply_click_dimensions: {e}")
+        return None
+
+
+def get_click_breakdown(affiliate_id: str, dimension: str, since: str, until: str):
+    """依維度分組的點擊數；affiliate_id 為 None 時統計所有代購業者"""
+    db = get_supabase()
+    try:
+        result = db.rpc('click_dimension_breakdown', {
+            'target_affiliate_id': affiliate_id,
+            'dimension': dimension,
+            'since': since,
+            'until': until
+        }).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_click_breakdown: {e}")
+        return None
+
+
+# ============================================
+# 點擊分區與保存期限
+# ============================================
+
+def ensure_click_partitions(months_ahead: int = 3):
+    """預先建立本月起 months_ahead 個月的點擊分區，並把 clicks_default 中的點擊搬到月份分區，回傳新建立的數量"""
+    db = get_supabase()
+    try:
+        result = db.rpc('ensure_click_partitions', {'months_ahead': months_ahead}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in ensure_click_partitions: {e}")
+        return None
+
+
+def list_click_partitions():
+    """取得所有月份分區與時間範圍（由舊到新）"""
+    db = get_supabase()
+    try:
+        result = db.rpc('list_click_partitions', {}).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in list_click_partitions: {e}")
+        return None
+
+
+def get_clicks_page(since: str, until: str, after_id: str = None, limit: int = 5000, columns: str = '*'):
+    """依 id 順序取得 [since, until) 期間 after_id 之後的點擊（大量讀取時逐頁使用）"""
+    db = get_supabase()
+    try:
+        query = db.table('clicks').select(columns).gte('created_at', since).lt('created_at', until)
+        if after_id:
+            query = query.gt('id', after_id)
+        result = query.order('id').limit(limit).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_clicks_page: {e}")
+        return None
+
+
+def drop_click_partition(name: str, archived_rows: int):
+    """刪除已封存的分區（筆數必須與封存檔一致），回傳刪除的筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('drop_click_partition', {
+            'partition_name': name,
+            'archived_rows': archived_rows
+        }).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in drop_click_partition: {e}")
+        return None
+
+
+def anonymize_click_ips(older_than_days: int):
+    """把超過指定天數的點擊 IP 匿名化，回傳更新筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('anonymize_click_ips', {'older_than_days': older_than_days}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in anonymize_click_ips: {e}")
+        return None
+
+
+# ============================================
+# 排行榜（最近 7 / 30 天）
+# ============================================
+
+LEADERBOARD_WINDOWS = (7, 30)
+LEADERBOARD_METRICS = ('clicks', 'orders', 'sales', 'commission')
+
+_leaderboards = {'value': None, 'loaded_at': 0.0, 'refreshed_at': 0.0}
+_leaderboards_lock = threading.Lock()
+_leaderboards_refreshing = threading.Event()
+
+
+def refresh_leaderboards(top_k: int = None):
+    """從每日統計重算排行榜，回傳寫入筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('refresh_leaderboards', {'top_k': top_k or Config.LEADERBOARD_SIZE}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in refresh_leaderboards: {e}")
+        return None
+
+
+def _refresh_leaderboards_in_background():
+    try:
+        refresh_leaderboards()
+        with _leaderboards_lock:
+            _leaderboards['loaded_at'] = 0.0
+    finally:
+        _leaderboards_refreshing.clear()
+
+
+def _load_leaderboards():
+    db = get_supabase()
+    result = db.table('affiliate_leaderboards').select('*').order('rank').execute()
+    boards = {days: {metric: [] for metric in LEADERBOARD_METRICS} for days in LEADERBOARD_WINDOWS}
+    refreshed_at = None
+    for row in result.data or []:
+        board = boards.get(row['window_days'], {}).get(row['metric'])
+        if board is not None:
+            board.append(row)
+        refreshed_at = max(refreshed_at or row['refreshed_at'], row['refreshed_at'])
+    return boards, refreshed_at
+
+
+def get_leaderboards(cache_ttl: float = 60):
+    """取得排行榜 {天數: {指標: [前幾名]}}；結果在記憶體快取 cache_ttl 秒，過期太久時在背景重算"""
+    now = time.monotonic()
+    with _leaderboards_lock:
+        if _leaderboards['value'] is not None and now - _leaderboards['loaded_at'] < cache_ttl:
+            return _leaderboards['value']
+
+    try:
+        boards, refreshed_at = _load_leaderboards()
+    except Exception as e:
+        print(f"Error in get_leaderboards: {e}")
+        return _leaderboards['value'] or {}
+
+    if refreshed_at:
+        age = (datetime.now(timezone.utc) - datetime.fromisoformat(refreshed_at)).total_seconds()
+        stale = age > Config.LEADERBOARD_REFRESH
+    else:
+        # 排行榜是空的：依本 worker 上次重算的時間判斷，避免每次都重算
+        stale = now - _leaderboards['refreshed_at'] > Config.LEADERBOARD_REFRESH
+
+    with _leaderboards_lock:
+        start_refresh = stale and not _leaderboards_refreshing.is_set()
+        if start_refresh:
+            _leaderboards_refreshing.set()
+            _leaderboards['refreshed_at'] = now
+        _leaderboards['value'] = boards
+        _leaderboards['loaded_at'] = now
+    if start_refresh:
+        threading.Thread(target=_refresh_leaderboards_in_background, daemon=True).start()
+    return boards
+
+
 # ============================================
 # Payout（佣金發放）操作
 # ============================================
@@ -369,11 +1325,17 @@ def create_payout(affiliate_id: str, amount: float, currency: str = 'JPY',
         
         # 更新 affiliate 的佣金狀態
         if result.data:
+            # 待發放佣金扣到 0 為止；帳本記錄實際扣掉的金額，與代購業者的餘額一致
+            pending_change = -amount
             affiliate = get_affiliate_by_id(affiliate_id)
             if affiliate:
-                new_pending = max(0, float(affiliate.get('pending_commission') or 0) - amount)
+                current_pending = float(affiliate.get('pending_commission') or 0)
+                new_pending = max(0, current_pending - amount)
+                pending_change = new_pending - current_pending
                 new_paid = float(affiliate.get('paid_commission') or 0) + amount
                 update_affiliate(affiliate_id, pending_commission=new_pending, paid_commission=new_paid)
+            record_ledger_entry(affiliate_id, 'payout', pending=pending_change, paid=amount,
+                                payout_id=result.data[0]['id'], note=note)
         
         return result.data[0] if result.data else None
     except Exception as e:
@@ -413,6 +1375,227 @@ def get_all_payouts(limit: int = 100):
         return []
 
 
+def get_payout_candidates(min_amount: float = None):
+    """取得待發放佣金達到門檻的代購業者（一次查詢），金額為可轉帳的整數日圓"""
+    db = get_supabase()
+    if min_amount is None:
+        min_amount = Config.MIN_PAYOUT_JPY
+    try:
+        result = db.table('affiliates').select('id, name, email, status, pending_commission')\
+            .gte('pending_commission', min_amount).order('pending_commission', desc=True).execute()
+        candidates = result.data if result.data else []
+        for candidate in candidates:
+            candidate['amount'] = int(float(candidate['pending_commission']))
+        return candidates
+    except Exception as e:
+        print(f"Error in get_payout_candidates: {e}")
+        return []
+
+
+def create_payout_run(affiliate_ids: list, payment_method: str = None, note: str = None,
+                      min_amount: float = None):
+    """批次發放：在單一交易內建立發放記錄並扣減佣金，回傳 {'run_id', 'payouts'}"""
+    db = get_supabase()
+    if min_amount is None:
+        min_amount = Config.MIN_PAYOUT_JPY
+    run_id = f"run-{datetime.now(timezone.utc):%Y%m%d%H%M%S}-{shortuuid.random(length=4).lower()}"
+    try:
+        result = db.rpc('create_payout_run', {
+            'run_code': run_id,
+            'affiliate_ids': affiliate_ids,
+            'min_amount': min_amount,
+            'method': payment_method,
+            'run_note': note
+        }).execute()
+        payouts = result.data or []
+        for payout in payouts:
+            affiliate_versions.touch(payout['affiliate_id'])
+        return {'run_id': run_id, 'payouts': payouts}
+    except Exception as e:
+        print(f"Error in create_payout_run: {e}")
+        return None
+
+
+def get_payouts_by_run(run_id: str):
+    """取得批次發放的所有記錄（含代購業者名稱與 Email）"""
+    db = get_supabase()
+    try:
+        payouts = _select_all(lambda: db.table('payouts').select('*').eq('run_id', run_id).order('id'))
+        affiliate_ids = list({payout['affiliate_id'] for payout in payouts})
+        affiliates = {}
+        for start in range(0, len(affiliate_ids), 200):
+            rows = db.table('affiliates').select('id, name, email')\
+                .in_('id', affiliate_ids[start:start + 200]).execute().data or []
+            affiliates.update((row['id'], row) for row in rows)
+        for payout in payouts:
+            payout['affiliates'] = affiliates.get(payout['affiliate_id'])
+        return payouts
+    except Exception as e:
+        print(f"Error in get_payouts_by_run: {e}")
+        return []
+
+
+# ============================================
+# 佣金帳本（只新增不修改）
+# ============================================
+
+LEDGER_ENTRY_TYPES = ('opening', 'accrual', 'confirmation', 'reversal', 'payout')
+
+
+def record_ledger_entry(affiliate_id: str, entry_type: str, accrued: float = 0,
+                        pending: float = 0, paid: float = 0, order_id: str = None,
+                        payout_id: str = None, note: str = None):
+    """寫入一筆帳本記錄；同一訂單重複的同類記錄會被忽略"""
+    db = get_supabase()
+    data = {
+        'affiliate_id': affiliate_id,
+        'entry_type': entry_type,
+        'order_id': order_id,
+        'payout_id': payout_id,
+        'accrued_delta': round(float(accrued), 2),
+        'pending_delta': round(float(pending), 2),
+        'paid_delta': round(float(paid), 2),
+        'note': note
+    }
+    try:
+        result = db.table('commission_ledger')\
+            .upsert(data, on_conflict='order_id,entry_type', ignore_duplicates=True).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error in record_ledger_entry: {e}")
+        return None
+
+
+def _record_status_change(order: dict, status: str, pending_change: float):
+    """依訂單狀態變更寫入確認或沖銷記錄；pending_change 為代購業者待發放佣金實際的變動"""
+    previous = order['status']
+    commission = float(order.get('commission_amount') or 0)
+    if status == 'confirmed' and previous not in ('confirmed', 'paid'):
+        record_ledger_entry(order['affiliate_id'], 'confirmation',
+                            accrued=-commission if previous == 'pending' else 0,
+                            pending=pending_change, order_id=order['id'])
+    elif status in ('cancelled', 'refunded') and previous in ('pending', 'confirmed'):
+        # 未確認的訂單沖銷未確認佣金，已確認的沖銷待發放佣金
+        record_ledger_entry(order['affiliate_id'], 'reversal',
+                            accrued=-commission if previous == 'pending' else 0,
+                            pending=pending_change, order_id=order['id'], note=status)
+
+
+def get_ledger_entries(affiliate_id: str, limit: int = 100):
+    """取得代購業者最近的帳本記錄"""
+    db = get_supabase()
+    try:
+        result = db.table('commission_ledger').select('*').eq('affiliate_id', affiliate_id)\
+            .order('id', desc=True).limit(limit).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in get_ledger_entries: {e}")
+        return []
+
+
+def get_commission_balance(affiliate_id: str, as_of: str = None):
+    """取得代購業者在指定時間點（預設現在）的未確認、待發放、已發放佣金"""
+    db = get_supabase()
+    params = {'target_affiliate_id': affiliate_id}
+    if as_of:
+        params['as_of'] = as_of
+    try:
+        result = db.rpc('commission_balance_as_of', params).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in get_commission_balance: {e}")
+        return None
+
+
+def seed_commission_openings():
+    """為導入帳本前就有佣金的代購業者寫入期初餘額，回傳寫入筆數（已有期初記錄的略過）"""
+    db = get_supabase()
+    try:
+        result = db.rpc('seed_commission_openings', {}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in seed_commission_openings: {e}")
+        return None
+
+
+def take_commission_snapshots(settle_seconds: int = 60):
+    """為有新帳本記錄的代購業者寫入餘額快照，回傳寫入筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('take_commission_snapshots', {'settle_seconds': settle_seconds}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in take_commission_snapshots: {e}")
+        return None
+
+
+# ============================================
+# 系統設定
+# ============================================
+
+def get_setting(key: str, default: str = None):
+    """取得系統設定值"""
+    db = get_supabase()
+    try:
+        result = db.table('settings').select('value').eq('key', key).execute()
+        return result.data[0]['value'] if result.data else default
+    except Exception as e:
+        print(f"Error in get_setting: {e}")
+        return default
+
+
+def set_setting(key: str, value: str):
+    """寫入系統設定值"""
+    db = get_supabase()
+    try:
+        result = db.table('settings').upsert({
+            'key': key,
+            'value': value,
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error in set_setting: {e}")
+        return None
+
+
+# ============================================
+# 對帳（affiliates 金額欄位）
+# ============================================
+
+def get_affiliates_changed_since(since: str = None):
+    """取得指定時間後有變動的代購業者，回傳 {'now': 資料庫時間, 'affiliate_ids': [...]}"""
+    db = get_supabase()
+    try:
+        result = db.rpc('affiliates_changed_since', {'since': since}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in get_affiliates_changed_since: {e}")
+        return None
+
+
+def compute_affiliate_totals(affiliate_ids: list):
+    """取得一批代購業者目前的金額欄位與正確值"""
+    db = get_supabase()
+    try:
+        result = db.rpc('compute_affiliate_totals', {'affiliate_ids': affiliate_ids}).execute()
+        return result.data if result.data else []
+    except Exception as e:
+        print(f"Error in compute_affiliate_totals: {e}")
+        return None
+
+
+def apply_affiliate_totals(totals: list):
+    """批次寫回修正後的金額欄位，回傳更新筆數"""
+    db = get_supabase()
+    try:
+        result = db.rpc('apply_affiliate_totals', {'totals': totals}).execute()
+        return result.data
+    except Exception as e:
+        print(f"Error in apply_affiliate_totals: {e}")
+        return None
+
+
 # ============================================
 # 統計查詢
 # ============================================
@@ -0,0 +1,348 @@
+"""
+獨立的短網址轉址程序（只用標準函式庫，不需要 Flask 與資料庫）
+
+build-redirect-map（或共用索引的 refresher）把啟用中的代購業者與活動連結編譯成一份
+帶版本的對照檔，這個程序以 mmap 唯讀開啟，每個請求只做一次二分搜尋就回 302，
+點擊以 JSON lines 附加到 CLICK_LOG_DIR 下的本機檔案，之後由 ingest-clicks 批次寫入資料庫。
+對照檔以 os.replace 原子替換，下一個請求發現 inode 改變就換用新版本，不需要重新啟動。
+Flask 只需要處理管理後台、代購業者入口、Webhook 與分享圖。
+
+對照檔格式（little-endian）：
+    header   magic(8s) version(Q) built_at(d) count(I) meta(IH)
+    entries  count × [hash(Q) key(IH) affiliate_id(16s) ref(IH) name(IH) target(IH) source(IH) campaign_id(I)]，
+             依 hash 排序；key 為短網址、「短網址/c/slug」或活動自己的短網址，target 為不含 ref 的目標網址
+    strings  UTF-8 字串池；meta 為 JSON（預設目標、來源代碼、點擊 ID 格式、分享圖網址、爬蟲 UA、商品路徑規則）
+
+點擊記錄檔每小時、每個程序各一個：clicks-<YYYYMMDDHH>-<主機>-<pid>.jsonl（時間為 UTC）。
+
+執行：
+    python redirector.py --port 8080
+    gunicorn -w 4 -b 0.0.0.0:8080 redirector:application
+"""
+import argparse
+import hashlib
+import html
+import json
+import mmap
+import os
+import re
+import secrets
+import socket
+import string
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, quote
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+MAGIC = b'GYRMAP01'
+HEADER = struct.Struct('<8sQdIIH')
+ENTRY = struct.Struct('<QIH16sIHIHIHIHI')
+
+MAP_FILENAME = 'redirect_map.bin'
+CLICK_LOG_PREFIX = 'clicks-'
+CLICK_LOG_SUFFIX = '.jsonl'
+CLICK_ID_ALPHABET = string.ascii_letters + string.digits
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1f\x7f]')
+
+# 與 config.py 相同的預設位置
+SHARED_DIR = os.getenv('SHARED_DIR', '/dev/shm/goyoulink' if os.path.isdir('/dev/shm')
+                       else os.path.join(tempfile.gettempdir(), 'goyoulink'))
+REDIRECT_MAP_PATH = os.getenv('REDIRECT_MAP_PATH') or os.path.join(SHARED_DIR, MAP_FILENAME)
+CLICK_LOG_DIR = os.getenv('CLICK_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clicklog'))
+PROXY_FIX_HOPS = int(os.getenv('PROXY_FIX_HOPS', 1))
+
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def campaign_key(short_code: str, slug: str) -> str:
+    """活動連結 /<short_code>/c/<slug> 的 key（與 services.affiliate_index.campaign_key 相同）"""
+    return f"{short_code}/c/{slug}"
+
+
+def click_log_hour(filename: str):
+    """點擊記錄檔名中的小時（YYYYMMDDHH）；不是點擊記錄檔時回傳 None"""
+    if not filename.startswith(CLICK_LOG_PREFIX) or not filename.endswith(CLICK_LOG_SUFFIX):
+        return None
+    hour = filename[len(CLICK_LOG_PREFIX):].split('-', 1)[0]
+    return hour if len(hour) == 10 and hour.isdigit() else None
+
+
+# ============================================
+# 讀取對照檔
+# ============================================
+
+class RedirectMap:
+    """唯讀的對照檔對應，檔案被替換時自動換用新版本"""
+
+    def __init__(self, path: str = None):
+        self.path = path or REDIRECT_MAP_PATH
+        self._map = None
+        self._meta = None
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return None
+        if inode == self._inode:
+            return self._map
+
+        with self._lock:
+            if inode != self._inode:
+                try:
+                    with open(self.path, 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if HEADER.unpack_from(mapped, 0)[0] != MAGIC:
+                        raise ValueError('bad magic')
+                    _, _, _, count, meta_off, meta_len = HEADER.unpack_from(mapped, 0)
+                    meta = json.loads(self._string(mapped, count, meta_off, meta_len))
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"Error loading redirect map: {e}")
+                    return None
+                # 舊的 mmap 不主動關閉，讓仍在讀取的執行緒安全結束，由 GC 回收
+                self._map, self._meta, self._inode = mapped, meta, inode
+        return self._map
+
+    @property
+    def meta(self) -> dict:
+        return self._meta if self._current() else {}
+
+    def stats(self):
+        mapped = self._current()
+        if not mapped:
+            return None
+        _, version, built_at, count, _, _ = HEADER.unpack_from(mapped, 0)
+        return {'version': version, 'built_at': built_at, 'count': count, 'bytes': len(mapped)}
+
+    @staticmethod
+    def _string(mapped, count, offset, length):
+        start = HEADER.size + count * ENTRY.size + offset
+        return mapped[start:start + length].decode('utf-8')
+
+    def lookup(self, key: str):
+        """查詢短網址或活動連結 key；對照檔不存在或查無資料時回傳 None"""
+        mapped = self._current()
+        if not key or not mapped:
+            return None
+
+        count = HEADER.unpack_from(mapped, 0)[3]
+        target = key_hash(key)
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if ENTRY.unpack_from(mapped, HEADER.size + mid * ENTRY.size)[0] < target:
+                low = mid + 1
+            else:
+                high = mid
+
+        while low < count:
+            (entry_hash, key_off, key_len, id_bytes, ref_off, ref_len, name_off, name_len,
+             target_off, target_len, source_off, source_len, campaign_id) = ENTRY.unpack_from(
+                mapped, HEADER.size + low * ENTRY.size)
+            if entry_hash != target:
+                return None
+            if self._string(mapped, count, key_off, key_len) == key:
+                return {
+                    'affiliate_id': str(uuid.UUID(bytes=id_bytes)),
+                    'ref_code': self._string(mapped, count, ref_off, ref_len),
+                    'name': self._string(mapped, count, name_off, name_len),
+                    'target': self._string(mapped, count, target_off, target_len),
+                    'source': self._string(mapped, count, source_off, source_len) or None,
+                    'campaign_id': campaign_id or None
+                }
+            low += 1
+        return None
+
+
+# ============================================
+# 點擊記錄
+# ============================================
+
+class ClickLog:
+    """把點擊以 JSON lines 附加到本機檔案；每小時換一個檔，每行一次 write()"""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or CLICK_LOG_DIR
+        self._host = re.sub(r'[^\w.]', '_', socket.gethostname())
+        self._hour = None
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def append(self, click: dict):
+        line = (json.dumps(click, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        hour = time.strftime('%Y%m%d%H', time.gmtime())
+        with self._lock:
+            try:
+                if hour != self._hour or self._fd is None:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                        self._fd = None
+                    os.makedirs(self.directory, exist_ok=True)
+                    filename = f"{CLICK_LOG_PREFIX}{hour}-{self._host}-{os.getpid()}{CLICK_LOG_SUFFIX}"
+                    self._fd = os.open(os.path.join(self.directory, filename),
+                                       os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    self._hour = hour
+                os.write(self._fd, line)
+            except OSError as e:
+                # 記錄失敗仍照常轉址，不讓訪客看到錯誤
+                print(f"Error writing click log: {e}")
+
+
+# ============================================
+# WSGI 應用程式
+# ============================================
+
+redirect_map = RedirectMap()
+click_log = ClickLog()
+
+
+def new_click_id(length: int) -> str:
+    return ''.join(secrets.choice(CLICK_ID_ALPHABET) for _ in range(length))
+
+
+def _respond(start_response, status: str, body: bytes = b'', headers=()):
+    start_response(status, [('Content-Length', str(len(body))), *headers])
+    return [body]
+
+
+def _link_preview(start_response, meta: dict, entry: dict, short_code: str, product_path: str, url: str, location: str):
+    """給 LINE / Facebook 等爬蟲的預覽頁（不記點擊）；分享圖網址由 Flask 的 /share 提供"""
+    image_url = f"{meta['share_base']}/{quote(short_code)}/og.png"
+    if product_path:
+        image_url += f"?p={quote(product_path, safe='/%')}"
+    title = html.escape(f"{entry['name'] or 'GoyouLink'} 推薦的日本好物")
+    body = (
+        '<!DOCTYPE html><html lang="zh-TW"><head><meta charset="utf-8">'
+        f'<title>{title}</title>'
+        f'<meta property="og:title" content="{title}">'
+        '<meta property="og:description" content="日本精選商品，直送到家。">'
+        f'<meta property="og:url" content="{html.escape(url)}">'
+        f'<meta property="og:image" content="{html.escape(image_url)}">'
+        '<meta property="og:image:width" content="1200"><meta property="og:image:height" content="630">'
+        '<meta name="twitter:card" content="summary_large_image">'
+        f'<meta http-equiv="refresh" content="0;url={html.escape(location)}">'
+        '</head><body></body></html>'
+    ).encode('utf-8')
+    return _respond(start_response, '200 OK', body, [
+        ('Content-Type', 'text/html; charset=utf-8'),
+        # 同一個網址對一般訪客是轉址，不能讓共用快取存下預覽頁
+        ('Cache-Control', 'private, max-age=300'),
+        ('Vary', 'User-Agent')
+    ])
+
+
+def client_ip(environ) -> str:
+    """訪客 IP：與 Flask 的 ProxyFix 相同，取 X-Forwarded-For 從右邊數來第 PROXY_FIX_HOPS 個值"""
+    if PROXY_FIX_HOPS:
+        forwarded = [value.strip() for value in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if value.strip()]
+        if len(forwarded) >= PROXY_FIX_HOPS:
+            return forwarded[-PROXY_FIX_HOPS]
+    return environ.get('REMOTE_ADDR')
+
+
+def _request_path(environ) -> str:
+    """PATH_INFO 依 PEP 3333 是以 latin-1 解碼的位元組，轉回 UTF-8 字串"""
+    path = environ.get('PATH_INFO') or '/'
+    try:
+        return path.encode('latin-1').decode('utf-8', 'replace')
+    except UnicodeEncodeError:
+        return path
+
+
+def application(environ, start_response):
+    path = _request_path(environ)
+    # 路徑會放進 Location 與預覽頁，解碼後帶有換行等控制字元的請求直接拒絕（避免 header injection）
+    if CONTROL_CHARACTERS.search(path):
+        return _respond(start_response, '400 Bad Request', b'Bad Request', [('Content-Type', 'text/plain')])
+    if path == '/health':
+        stats = redirect_map.stats()
+        body = json.dumps({'status': 'healthy' if stats else 'no_map', 'redirect_map': stats}).encode('utf-8')
+        return _respond(start_response, '200 OK' if stats else '503 Service Unavailable', body,
+                        [('Content-Type', 'application/json')])
+
+    meta = redirect_map.meta
+    default_target = meta.get('default_target')
+    if not default_target:
+        return _respond(start_response, '503 Service Unavailable', b'Redirect map not available',
+                        [('Content-Type', 'text/plain'), ('Retry-After', '5')])
+
+    # /<short_code>、/<short_code>/c/<slug>、/<short_code>/<product_path>（與 routes/redirect.py 相同）
+    short_code, _, rest = path.lstrip('/').partition('/')
+    entry, product_path = None, None
+    if rest.startswith('c/') and '/' not in rest[2:] and len(rest) > 2:
+        entry = redirect_map.lookup(campaign_key(short_code, rest[2:].lower()))
+    elif rest:
+        # 只接受商品 / 系列頁（與分享圖相同的規則），其他路徑導向代購業者的預設目標
+        pattern = meta.get('product_path_pattern')
+        product_path = rest if pattern and re.match(pattern, rest) else None
+    entry = entry or redirect_map.lookup(short_code)
+    if not entry:
+        return _respond(start_response, '302 Found', headers=[('Location', default_target)])
+
+    # 與 Werkzeug 的 redirect() 一樣把路徑百分比編碼後才放進 Location
+    target_url = f"{default_target}/{quote(product_path, safe='/%-._~')}" if product_path else entry['target']
+    user_agent = environ.get('HTTP_USER_AGENT')
+    if user_agent and re.search(meta['preview_pattern'], user_agent, re.I):
+        url = f"{meta['short_url_domain']}{path}"
+        return _link_preview(start_response, meta, entry, short_code, product_path, url,
+                             f"{target_url}?ref={entry['ref_code']}")
+
+    # 網址的 ?s= 優先於活動連結設定的來源
+    source_code = (parse_qs(environ.get('QUERY_STRING', '')).get('s') or [''])[0].lower()
+    click_id = new_click_id(meta['click_id_length'])
+    click_log.append({
+        'affiliate_id': entry['affiliate_id'],
+        'ip_address': client_ip(environ),
+        'user_agent': user_agent,
+        'referer': environ.get('HTTP_REFERER'),
+        'landed_url': target_url,
+        'source': meta['sources'].get(source_code) or entry['source'],
+        'click_id': click_id,
+        'campaign_id': entry['campaign_id'],
+        'created_at': datetime.now(timezone.utc).isoformat()
+    })
+    location = f"{target_url}?ref={entry['ref_code']}{meta['click_id_separator']}{click_id}"
+    return _respond(start_response, '302 Found', headers=[('Location', location)])
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    global PROXY_FIX_HOPS
+    parser = argparse.ArgumentParser(description='GoyouLink 獨立短網址轉址程序')
+    parser.add_argument('--host', default=os.getenv('REDIRECTOR_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('REDIRECTOR_PORT', 8080)))
+    parser.add_argument('--map', default=REDIRECT_MAP_PATH, help='對照檔路徑')
+    parser.add_argument('--log-dir', default=CLICK_LOG_DIR, help='點擊記錄目錄')
+    parser.add_argument('--proxy-hops', type=int, default=PROXY_FIX_HOPS, help='前面的反向代理層數（直接對外時為 0）')
+    args = parser.parse_args()
+
+    PROXY_FIX_HOPS = args.proxy_hops
+
+    redirect_map.path = args.map
+    click_log.directory = args.log_dir
+    stats = redirect_map.stats()
+    print(f"Redirect map {args.map}: {stats['count']} entries" if stats else f"Redirect map {args.map} not found yet")
+    with make_server(args.host, args.port, application, ThreadingWSGIServer, QuietHandler) as server:
+        print(f"Redirector listening on {args.host}:{args.port}, logging clicks to {args.log_dir}")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,23 @@
-from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, Response, abort
 from functools import wraps
+from datetime import datetime
+import csv
+import io
 from models import (
-    get_all_affiliates, get_affiliate_by_id, create_affiliate, update_affiliate,
-    get_all_orders, update_order_status,
+    get_all_affiliates, get_affiliate_by_id, create_affiliate, update_affiliate, search_affiliates,
+    get_all_orders, update_order_status, ORDER_HELD,
     get_all_payouts, create_payout,
-    get_dashboard_stats, get_affiliate_summary
+    get_payout_candidates, create_payout_run, get_payouts_by_run,
+    get_dashboard_stats, get_affiliate_summary,
+    get_commission_balance, get_ledger_entries, get_leaderboards, LEADERBOARD_WINDOWS,
+    get_click_breakdown, CLICK_DIMENSIONS,
+    get_commission_rules, create_commission_rule, update_commission_rule
 )
+from services.profiler import list_profiles, get_profile, to_collapsed, top_functions
+from services.events import sse_stream
+from services.timeseries import TIMEZONE, cached_timeseries, parse_range
+from services.commission_rules import RULE_TYPES
+from services.affiliate_import import ImportFormatError, import_affiliates, parse_rows
 from config import Config
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -59,7 +71,12 @@ def dashboard():
     """管理後台儀表板"""
     stats = get_dashboard_stats()
     recent_orders = get_all_orders(limit=10)
-    return render_template('admin/dashboard.html', stats=stats, recent_orders=recent_orders)
+    window = request.args.get('window', 7, type=int)
+    if window not in LEADERBOARD_WINDOWS:
+        window = LEADERBOARD_WINDOWS[0]
+    leaderboards = get_leaderboards().get(window, {})
+    return render_template('admin/dashboard.html', stats=stats, recent_orders=recent_orders,
+                           leaderboards=leaderboards, window=window, windows=LEADERBOARD_WINDOWS)
 
 
 # ============================================
@@ -70,9 +87,37 @@ def dashboard():
 @admin_required
 def affiliates_list():
     """代購業者列表"""
-    type_filter = request.args.get('type')
-    affiliates = get_all_affiliates(affiliate_type=type_filter)
-    return render_template('admin/affiliates.html', affiliates=affiliates, config=Config, type_filter=type_filter)
+    filters = _affiliate_filters()
+    result = search_affiliates(**_search_args(filters))
+    return render_template('admin/affiliates.html', affiliates=result['items'], result=result,
+                           filters=filters, config=Config, type_filter=filters['type'])
+
+
+def _affiliate_filters():
+    """代購業者列表的搜尋、篩選、排序參數（沒有指定的值為空字串，方便組網址）"""
+    return {
+        'q': request.args.get('q', '').strip(),
+        'status': request.args.get('status', ''),
+        'type': request.args.get('type', ''),
+        'sort': request.args.get('sort', 'created_at'),
+        'order': 'asc' if request.args.get('order') == 'asc' else 'desc'
+    }
+
+
+# 代購業者列表 API 有這些參數時才回傳分頁格式
+PAGED_LIST_ARGS = ('q', 'sort', 'order', 'page', 'per_page')
+
+
+def _search_args(filters: dict):
+    return {
+        'q': filters['q'] or None,
+        'status': filters['status'] or None,
+        'affiliate_type': filters['type'] or None,
+        'sort': filters['sort'],
+        'desc': filters['order'] == 'desc',
+        'page': request.args.get('page', 1, type=int),
+        'per_page': request.args.get('per_page', 50, type=int)
+    }
 
 
 @admin_bp.route('/affiliates/create', methods=['GET', 'POST'])
@@ -121,6 +166,27 @@ def affiliates_create():
     return render_template('admin/affiliate_form.html', config=Config)
 
 
+@admin_bp.route('/affiliates/import', methods=['GET', 'POST'])
+@admin_required
+def affiliates_import():
+    """批次匯入代購業者（CSV / JSON）"""
+    report = None
+    error = None
+    dry_run = False
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        dry_run = bool(request.form.get('dry_run'))
+        if not upload or not upload.filename:
+            error = '請選擇檔案'
+        else:
+            try:
+                report = import_affiliates(parse_rows(upload.read(), upload.filename), dry_run=dry_run)
+            except (ImportFormatError, UnicodeDecodeError) as e:
+                error = f"匯入失敗: {e}"
+    return render_template('admin/affiliate_import.html', report=report, error=error,
+                           dry_run=dry_run, config=Config)
+
+
 @admin_bp.route('/affiliates/<affiliate_id>')
 @admin_required
 def affiliates_detail(affiliate_id):
@@ -171,13 +237,22 @@ def affiliates_edit(affiliate_id):
 # 訂單管理
 # ============================================
 
+# 更新訂單狀態後顯示的訊息（?notice=）
+ORDER_NOTICES = {
+    'held': ('warning', '這筆訂單的詐騙分數達門檻，維持待確認；確認無誤後請按「確認並放行可疑訂單」'),
+    'failed': ('danger', '更新訂單狀態失敗，請稍後再試')
+}
+
+
 @admin_bp.route('/orders')
 @admin_required
 def orders_list():
     """訂單列表"""
     status_filter = request.args.get('status')
     orders = get_all_orders(status=status_filter, limit=100)
-    return render_template('admin/orders.html', orders=orders, status_filter=status_filter)
+    notice = ORDER_NOTICES.get(request.args.get('notice'))
+    return render_template('admin/orders.html', orders=orders, status_filter=status_filter, notice=notice,
+                           config=Config)
 
 
 @admin_bp.route('/orders/<order_id>/status', methods=['POST'])
@@ -186,7 +261,11 @@ def orders_update_status(order_id):
     """更新訂單狀態"""
     new_status = request.form.get('status')
     if new_status in ['pending', 'confirmed', 'paid', 'refunded', 'cancelled']:
-        update_order_status(order_id, new_status)
+        result = update_order_status(order_id, new_status, force=request.form.get('force') == '1')
+        if result == ORDER_HELD:
+            return redirect(url_for('admin.orders_list', status='pending', notice='held'))
+        if result is None:
+            return redirect(url_for('admin.orders_list', notice='failed'))
     
     return redirect(request.referrer or url_for('admin.orders_list'))
 
@@ -230,6 +309,171 @@ def payouts_create():
     return render_template('admin/payout_form.html', affiliates=affiliates, config=Config)
 
 
+@admin_bp.route('/payouts/run', methods=['GET', 'POST'])
+@admin_required
+def payouts_run():
+    """批次發放：預覽所有達到門檻的代購業者，確認後一次發放"""
+    error = None
+    if request.method == 'POST':
+        affiliate_ids = request.form.getlist('affiliate_ids')
+        if not affiliate_ids:
+            error = '請至少選擇一位代購業者'
+        else:
+            run = create_payout_run(
+                affiliate_ids,
+                payment_method=request.form.get('payment_method'),
+                note=request.form.get('note')
+            )
+            if run:
+                return redirect(url_for('admin.payouts_run_detail', run_id=run['run_id']))
+            error = '發放失敗，沒有建立任何發放記錄，請稍後再試'
+    
+    candidates = get_payout_candidates()
+    total = sum(candidate['amount'] for candidate in candidates)
+    return render_template('admin/payout_run.html', candidates=candidates, total=total,
+                           payouts=None, run_id=None, error=error, config=Config)
+
+
+@admin_bp.route('/payouts/runs/<run_id>')
+@admin_required
+def payouts_run_detail(run_id):
+    """批次發放結果"""
+    payouts = get_payouts_by_run(run_id)
+    total = sum(float(payout['amount']) for payout in payouts)
+    return render_template('admin/payout_run.html', candidates=None, total=total,
+                           payouts=payouts, run_id=run_id, config=Config)
+
+
+@admin_bp.route('/payouts/runs/<run_id>/transfers.csv')
+@admin_required
+def payouts_run_export(run_id):
+    """下載批次發放的轉帳檔（CSV）"""
+    payouts = get_payouts_by_run(run_id)
+    if not payouts:
+        abort(404)
+    
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['payout_id', 'affiliate_id', 'name', 'email', 'amount', 'currency', 'reference'])
+    for payout in payouts:
+        affiliate = payout.get('affiliates') or {}
+        writer.writerow([
+            payout['id'], payout['affiliate_id'], affiliate.get('name', ''), affiliate.get('email', ''),
+            int(float(payout['amount'])), payout.get('currency') or 'JPY', run_id
+        ])
+    
+    # 加上 BOM，Excel 開啟時才不會亂碼
+    response = Response('\ufeff' + output.getvalue(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename="{run_id}.csv"'
+    return response
+
+
+# ============================================
+# 佣金規則
+# ============================================
+
+def _rule_from_form(form):
+    """從表單取得規則欄位；欄位錯誤時拋出 ValueError"""
+    match_type = form.get('match_type')
+    if match_type not in RULE_TYPES:
+        raise ValueError('請選擇規則類型')
+    match_value = (form.get('match_value') or '').strip() or None
+    if match_type != 'all' and not match_value:
+        raise ValueError('請填寫商品 ID、系列 ID 或品牌')
+    
+    commission_rate = float(form.get('commission_rate', ''))
+    if not 0 <= commission_rate <= 100:
+        raise ValueError('佣金比例需介於 0 到 100')
+    
+    # 期間以日本時間輸入
+    period = {}
+    for field in ('starts_at', 'ends_at'):
+        value = form.get(field)
+        period[field] = datetime.fromisoformat(value).replace(tzinfo=TIMEZONE).isoformat() if value else None
+    if period['starts_at'] and period['ends_at'] and period['starts_at'] >= period['ends_at']:
+        raise ValueError('結束時間必須晚於開始時間')
+    
+    return {
+        'name': (form.get('name') or '').strip() or f"{match_type} {match_value or ''}".strip(),
+        'match_type': match_type,
+        'match_value': None if match_type == 'all' else match_value,
+        'commission_rate': commission_rate,
+        'priority': int(form.get('priority') or 0),
+        **period
+    }
+
+
+@admin_bp.route('/commission-rules', methods=['GET', 'POST'])
+@admin_required
+def commission_rules_list():
+    """佣金規則列表與新增"""
+    error = None
+    if request.method == 'POST':
+        try:
+            if create_commission_rule(**_rule_from_form(request.form)):
+                return redirect(url_for('admin.commission_rules_list'))
+            error = '建立失敗'
+        except ValueError as e:
+            error = str(e)
+    
+    rules = get_commission_rules() or []
+    return render_template('admin/commission_rules.html', rules=rules, rule_types=RULE_TYPES,
+                           error=error, config=Config)
+
+
+@admin_bp.route('/commission-rules/<int:rule_id>/status', methods=['POST'])
+@admin_required
+def commission_rules_update_status(rule_id):
+    """啟用 / 停用佣金規則"""
+    status = request.form.get('status')
+    if status in ('active', 'inactive'):
+        update_commission_rule(rule_id, status=status)
+    return redirect(url_for('admin.commission_rules_list'))
+
+
+# ============================================
+# 效能分析
+# ============================================
+
+@admin_bp.route('/profiles')
+@admin_required
+def profiles_list():
+    """效能分析記錄列表"""
+    profiles = list_profiles(limit=100)
+    return render_template('admin/profiles.html', profiles=profiles, config=Config)
+
+
+@admin_bp.route('/profiles/<profile_id>')
+@admin_required
+def profiles_detail(profile_id):
+    """效能分析詳情"""
+    profile = get_profile(profile_id)
+    if not profile:
+        return redirect(url_for('admin.profiles_list'))
+    
+    return render_template('admin/profile_detail.html', profile=profile,
+                           functions=top_functions(profile))
+
+
+@admin_bp.route('/profiles/<profile_id>/download')
+@admin_required
+def profiles_download(profile_id):
+    """下載分析結果（collapsed stack 或完整 JSON）"""
+    profile = get_profile(profile_id)
+    if not profile:
+        abort(404)
+    
+    if request.args.get('format') == 'json':
+        response = jsonify(profile)
+        filename = f"{profile_id}.json"
+    else:
+        response = Response(to_collapsed(profile), mimetype='text/plain')
+        filename = f"{profile_id}.collapsed.txt"
+    
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 # ============================================
 # API endpoints（給前端 AJAX 用）
 # ============================================
@@ -242,12 +486,69 @@ def api_stats():
     return jsonify(stats)
 
 
+@admin_bp.route('/api/timeseries')
+@admin_required
+def api_timeseries():
+    """取得全站或指定代購業者（?affiliate_id=）的時間序列統計 API"""
+    try:
+        granularity, since, until = parse_range(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    series = cached_timeseries(request.args.get('affiliate_id') or None, granularity, since, until)
+    if series is None:
+        return jsonify({'error': '無法取得統計資料'}), 500
+    return jsonify(series)
+
+
+@admin_bp.route('/api/clicks/breakdown')
+@admin_required
+def api_click_breakdown():
+    """依裝置 / 瀏覽器 / 作業系統 / 來源網站分組的點擊數 API（?dimension=&affiliate_id=&days=）"""
+    dimension = request.args.get('dimension', 'device')
+    if dimension not in CLICK_DIMENSIONS:
+        return jsonify({'error': f"dimension 必須是 {' / '.join(CLICK_DIMENSIONS)}"}), 400
+    try:
+        _, since, until = parse_range(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    rows = get_click_breakdown(request.args.get('affiliate_id') or None, dimension,
+                               since.isoformat(), until.isoformat())
+    if rows is None:
+        return jsonify({'error': '無法取得統計資料'}), 500
+    return jsonify({'dimension': dimension, 'from': since.isoformat(), 'to': until.isoformat(), 'rows': rows})
+
+
+@admin_bp.route('/api/leaderboards')
+@admin_required
+def api_leaderboards():
+    """取得最近 7 / 30 天各指標排行榜 API"""
+    return jsonify(get_leaderboards())
+
+
+@admin_bp.route('/api/stream')
+@admin_required
+def api_stream():
+    """即時事件串流（Server-Sent Events）"""
+    return Response(sse_stream(max_streams=Config.SSE_MAX_STREAMS), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @admin_bp.route('/api/affiliates')
 @admin_required
 def api_affiliates():
-    """取得代購業者列表 API"""
-    affiliates = get_all_affiliates()
-    return jsonify(affiliates)
+    """取得代購業者列表 API
+
+    沒有 q / sort / order / page / per_page 時維持原本的格式：所有代購業者的陣列（可用 status / type 篩選）；
+    有任一參數時回傳分頁結果 {'items', 'total', 'page', 'per_page', 'pages'}
+    """
+    if not any(name in request.args for name in PAGED_LIST_ARGS):
+        return jsonify(get_all_affiliates(status=request.args.get('status') or None,
+                                          affiliate_type=request.args.get('type') or None))
+    return jsonify(search_affiliates(**_search_args(_affiliate_filters())))
 
 
 @admin_bp.route('/api/affiliates/<affiliate_id>')
@@ -256,3 +557,14 @@ def api_affiliate_detail(affiliate_id):
     """取得代購業者詳情 API"""
     summary = get_affiliate_summary(affiliate_id)
     return jsonify(summary)
+
+
+@admin_bp.route('/api/affiliates/<affiliate_id>/balance')
+@admin_required
+def api_affiliate_balance(affiliate_id):
+    """取得代購業者指定時間點的佣金餘額 API（?as_of=ISO 時間）"""
+    balance = get_commission_balance(affiliate_id, as_of=request.args.get('as_of'))
+    if balance is None:
+        return jsonify({'error': '無法取得餘額'}), 500
+    balance['entries'] = get_ledger_entries(affiliate_id, limit=request.args.get('limit', 50, type=int))
+    return jsonify(balance)
@@ -1,15 +1,38 @@
-from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, make_response
 from functools import wraps
+from markupsafe import Markup
 from models import (
     get_affiliate_by_ref_code, get_affiliate_by_id, update_affiliate,
     get_orders_by_affiliate, get_payouts_by_affiliate, get_clicks_by_affiliate,
-    get_affiliate_summary, get_clicks_by_source
+    get_affiliate_summary, get_clicks_by_source, get_source_conversions,
+    get_campaign_links, create_campaign_link, update_campaign_link_status
 )
+from services.affiliate_versions import get_version, cached
+from services.assets import get_manifest
+from services.rate_limit import client_ip, rate_limited, session_value
+from services.share_images import share_image_url
+from services.timeseries import TIMEZONE, build_timeseries, parse_range
+from routes.redirect import SOURCE_CODES
 from config import Config
-import requests
+from urllib.parse import urlsplit
+from datetime import datetime
+import hashlib
+import re
 
 affiliate_bp = Blueprint('affiliate', __name__, url_prefix='/partner')
 
+# Shopify API 共用連線（保持 keep-alive，requests 第一次使用時才 import）
+_shopify_session = None
+
+
+def get_shopify_session():
+    """取得 Shopify API 用的 requests.Session"""
+    global _shopify_session
+    if _shopify_session is None:
+        import requests
+        _shopify_session = requests.Session()
+    return _shopify_session
+
 
 def affiliate_required(f):
     """代購業者登入驗證裝飾器"""
@@ -21,6 +44,34 @@ def affiliate_required(f):
     return decorated_function
 
 
+def conditional_get(f):
+    """依代購業者的資料版本產生 ETag，資料沒變就直接回 304（不查資料庫）"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        affiliate_id = session.get('affiliate_id')
+        version = get_version(affiliate_id)
+        if version is None:
+            return f(*args, **kwargs)
+        
+        # 部署新版本（模板、靜態檔變更）時 build_id 會改變，舊的 ETag 一併失效；
+        # 「最近 N 天」等相對今天的範圍過了午夜（日本時間）就不同，日期也放進 key
+        today = datetime.now(TIMEZONE).date().isoformat()
+        key = f"{get_manifest()['build_id']}:{affiliate_id}:{version}:{today}:{request.full_path}"
+        etag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+        
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return decorated_function
+
+
 def search_shopify_graphql(query, max_results=20):
     """使用 Shopify GraphQL API 搜尋商品"""
     shop_domain = Config.SHOPIFY_SHOP_DOMAIN
@@ -67,7 +118,7 @@ def search_shopify_graphql(query, max_results=20):
     """
     
     try:
-        response = requests.post(
+        response = get_shopify_session().post(
             url,
             headers=headers,
             json={
@@ -163,18 +214,22 @@ def logout():
 @affiliate_bp.route('/')
 @affiliate_bp.route('/dashboard')
 @affiliate_required
+@conditional_get
 def dashboard():
     """代購業者儀表板"""
     affiliate_id = session.get('affiliate_id')
-    summary = get_affiliate_summary(affiliate_id)
+    summary = cached(affiliate_id, 'summary', lambda: get_affiliate_summary(affiliate_id))
     
     if not summary:
         return redirect(url_for('affiliate.logout'))
     
-    recent_orders = get_orders_by_affiliate(affiliate_id, limit=5)
+    recent_orders = cached(affiliate_id, 'recent_orders', lambda: get_orders_by_affiliate(affiliate_id, limit=5))
+    stats_html = cached(affiliate_id, 'dashboard_stats_html', lambda: render_template(
+        'affiliate/_dashboard_stats.html', summary=summary, config=Config))
     
     return render_template('affiliate/dashboard.html', 
-                           summary=summary, recent_orders=recent_orders, config=Config)
+                           summary=summary, recent_orders=recent_orders, config=Config,
+                           stats_html=Markup(stats_html))
 
 
 # ============================================
@@ -250,20 +305,92 @@ def payouts():
 
 @affiliate_bp.route('/links')
 @affiliate_required
+@conditional_get
 def links():
     """推廣連結頁面"""
     affiliate_id = session.get('affiliate_id')
-    affiliate = get_affiliate_by_id(affiliate_id)
+    affiliate = cached(affiliate_id, 'affiliate', lambda: get_affiliate_by_id(affiliate_id))
     
     short_url = f"{Config.SHORT_URL_DOMAIN}/{affiliate['short_code']}"
     direct_url = f"{Config.REDIRECT_TARGET}?ref={affiliate['ref_code']}"
     
-    source_stats = get_clicks_by_source(affiliate_id)
+    source_stats_html = cached(affiliate_id, 'source_stats_html', lambda: render_template(
+        'affiliate/_source_stats.html', source_stats=get_clicks_by_source(affiliate_id),
+        conversions=get_source_conversions(affiliate_id)))
+    campaigns = cached(affiliate_id, 'campaigns', lambda: get_campaign_links(affiliate_id))
     
     return render_template('affiliate/links.html', 
                            affiliate=affiliate, short_url=short_url, 
                            direct_url=direct_url, config=Config,
-                           source_stats=source_stats)
+                           source_stats_html=Markup(source_stats_html),
+                           campaigns=campaigns, source_codes=SOURCE_CODES,
+                           qr_url=share_image_url('qr', affiliate, hashed=False),
+                           og_url=share_image_url('og', affiliate, hashed=False),
+                           campaign_error=CAMPAIGN_ERRORS.get(request.args.get('campaign_error')))
+
+
+# 活動連結的網址代碼：英數字與 -，最長 40 字
+CAMPAIGN_SLUG_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]{0,39}$')
+CAMPAIGN_PATH_PREFIXES = ('products/', 'collections/')
+CAMPAIGN_ERRORS = {
+    'name': '請填寫活動名稱',
+    'slug': '網址代碼只能使用英文小寫、數字與 -（最多 40 字）',
+    'duplicate': '這個網址代碼已經使用過',
+    'path': '導向網址需為商品或系列頁面（包含 /products/ 或 /collections/）',
+    'failed': '建立失敗，請稍後再試'
+}
+
+
+def _campaign_from_form(form):
+    """從表單取得活動連結欄位；欄位錯誤時拋出 ValueError（內容為 CAMPAIGN_ERRORS 的 key）"""
+    name = (form.get('name') or '').strip()[:100]
+    if not name:
+        raise ValueError('name')
+    slug = (form.get('slug') or '').strip().lower()
+    if not CAMPAIGN_SLUG_PATTERN.match(slug):
+        raise ValueError('slug')
+    
+    # 可貼完整商品網址或 products/xxx
+    target_path = (form.get('target_path') or '').strip()
+    if target_path:
+        target_path = urlsplit(target_path).path.strip('/')
+        if not target_path.startswith(CAMPAIGN_PATH_PREFIXES) or len(target_path) > 255:
+            raise ValueError('path')
+    
+    return {
+        'name': name,
+        'slug': slug,
+        'source': SOURCE_CODES.get(form.get('source', '').lower()),
+        'target_path': target_path or None,
+        'own_short_code': form.get('own_short_code') == '1'
+    }
+
+
+@affiliate_bp.route('/links/campaigns', methods=['POST'])
+@affiliate_required
+def create_campaign():
+    """新增活動連結"""
+    affiliate_id = session.get('affiliate_id')
+    try:
+        data = _campaign_from_form(request.form)
+        existing = get_campaign_links(affiliate_id, include_archived=True)
+        if any(campaign['slug'] == data['slug'] for campaign in existing):
+            raise ValueError('duplicate')
+        if not create_campaign_link(affiliate_id, **data):
+            raise ValueError('failed')
+    except ValueError as e:
+        return redirect(url_for('affiliate.links', campaign_error=str(e)))
+    return redirect(url_for('affiliate.links'))
+
+
+@affiliate_bp.route('/links/campaigns/<int:campaign_id>/status', methods=['POST'])
+@affiliate_required
+def update_campaign_status(campaign_id):
+    """封存 / 恢復活動連結"""
+    status = request.form.get('status')
+    if status in ('active', 'archived'):
+        update_campaign_link_status(session.get('affiliate_id'), campaign_id, status)
+    return redirect(url_for('affiliate.links'))
 
 
 # ============================================
@@ -272,6 +399,8 @@ def links():
 
 @affiliate_bp.route('/api/products/search')
 @affiliate_required
+@rate_limited(('search_ip', client_ip), ('search_affiliate', session_value('affiliate_id')),
+              json_error='搜尋太頻繁，請稍後再試')
 def api_search_products():
     """搜尋 Shopify 商品（使用 GraphQL API）"""
     query = request.args.get('q', '').strip()
@@ -300,35 +429,57 @@ def api_search_products():
 
 @affiliate_bp.route('/api/stats')
 @affiliate_required
+@conditional_get
 def api_stats():
     """取得統計數據 API"""
     affiliate_id = session.get('affiliate_id')
-    summary = get_affiliate_summary(affiliate_id)
+    summary = cached(affiliate_id, 'summary', lambda: get_affiliate_summary(affiliate_id))
     return jsonify(summary)
 
 
 @affiliate_bp.route('/api/orders')
 @affiliate_required
+@conditional_get
 def api_orders():
     """取得訂單列表 API"""
     affiliate_id = session.get('affiliate_id')
-    orders = get_orders_by_affiliate(affiliate_id, limit=50)
+    orders = cached(affiliate_id, 'orders_50', lambda: get_orders_by_affiliate(affiliate_id, limit=50))
     return jsonify(orders)
 
 
 @affiliate_bp.route('/api/clicks')
 @affiliate_required
+@conditional_get
 def api_clicks():
     """取得點擊記錄 API"""
     affiliate_id = session.get('affiliate_id')
-    clicks = get_clicks_by_affiliate(affiliate_id, limit=50)
+    clicks = cached(affiliate_id, 'clicks_50', lambda: get_clicks_by_affiliate(affiliate_id, limit=50))
     return jsonify(clicks)
 
 
 @affiliate_bp.route('/api/source-stats')
 @affiliate_required
+@conditional_get
 def api_source_stats():
     """取得各來源點擊統計 API"""
     affiliate_id = session.get('affiliate_id')
-    stats = get_clicks_by_source(affiliate_id)
+    stats = cached(affiliate_id, 'source_stats', lambda: get_clicks_by_source(affiliate_id))
     return jsonify(stats)
+
+
+@affiliate_bp.route('/api/timeseries')
+@affiliate_required
+@conditional_get
+def api_timeseries():
+    """取得每小時 / 每日的點擊、訂單、銷售額與佣金 API"""
+    affiliate_id = session.get('affiliate_id')
+    try:
+        granularity, since, until = parse_range(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    series = cached(affiliate_id, f"timeseries:{granularity}:{since.isoformat()}:{until.isoformat()}",
+                    lambda: build_timeseries(affiliate_id, granularity, since, until))
+    if series is None:
+        return jsonify({'error': '無法取得統計資料'}), 500
+    return jsonify(series)
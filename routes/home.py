@@ -1,9 +1,60 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, abort, redirect, request, send_file
+from models import get_affiliate_for_redirect
+from services.assets import IMMUTABLE_CACHE_CONTROL, asset_url, serve_home, serve_asset
+from services.rate_limit import client_ip, rate_limited
+from services.share_images import IMAGE_KINDS, get_share_image, share_image_url, valid_product_path
+from config import Config
+import re
 
 home_bp = Blueprint('home', __name__)
 
+# og.png / qr.png（固定網址）或 og.<hash>.png / qr.<hash>.png（帶內容 hash）
+SHARE_FILENAME_PATTERN = re.compile(r'^(%s)(?:\.([0-9a-f]{16}))?\.png$' % '|'.join(IMAGE_KINDS))
+
 
 @home_bp.route('/')
 def index():
-    """分潤計劃首頁"""
-    return render_template('home.html')
+    """分潤計劃首頁（預先渲染，帶 ETag）"""
+    return serve_home()
+
+
+@home_bp.route('/assets/<filename>')
+def assets(filename):
+    """帶內容 hash 的靜態檔（可永久快取）"""
+    response = serve_asset(filename)
+    if response is None:
+        abort(404)
+    return response
+
+
+@home_bp.route('/share/<short_code>/<filename>')
+@rate_limited(('share_ip', client_ip))
+def share_image(short_code, filename):
+    """代購業者的分享圖與 QR code（?p=products/xxx 為商品連結）"""
+    match = SHARE_FILENAME_PATTERN.match(filename)
+    product_path = request.args.get('p') or None
+    if not match or (product_path and not valid_product_path(product_path)):
+        abort(404)
+    kind, requested = match.groups()
+    
+    # 從共用索引取得名稱與短網址，不碰資料庫
+    affiliate = get_affiliate_for_redirect(short_code)
+    if not affiliate:
+        abort(404)
+    
+    image = get_share_image(kind, affiliate, product_path)
+    if image is None:
+        if kind == 'og':
+            return redirect(asset_url('og-image.png'))
+        abort(404)
+    digest, path = image
+    
+    # 名稱或連結改了：舊的 hash 網址轉到新圖
+    if requested and requested != digest:
+        return redirect(share_image_url(kind, affiliate, product_path))
+    
+    response = send_file(path, mimetype='image/png', etag=digest, conditional=True,
+                         max_age=Config.SHARE_IMAGE_MAX_AGE)
+    if requested:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
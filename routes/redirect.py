@@ -1,5 +1,9 @@
-from flask import Blueprint, redirect, request
-from models import get_affiliate_by_short_code, record_click
+from flask import Blueprint, make_response, redirect, render_template, request
+from models import get_affiliate_for_redirect, record_click, new_click_id, compose_ref_value
+from services.resilience import set_deadline
+from services.assets import asset_url
+from services.rate_limit import client_ip, hit, rate_limited
+from services.share_images import available, is_link_preview, share_image_url, valid_product_path
 from config import Config
 
 redirect_bp = Blueprint('redirect', __name__)
@@ -18,58 +22,101 @@ SOURCE_CODES = {
 }
 
 
-@redirect_bp.route('/<short_code>')
-def redirect_short(short_code):
-    """短網址重新導向"""
-    affiliate = get_affiliate_by_short_code(short_code)
+@redirect_bp.before_request
+def limit_db_budget():
+    """短網址只給資料庫很短的時間，資料庫變慢時也不會卡住 worker"""
+    set_deadline(Config.REDIRECT_DB_BUDGET_MS)
+
+
+def link_preview(affiliate: dict, product_path: str = None):
+    """給 LINE / Facebook 等爬蟲的預覽頁：帶代購業者專屬分享圖的 og 標籤，不記點擊"""
+    image_path = product_path if valid_product_path(product_path) else None
+    if available('og'):
+        image_url = share_image_url('og', affiliate, image_path)
+    else:
+        image_url = f"{Config.SHORT_URL_DOMAIN}{asset_url('og-image.png')}"
     
-    if not affiliate:
-        return redirect(Config.REDIRECT_TARGET)
+    target_url = f"{Config.REDIRECT_TARGET}/{product_path}" if product_path else Config.REDIRECT_TARGET
+    response = make_response(render_template(
+        'share.html',
+        title=f"{affiliate.get('name') or 'GoyouLink'} 推薦的日本好物",
+        description='日本精選商品，直送到家。',
+        url=f"{Config.SHORT_URL_DOMAIN}{request.path}",
+        image_url=image_url,
+        target_url=f"{target_url}?ref={compose_ref_value(affiliate['ref_code'])}"
+    ))
+    # 同一個網址對一般訪客是轉址，不能讓共用快取存下預覽頁
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    response.headers['Vary'] = 'User-Agent'
+    return response
+
+
+def track_and_redirect(affiliate: dict, product_path: str = None):
+    """記錄點擊並帶著推薦碼導向商店（活動連結另外記錄活動與預設來源）
+
+    超過每個短網址的點擊上限（redirect_affiliate）時仍然轉址並帶推薦碼，只是不記錄點擊，
+    爆紅的連結不會擋掉真正的顧客
+    """
+    if is_link_preview(request.headers.get('User-Agent')):
+        return link_preview(affiliate, product_path)
     
-    # 取得來源參數
+    target_url = f"{Config.REDIRECT_TARGET}/{product_path}" if product_path else Config.REDIRECT_TARGET
+    allowed, _ = hit('redirect_affiliate', affiliate['short_code'])
+    if not allowed:
+        return redirect(f"{target_url}?ref={compose_ref_value(affiliate['ref_code'])}")
+    
+    # 取得來源參數（網址的 ?s= 優先於活動連結設定的來源）
     source_code = request.args.get('s', '').lower()
-    source = SOURCE_CODES.get(source_code, None)
+    source = SOURCE_CODES.get(source_code) or affiliate.get('campaign_source')
     
-    # 記錄點擊
+    # 記錄點擊（點擊 ID 跟著 ref 一起帶到商店，用來把訂單歸因到這次點擊）
+    click_id = new_click_id()
     record_click(
         affiliate_id=affiliate['id'],
         ip_address=request.remote_addr,
         user_agent=request.headers.get('User-Agent'),
         referer=request.headers.get('Referer'),
-        landed_url=Config.REDIRECT_TARGET,
-        source=source
+        landed_url=target_url,
+        source=source,
+        click_id=click_id,
+        campaign_id=affiliate.get('campaign_id')
     )
     
     # 重新導向到目標網站，帶上推薦碼
-    target_url = f"{Config.REDIRECT_TARGET}?ref={affiliate['ref_code']}"
+    return redirect(f"{target_url}?ref={compose_ref_value(affiliate['ref_code'], click_id)}")
+
+
+@redirect_bp.route('/<short_code>')
+@rate_limited(('redirect_ip', client_ip))
+def redirect_short(short_code):
+    """短網址重新導向（也包含活動連結自己的短網址）"""
+    affiliate = get_affiliate_for_redirect(short_code)
+    
+    if not affiliate:
+        return redirect(Config.REDIRECT_TARGET)
     
-    return redirect(target_url)
+    return track_and_redirect(affiliate, affiliate.get('target_path'))
+
+
+@redirect_bp.route('/<short_code>/c/<slug>')
+@rate_limited(('redirect_ip', client_ip))
+def redirect_campaign(short_code, slug):
+    """活動連結重新導向：/<short_code>/c/<slug>"""
+    affiliate = get_affiliate_for_redirect(short_code, slug=slug.lower())
+    
+    if not affiliate:
+        return redirect(Config.REDIRECT_TARGET)
+    
+    return track_and_redirect(affiliate, affiliate.get('target_path'))
 
 
 @redirect_bp.route('/<short_code>/<path:product_path>')
+@rate_limited(('redirect_ip', client_ip))
 def redirect_product(short_code, product_path):
     """商品頁面短網址重新導向"""
-    affiliate = get_affiliate_by_short_code(short_code)
+    affiliate = get_affiliate_for_redirect(short_code)
     
     if not affiliate:
         return redirect(Config.REDIRECT_TARGET)
     
-    # 取得來源參數
-    source_code = request.args.get('s', '').lower()
-    source = SOURCE_CODES.get(source_code, None)
-    
-    # 記錄點擊
-    target_url = f"{Config.REDIRECT_TARGET}/{product_path}"
-    record_click(
-        affiliate_id=affiliate['id'],
-        ip_address=request.remote_addr,
-        user_agent=request.headers.get('User-Agent'),
-        referer=request.headers.get('Referer'),
-        landed_url=target_url,
-        source=source
-    )
-    
-    # 重新導向到商品頁面，帶上推薦碼
-    target_url = f"{Config.REDIRECT_TARGET}/{product_path}?ref={affiliate['ref_code']}"
-    
-    return redirect(target_url)
+    return track_and_redirect(affiliate, product_path)
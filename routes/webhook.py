@@ -3,12 +3,12 @@ from models import (
     get_affiliate_by_ref_code, 
     create_referral_order, 
     get_order_by_shopify_id,
-    update_order_status
+    update_order_status,
+    split_ref_value,
+    ORDER_HELD
 )
+from services.webhook_payload import OrderRecord, parse_field, parse_order, verify_signature
 from config import Config
-import hmac
-import hashlib
-import base64
 
 webhook_bp = Blueprint('webhook', __name__)
 
@@ -19,44 +19,42 @@ def verify_shopify_webhook(data, hmac_header):
         # 開發模式，跳過驗證
         return True
     
-    digest = hmac.new(
-        Config.SHOPIFY_WEBHOOK_SECRET.encode('utf-8'),
-        data,
-        hashlib.sha256
-    ).digest()
-    computed_hmac = base64.b64encode(digest).decode('utf-8')
-    
-    return hmac.compare_digest(computed_hmac, hmac_header)
+    return verify_signature(data, hmac_header, Config.SHOPIFY_WEBHOOK_SECRET)
+
+
+def read_webhook_body():
+    """讀取原始 body（只讀一次、不留在 request 快取）並驗證簽名；簽名錯誤時回傳 None"""
+    body = request.get_data(cache=False)
+    if not verify_shopify_webhook(body, request.headers.get('X-Shopify-Hmac-Sha256', '')):
+        return None
+    return body
 
 
-def extract_ref_code(order_data):
-    """從訂單中提取推薦碼"""
+def extract_ref_code(order: OrderRecord, find_affiliate=None):
+    """從訂單中提取推薦碼（find_affiliate 可替換推薦碼查詢，例如批次補登時用記憶體中的對照表）"""
+    find_affiliate = find_affiliate or get_affiliate_by_ref_code
     
     # 方法 1：從 note_attributes 中找（Cart Attributes）
-    note_attributes = order_data.get('note_attributes', [])
-    for attr in note_attributes:
-        if attr.get('name') in ['ref', 'referral_code', 'affiliate']:
-            return attr.get('value')
+    for name, value in order.note_attributes:
+        if name in ['ref', 'referral_code', 'affiliate']:
+            return value
     
     # 方法 2：從 discount_codes 中找（如果推薦碼就是折扣碼）
-    discount_codes = order_data.get('discount_codes', [])
-    for discount in discount_codes:
-        code = discount.get('code', '')
+    for code in order.discount_codes:
         # 檢查這個折扣碼是否是某個代購業者的 ref_code
-        affiliate = get_affiliate_by_ref_code(code)
+        affiliate = find_affiliate(code)
         if affiliate:
             return code
     
     # 方法 3：從 order note 中找
-    note = order_data.get('note', '')
-    if note:
+    if order.note:
         # 簡單解析，例如 "ref:alice123"
-        for part in note.split():
+        for part in order.note.split():
             if part.startswith('ref:'):
                 return part[4:]
     
     # 方法 4：從 landing_site 或 referring_site 中找 ref 參數
-    landing_site = order_data.get('landing_site', '')
+    landing_site = order.landing_site
     if landing_site and 'ref=' in landing_site:
         try:
             from urllib.parse import urlparse, parse_qs
@@ -75,17 +73,17 @@ def handle_order_create():
     """處理新訂單 Webhook"""
     
     # 驗證 Webhook
-    hmac_header = request.headers.get('X-Shopify-Hmac-Sha256', '')
-    if not verify_shopify_webhook(request.data, hmac_header):
+    body = read_webhook_body()
+    if body is None:
         return jsonify({'error': 'Invalid signature'}), 401
     
-    order_data = request.get_json()
+    order = parse_order(body)
     
-    if not order_data:
+    if not order:
         return jsonify({'error': 'No data'}), 400
     
-    # 提取推薦碼
-    ref_code = extract_ref_code(order_data)
+    # 提取推薦碼（可能帶有點擊 ID）
+    ref_code, click_id = split_ref_value(extract_ref_code(order))
     
     if not ref_code:
         # 沒有推薦碼，不是分潤訂單
@@ -101,27 +99,28 @@ def handle_order_create():
         return jsonify({'status': 'ok', 'message': 'Affiliate inactive'}), 200
     
     # 檢查訂單是否已存在
-    shopify_order_id = str(order_data.get('id'))
-    existing = get_order_by_shopify_id(shopify_order_id)
+    existing = get_order_by_shopify_id(order.id)
     
     if existing:
         return jsonify({'status': 'ok', 'message': 'Order already exists'}), 200
     
     # 建立推薦訂單記錄
-    order = create_referral_order(
+    created = create_referral_order(
         affiliate_id=affiliate['id'],
-        shopify_order_id=shopify_order_id,
-        order_number=order_data.get('name', ''),  # #1001
-        order_total=float(order_data.get('total_price', 0)),
-        currency=order_data.get('currency', 'JPY'),
-        customer_email=order_data.get('email'),
-        order_created_at=order_data.get('created_at')
+        shopify_order_id=order.id,
+        order_number=order.name,  # #1001
+        order_total=order.total_price,
+        currency=order.currency,
+        customer_email=order.email,
+        order_created_at=order.created_at,
+        click_id=click_id,
+        line_items=list(order.line_items)
     )
     
     return jsonify({
         'status': 'ok',
         'message': 'Referral order created',
-        'order_id': order['id'] if order else None
+        'order_id': created['id'] if created else None
     }), 200
 
 
@@ -129,21 +128,25 @@ def handle_order_create():
 def handle_order_fulfilled():
     """處理訂單出貨 Webhook（確認佣金）"""
     
-    hmac_header = request.headers.get('X-Shopify-Hmac-Sha256', '')
-    if not verify_shopify_webhook(request.data, hmac_header):
+    body = read_webhook_body()
+    if body is None:
         return jsonify({'error': 'Invalid signature'}), 401
     
-    order_data = request.get_json()
+    shopify_order_id = parse_field(body, 'id')
     
-    if not order_data:
+    if not shopify_order_id:
         return jsonify({'error': 'No data'}), 400
     
-    shopify_order_id = str(order_data.get('id'))
     existing = get_order_by_shopify_id(shopify_order_id)
     
     if existing and existing['status'] == 'pending':
         # 訂單已出貨，確認佣金
-        update_order_status(existing['id'], 'confirmed')
+        result = update_order_status(existing['id'], 'confirmed')
+        if result == ORDER_HELD:
+            return jsonify({'status': 'ok', 'message': 'Order held for review'}), 200
+        if result is None:
+            # 讓 Shopify 稍後重送
+            return jsonify({'error': 'Failed to confirm order'}), 500
         return jsonify({'status': 'ok', 'message': 'Order confirmed'}), 200
     
     return jsonify({'status': 'ok', 'message': 'No action needed'}), 200
@@ -153,16 +156,15 @@ def handle_order_fulfilled():
 def handle_order_cancelled():
     """處理訂單取消 Webhook"""
     
-    hmac_header = request.headers.get('X-Shopify-Hmac-Sha256', '')
-    if not verify_shopify_webhook(request.data, hmac_header):
+    body = read_webhook_body()
+    if body is None:
         return jsonify({'error': 'Invalid signature'}), 401
     
-    order_data = request.get_json()
+    shopify_order_id = parse_field(body, 'id')
     
-    if not order_data:
+    if not shopify_order_id:
         return jsonify({'error': 'No data'}), 400
     
-    shopify_order_id = str(order_data.get('id'))
     existing = get_order_by_shopify_id(shopify_order_id)
     
     if existing:
@@ -176,17 +178,16 @@ def handle_order_cancelled():
 def handle_refund_create():
     """處理退款 Webhook"""
     
-    hmac_header = request.headers.get('X-Shopify-Hmac-Sha256', '')
-    if not verify_shopify_webhook(request.data, hmac_header):
+    body = read_webhook_body()
+    if body is None:
         return jsonify({'error': 'Invalid signature'}), 401
     
-    refund_data = request.get_json()
+    # 退款資料中的 order_id
+    shopify_order_id = parse_field(body, 'order_id')
     
-    if not refund_data:
+    if not shopify_order_id:
         return jsonify({'error': 'No data'}), 400
     
-    # 退款資料中的 order_id
-    shopify_order_id = str(refund_data.get('order_id'))
     existing = get_order_by_shopify_id(shopify_order_id)
     
     if existing:
@@ -0,0 +1,177 @@
+"""
+代購業者批次匯入（CSV / JSON）
+
+流程：
+    1. 解析檔案成一列一個 dict（CSV 第一列為欄位名稱；JSON 為物件陣列）
+    2. 一次載入所有已使用的 email / ref_code / short_code（含活動連結的短網址）到記憶體
+    3. 逐列驗證；沒有 ref_code 的自動產生，short_code 一律自動產生，
+       產生時對照記憶體中的集合，保證和既有資料及同檔其他列都不重複
+    4. 通過驗證的列每 chunk_size 筆一次寫入；整批失敗時改為逐筆寫入，找出有問題的列
+回傳每一列的結果（created / error / valid），可顯示在後台或輸出成 CSV。
+"""
+import csv
+import io
+import json
+import re
+
+from config import Config
+from models import bulk_insert_affiliates, get_affiliate_codes, new_ref_code, new_short_code
+
+FIELDS = ['name', 'email', 'domain', 'ref_code', 'commission_rate', 'type',
+          'social_facebook', 'social_instagram', 'social_threads', 'social_youtube', 'social_tiktok']
+AFFILIATE_TYPES = ('affiliate', 'reseller')
+REF_CODE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{3,50}$')
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+class ImportFormatError(Exception):
+    """檔案無法解析"""
+
+
+def parse_rows(data: bytes, filename: str = ''):
+    """把上傳的檔案解析成 dict 清單"""
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise ImportFormatError(f"JSON 格式錯誤: {e}")
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ImportFormatError('JSON 必須是物件陣列')
+        return rows
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _generate(existing: set, generator):
+    code = generator()
+    while code in existing:
+        code = generator()
+    existing.add(code)
+    return code
+
+
+def validate_rows(rows: list, codes: dict):
+    """驗證並補上代碼；回傳每列的結果，通過驗證的列帶有 data（要寫入的欄位）"""
+    emails = set(codes['emails'])
+    ref_codes = set(codes['ref_codes'])
+    short_codes = set(codes['short_codes'])
+    results = []
+
+    for line, row in enumerate(rows, start=1):
+        values = {field: _clean(row.get(field)) for field in FIELDS}
+        errors = []
+
+        if not values['name']:
+            errors.append('缺少名稱')
+
+        email = values['email']
+        if email:
+            if not EMAIL_PATTERN.match(email):
+                errors.append('Email 格式錯誤')
+            elif email.lower() in emails:
+                errors.append('Email 已存在')
+
+        ref_code = values['ref_code']
+        if ref_code:
+            if not REF_CODE_PATTERN.match(ref_code):
+                errors.append('推薦碼只能包含英數字、- 與 _（3-50 字）')
+            elif ref_code in ref_codes:
+                errors.append('推薦碼已存在')
+
+        commission_rate = Config.DEFAULT_COMMISSION_RATE
+        if values['commission_rate']:
+            try:
+                commission_rate = float(values['commission_rate'])
+                if not 0 <= commission_rate <= 100:
+                    errors.append('佣金比例需介於 0 到 100')
+            except ValueError:
+                errors.append('佣金比例不是數字')
+
+        affiliate_type = values['type'] or 'affiliate'
+        if affiliate_type not in AFFILIATE_TYPES:
+            errors.append(f"類型需為 {' / '.join(AFFILIATE_TYPES)}")
+
+        result = {'row': line, 'name': values['name'], 'email': email, 'errors': errors}
+        if errors:
+            result['status'] = 'error'
+            results.append(result)
+            continue
+
+        # 通過驗證才佔用 email 與代碼，讓同檔後面重複的列被擋下
+        if email:
+            emails.add(email.lower())
+        if ref_code:
+            ref_codes.add(ref_code)
+        else:
+            ref_code = _generate(ref_codes, new_ref_code)
+
+        result['status'] = 'valid'
+        result['data'] = {
+            **{field: values[field] for field in FIELDS if field.startswith('social_')},
+            'name': values['name'],
+            'email': email,
+            'domain': values['domain'],
+            'ref_code': ref_code,
+            'short_code': _generate(short_codes, new_short_code),
+            'commission_rate': commission_rate,
+            'type': affiliate_type,
+            'status': 'active'
+        }
+        results.append(result)
+    return results
+
+
+def import_affiliates(rows: list, chunk_size: int = 500, dry_run: bool = False):
+    """驗證並寫入代購業者，回傳 {'results': [...], 'created': n, 'errors': n}"""
+    codes = get_affiliate_codes()
+    if codes is None:
+        raise ImportFormatError('無法讀取既有的代購業者資料')
+
+    results = validate_rows(rows, codes)
+    valid = [result for result in results if result['status'] == 'valid']
+
+    if not dry_run:
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            created = bulk_insert_affiliates([result['data'] for result in chunk])
+            if created is not None:
+                for result, affiliate in zip(chunk, created):
+                    result.update(status='created', id=affiliate['id'])
+                continue
+
+            # 整批失敗時逐筆重試，找出是哪幾列（例如同時有其他人建立了相同 Email）
+            for result in chunk:
+                created = bulk_insert_affiliates([result['data']])
+                if created:
+                    result.update(status='created', id=created[0]['id'])
+                else:
+                    result.update(status='error', errors=['寫入失敗（可能與既有資料重複）'])
+
+    for result in results:
+        data = result.pop('data', None) or {}
+        result['ref_code'] = data.get('ref_code')
+        result['short_code'] = data.get('short_code')
+
+    return {
+        'results': results,
+        'created': sum(1 for result in results if result['status'] == 'created'),
+        'errors': sum(1 for result in results if result['status'] == 'error')
+    }
+
+
+def report_csv(results: list) -> str:
+    """把匯入結果轉成 CSV"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['row', 'status', 'name', 'email', 'ref_code', 'short_code', 'errors'])
+    for result in results:
+        writer.writerow([result['row'], result['status'], result['name'] or '', result['email'] or '',
+                         result['ref_code'] or '', result['short_code'] or '', '; '.join(result['errors'])])
+    return output.getvalue()
@@ -0,0 +1,280 @@
+"""
+跨 worker 共用的代購業者索引（memory-mapped）
+
+由一個 refresher 程序從資料庫建好二進位索引檔，所有 gunicorn worker 以 mmap
+唯讀開啟，查詢時直接在共用的 page cache 上二分搜尋，不複製整份資料。
+活動連結（/<short_code>/c/<slug> 或活動自己的短網址）也放在同一份索引，查詢同樣不碰資料庫。
+重建時寫入暫存檔後 os.replace 原子替換，worker 在下一次查詢時發現 inode
+改變就換用新檔，所以所有 worker 會同時看到新版本。
+
+檔案格式（little-endian）：
+    header     magic(8s) version(Q) built_at(d) count(I) campaign_count(I)
+    records    count × [id(16s) ref(IH) short(IH) status(IH) name(IH) commission_rate(f)]
+    short      count × [hash(Q) record_index(I)]，依 hash 排序
+    ref        count × [hash(Q) record_index(I)]，依 hash 排序
+    campaigns  campaign_count × [hash(Q) key(IH) record_index(I) campaign_id(I) source(IH) target_path(IH)]，
+               依 hash 排序；key 為「短網址/c/slug」或活動自己的短網址
+    strings    UTF-8 字串池
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+
+from config import Config
+
+MAGIC = b'GYAIDX03'
+HEADER = struct.Struct('<8sQdII')
+RECORD = struct.Struct('<16sIHIHIHIHf')
+ENTRY = struct.Struct('<QI')
+CAMPAIGN = struct.Struct('<QIHIIIHIH')
+
+INDEX_FILENAME = 'affiliate_index.bin'
+DIRTY_FILENAME = 'affiliate_index.dirty'
+
+
+def index_path():
+    return os.path.join(Config.SHARED_DIR, INDEX_FILENAME)
+
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def campaign_key(short_code: str, slug: str) -> str:
+    """活動連結 /<short_code>/c/<slug> 在索引中的 key"""
+    return f"{short_code}/c/{slug}"
+
+
+# ============================================
+# 建立索引（refresher 程序）
+# ============================================
+
+def build_index(affiliates, path: str = None, campaigns=()):
+    """把代購業者清單與啟用中的活動連結寫成索引檔並原子替換，回傳新版本號"""
+    path = path or index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    pool = bytearray()
+    pool_offsets = {}
+
+    def add_string(value):
+        data = (value or '').encode('utf-8')
+        if data not in pool_offsets:
+            pool_offsets[data] = len(pool)
+            pool.extend(data)
+        return pool_offsets[data], len(data)
+
+    records = bytearray()
+    short_entries = []
+    ref_entries = []
+    record_indexes = {}
+    for affiliate in affiliates:
+        record_indexes[str(affiliate['id'])] = len(short_entries)
+        record_index = len(short_entries)
+        records += RECORD.pack(
+            uuid.UUID(str(affiliate['id'])).bytes,
+            *add_string(affiliate['ref_code']),
+            *add_string(affiliate['short_code']),
+            *add_string(affiliate.get('status')),
+            *add_string(affiliate.get('name')),
+            float(affiliate.get('commission_rate') or 0)
+        )
+        short_entries.append((_key_hash(affiliate['short_code']), record_index))
+        ref_entries.append((_key_hash(affiliate['ref_code']), record_index))
+
+    campaign_entries = []
+    for campaign in campaigns:
+        record_index = record_indexes.get(str(campaign['affiliate_id']))
+        if record_index is None:
+            continue
+        short_code = affiliates[record_index]['short_code']
+        keys = [campaign_key(short_code, campaign['slug'])]
+        if campaign.get('short_code'):
+            keys.append(campaign['short_code'])
+        for key in keys:
+            campaign_entries.append((
+                _key_hash(key), *add_string(key), record_index, int(campaign['id']),
+                *add_string(campaign.get('source')), *add_string(campaign.get('target_path'))
+            ))
+
+    version = time.time_ns()
+    count = len(short_entries)
+    tmp_path = f"{path}.{version}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, version, time.time(), count, len(campaign_entries)))
+        f.write(records)
+        for entries in (short_entries, ref_entries):
+            f.write(b''.join(ENTRY.pack(*entry) for entry in sorted(entries)))
+        f.write(b''.join(CAMPAIGN.pack(*entry) for entry in sorted(campaign_entries)))
+        f.write(pool)
+    os.replace(tmp_path, path)
+    return version
+
+
+def request_rebuild():
+    """通知 refresher 盡快重建（例如新增或修改代購業者之後）"""
+    try:
+        os.makedirs(Config.SHARED_DIR, exist_ok=True)
+        with open(os.path.join(Config.SHARED_DIR, DIRTY_FILENAME), 'w'):
+            pass
+    except OSError as e:
+        print(f"Error in request_rebuild: {e}")
+
+
+def consume_rebuild_request():
+    """refresher 用：有重建請求就刪除標記並回傳 True"""
+    try:
+        os.remove(os.path.join(Config.SHARED_DIR, DIRTY_FILENAME))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+# ============================================
+# 讀取索引（worker）
+# ============================================
+
+class AffiliateIndex:
+    """唯讀的索引檔對應，檔案被替換時自動換用新版本"""
+
+    def __init__(self, path: str = None):
+        self.path = path or index_path()
+        self._map = None
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return None
+        if inode == self._inode:
+            return self._map
+
+        with self._lock:
+            if inode != self._inode:
+                try:
+                    with open(self.path, 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    return None
+                if HEADER.unpack_from(mapped, 0)[0] != MAGIC:
+                    mapped.close()
+                    return None
+                # 舊的 mmap 不主動關閉，讓仍在讀取的執行緒安全結束，由 GC 回收
+                self._map, self._inode = mapped, inode
+        return self._map
+
+    @property
+    def version(self):
+        mapped = self._current()
+        return HEADER.unpack_from(mapped, 0)[1] if mapped else None
+
+    def stats(self):
+        mapped = self._current()
+        if not mapped:
+            return None
+        _, version, built_at, count, campaign_count = HEADER.unpack_from(mapped, 0)
+        return {'version': version, 'built_at': built_at, 'count': count, 'campaigns': campaign_count,
+                'bytes': len(mapped)}
+
+    @staticmethod
+    def _offsets(mapped):
+        """回傳 (代購業者筆數, 活動筆數, records、short、ref、campaigns、字串池的起始位置)"""
+        count, campaign_count = HEADER.unpack_from(mapped, 0)[3:]
+        records_offset = HEADER.size
+        short_offset = records_offset + count * RECORD.size
+        ref_offset = short_offset + count * ENTRY.size
+        campaigns_offset = ref_offset + count * ENTRY.size
+        pool_offset = campaigns_offset + campaign_count * CAMPAIGN.size
+        return count, campaign_count, records_offset, short_offset, ref_offset, campaigns_offset, pool_offset
+
+    @staticmethod
+    def _first_at_least(mapped, offset, count, size, target):
+        """二分搜尋第一個 hash >= target 的位置（每個項目開頭都是 hash(Q)）"""
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if ENTRY.unpack_from(mapped, offset + mid * size)[0] < target:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _lookup(self, key: str, section: int):
+        mapped = self._current()
+        if not key or not mapped:
+            return None
+
+        count, _, records_offset, short_offset, ref_offset, _, pool_offset = self._offsets(mapped)
+        entries_offset = ref_offset if section else short_offset
+        target = _key_hash(key)
+
+        low = self._first_at_least(mapped, entries_offset, count, ENTRY.size, target)
+        while low < count:
+            entry_hash, record_index = ENTRY.unpack_from(mapped, entries_offset + low * ENTRY.size)
+            if entry_hash != target:
+                return None
+            record = self._record(mapped, records_offset, pool_offset, record_index)
+            if record['short_code' if section == 0 else 'ref_code'] == key:
+                return record
+            low += 1
+        return None
+
+    @staticmethod
+    def _string(mapped, pool_offset, offset, length):
+        start = pool_offset + offset
+        return mapped[start:start + length].decode('utf-8')
+
+    @staticmethod
+    def _record(mapped, records_offset, pool_offset, record_index):
+        (id_bytes, ref_off, ref_len, short_off, short_len,
+         status_off, status_len, name_off, name_len, commission_rate) = RECORD.unpack_from(mapped, records_offset + record_index * RECORD.size)
+
+        string = AffiliateIndex._string
+        return {
+            'id': str(uuid.UUID(bytes=id_bytes)),
+            'ref_code': string(mapped, pool_offset, ref_off, ref_len),
+            'short_code': string(mapped, pool_offset, short_off, short_len),
+            'status': string(mapped, pool_offset, status_off, status_len),
+            'name': string(mapped, pool_offset, name_off, name_len),
+            'commission_rate': round(commission_rate, 2)
+        }
+
+    def lookup_short_code(self, short_code: str):
+        """用短網址代碼查詢；索引不存在或查無資料時回傳 None"""
+        return self._lookup(short_code, 0)
+
+    def lookup_ref_code(self, ref_code: str):
+        """用推薦碼查詢；索引不存在或查無資料時回傳 None"""
+        return self._lookup(ref_code, 1)
+
+    def lookup_campaign(self, key: str):
+        """用活動連結的 key 查詢，回傳代購業者資料加上 campaign_id、campaign_source、target_path"""
+        mapped = self._current()
+        if not key or not mapped:
+            return None
+
+        count, campaign_count, records_offset, _, _, campaigns_offset, pool_offset = self._offsets(mapped)
+        target = _key_hash(key)
+        low = self._first_at_least(mapped, campaigns_offset, campaign_count, CAMPAIGN.size, target)
+        while low < campaign_count:
+            (entry_hash, key_off, key_len, record_index, campaign_id,
+             source_off, source_len, path_off, path_len) = CAMPAIGN.unpack_from(mapped, campaigns_offset + low * CAMPAIGN.size)
+            if entry_hash != target:
+                return None
+            if self._string(mapped, pool_offset, key_off, key_len) == key:
+                record = self._record(mapped, records_offset, pool_offset, record_index)
+                record['campaign_id'] = campaign_id
+                record['campaign_source'] = self._string(mapped, pool_offset, source_off, source_len) or None
+                record['target_path'] = self._string(mapped, pool_offset, path_off, path_len) or None
+                return record
+            low += 1
+        return None
+
+
+affiliate_index = AffiliateIndex()
@@ -0,0 +1,110 @@
+"""
+代購業者資料版本戳記
+
+每次寫入某個代購業者的點擊、訂單、發放或資料時呼叫 touch()，
+把 SHARED_DIR 下共用版本檔中該代購業者的槽位更新為目前時間（奈秒）。
+讀取版本只是一次 mmap 讀取，所有 worker 看到同一份。
+
+代購業者入口用版本號產生 ETag（沒變就回 304），
+並以 (代購業者, 版本) 為 key 快取查詢結果與渲染好的區塊。
+
+槽位以 hash 分配，兩個代購業者共用槽位時只會讓快取多失效幾次，不會回傳錯誤資料。
+檔案開頭存放建立時間（epoch），重建檔案後舊的 ETag 一律失效。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+
+VERSION_FILENAME = 'affiliate_versions.bin'
+SLOT_COUNT = 65536
+SLOT = struct.Struct('<Q')
+FILE_SIZE = SLOT.size * (SLOT_COUNT + 1)
+
+_map = None
+_map_lock = threading.Lock()
+
+
+def _open():
+    global _map
+    if _map is not None:
+        return _map
+    with _map_lock:
+        if _map is None:
+            try:
+                os.makedirs(Config.SHARED_DIR, exist_ok=True)
+                fd = os.open(os.path.join(Config.SHARED_DIR, VERSION_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if os.fstat(fd).st_size < FILE_SIZE:
+                        os.ftruncate(fd, FILE_SIZE)
+                    mapped = mmap.mmap(fd, FILE_SIZE)
+                finally:
+                    os.close(fd)
+                if SLOT.unpack_from(mapped, 0)[0] == 0:
+                    SLOT.pack_into(mapped, 0, time.time_ns())
+                _map = mapped
+            except (OSError, ValueError) as e:
+                print(f"Error opening affiliate versions: {e}")
+                return None
+    return _map
+
+
+def _slot_offset(affiliate_id: str) -> int:
+    digest = hashlib.blake2b(str(affiliate_id).encode('utf-8'), digest_size=8).digest()
+    return SLOT.size * (1 + int.from_bytes(digest, 'little') % SLOT_COUNT)
+
+
+def touch(affiliate_id: str):
+    """標記代購業者的資料已變更"""
+    mapped = _open()
+    if mapped is None or not affiliate_id:
+        return
+    SLOT.pack_into(mapped, _slot_offset(affiliate_id), time.time_ns())
+
+
+def get_version(affiliate_id: str):
+    """取得代購業者目前的版本字串；共用檔無法使用時回傳 None（不快取）"""
+    mapped = _open()
+    if mapped is None or not affiliate_id:
+        return None
+    epoch = SLOT.unpack_from(mapped, 0)[0]
+    return f"{epoch:x}.{SLOT.unpack_from(mapped, _slot_offset(affiliate_id))[0]:x}"
+
+
+# ============================================
+# 依版本快取（每個 worker 一份，LRU）
+# ============================================
+
+CACHE_SIZE = 2000
+CACHE_TTL = 300  # 即使版本沒變也定期重新查詢，避免查詢失敗時的空結果一直留在快取
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cached(affiliate_id: str, name: str, producer):
+    """以 (代購業者, 版本, 名稱) 快取 producer() 的結果；結果為 None 時不快取"""
+    version = get_version(affiliate_id)
+    if version is None:
+        return producer()
+
+    key = (affiliate_id, name)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry[0] == version and time.monotonic() - entry[2] < CACHE_TTL:
+            _cache.move_to_end(key)
+            return entry[1]
+
+    value = producer()
+    if value is not None:
+        with _cache_lock:
+            _cache[key] = (version, value, time.monotonic())
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return value
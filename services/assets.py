@@ -0,0 +1,205 @@
+"""
+預先產生的首頁與靜態檔
+
+`flask --app app build-static` 會：
+    - 把 templates/home.html 預先渲染成 BUILD_DIR/home.html
+    - 把 static/ 下的檔案複製成帶內容 hash 的檔名（如 tracking.3f2a9c01b4.js）
+    - 為可壓縮的檔案預先產生 .gz（有安裝 brotli 時再加 .br）
+    - 寫出 manifest.json 記錄對照表與 build_id
+
+執行期間：首頁與 /assets/<檔名> 直接回傳記憶體中的 bytes，
+依 Accept-Encoding 選擇壓縮版本，帶 ETag 並處理 304。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+from flask import Response, render_template, request
+
+from config import Config
+
+try:
+    import brotli
+except ImportError:  # brotli 是選用套件，沒有安裝時只產生 gzip
+    brotli = None
+
+MANIFEST_FILENAME = 'manifest.json'
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.json', '.svg', '.txt', '.xml'}
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# 每種壓縮格式的副檔名（依偏好順序）
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def _write_variants(path: str, data: bytes):
+    """寫入原始檔與預先壓縮的版本（只保留真的有變小的）"""
+    with open(path, 'wb') as f:
+        f.write(data)
+    if os.path.splitext(path)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return
+
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+# ============================================
+# 建置
+# ============================================
+
+def build_static(app, out_dir: str = None):
+    """產生預先渲染的首頁與帶 hash 的靜態檔，回傳 manifest"""
+    out_dir = out_dir or Config.BUILD_DIR
+    assets_dir = os.path.join(out_dir, 'assets')
+    os.makedirs(assets_dir, exist_ok=True)
+
+    assets = {}
+    for name in sorted(os.listdir(app.static_folder)):
+        source = os.path.join(app.static_folder, name)
+        if not os.path.isfile(source):
+            continue
+        with open(source, 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        hashed_name = f"{stem}.{_content_hash(data)}{ext}"
+        _write_variants(os.path.join(assets_dir, hashed_name), data)
+        assets[name] = hashed_name
+
+    # 渲染首頁時 asset_url() 要用這次建置的檔名，而不是舊的 manifest
+    global _manifest
+    _manifest = {'build_id': None, 'assets': assets, 'pages': {}}
+    with app.test_request_context('/'):
+        home = render_template('home.html', config=Config).encode('utf-8')
+    _write_variants(os.path.join(out_dir, 'home.html'), home)
+
+    manifest = {
+        'build_id': _content_hash(json.dumps(assets, sort_keys=True).encode() + home),
+        'assets': assets,
+        'pages': {'home': _content_hash(home)}
+    }
+    tmp_path = os.path.join(out_dir, f"{MANIFEST_FILENAME}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, MANIFEST_FILENAME))
+    # 下次 asset_url() 重新讀取 BUILD_DIR 的 manifest
+    _manifest = None
+
+    # 移除舊版本的 hash 檔
+    keep = set(assets.values())
+    for name in os.listdir(assets_dir):
+        base = name[:-3] if name.endswith(('.gz', '.br')) else name
+        if base not in keep:
+            os.remove(os.path.join(assets_dir, name))
+    return manifest
+
+
+# ============================================
+# 讀取（每個 worker 在記憶體保留一份）
+# ============================================
+
+_manifest = None
+_files = {}
+_lock = threading.Lock()
+
+
+def get_manifest():
+    """讀取 manifest；尚未建置時回傳空的 manifest"""
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(os.path.join(Config.BUILD_DIR, MANIFEST_FILENAME), encoding='utf-8') as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {'build_id': None, 'assets': {}, 'pages': {}}
+    return _manifest
+
+
+def asset_url(filename: str) -> str:
+    """模板用：有建置過就回傳帶 hash 的網址，否則回傳一般 /static/ 網址"""
+    hashed = get_manifest()['assets'].get(filename)
+    return f"/assets/{hashed}" if hashed else f"/static/{filename}"
+
+
+def _load_variants(path: str):
+    """讀取檔案與各壓縮版本：{encoding 或 None: bytes}"""
+    with _lock:
+        if path in _files:
+            return _files[path]
+    variants = {}
+    try:
+        with open(path, 'rb') as f:
+            variants[None] = f.read()
+    except OSError:
+        variants = None
+    if variants:
+        for encoding, suffix in ENCODINGS:
+            if os.path.exists(path + suffix):
+                with open(path + suffix, 'rb') as f:
+                    variants[encoding] = f.read()
+    with _lock:
+        _files[path] = variants
+    return variants
+
+
+def _negotiated_response(variants: dict, etag: str, mimetype: str, cache_control: str):
+    """依 Accept-Encoding 選擇版本，並處理 If-None-Match"""
+    encoding = None
+    for candidate, _ in ENCODINGS:
+        if candidate in variants and candidate in request.accept_encodings:
+            encoding = candidate
+            break
+
+    # 不同壓縮版本各自有 ETag，避免中介快取混用
+    tagged = f"{etag}-{encoding}" if encoding else etag
+    if request.if_none_match.contains(tagged):
+        response = Response(status=304)
+    else:
+        response = Response(variants[encoding], mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(tagged)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def serve_asset(filename: str):
+    """回傳帶 hash 的靜態檔；檔案不存在時回傳 None"""
+    if filename not in set(get_manifest()['assets'].values()):
+        return None
+    variants = _load_variants(os.path.join(Config.BUILD_DIR, 'assets', filename))
+    if not variants:
+        return None
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = filename.rsplit('.', 2)[-2]
+    return _negotiated_response(variants, etag, mimetype, IMMUTABLE_CACHE_CONTROL)
+
+
+def serve_home():
+    """回傳預先渲染的首頁；沒有建置檔時渲染一次後留在記憶體"""
+    etag = get_manifest()['pages'].get('home')
+    variants = _load_variants(os.path.join(Config.BUILD_DIR, 'home.html')) if etag else None
+
+    if not variants:
+        with _lock:
+            rendered = _files.get('home:rendered')
+        if rendered is None:
+            data = render_template('home.html').encode('utf-8')
+            rendered = ({None: data, 'gzip': gzip.compress(data, mtime=0)}, _content_hash(data))
+            with _lock:
+                _files['home:rendered'] = rendered
+        variants, etag = rendered
+
+    return _negotiated_response(variants, etag, 'text/html',
+                                f"public, max-age={Config.HOME_MAX_AGE}")
@@ -0,0 +1,285 @@
+"""
+歷史訂單補登（Shopify Bulk Operation）
+
+Webhook 設定錯誤或停機期間的訂單不會被記錄。backfill 指令會：
+    1. 以 bulkOperationRunQuery 請 Shopify 匯出指定期間的訂單
+    2. 輪詢 currentBulkOperation 直到完成，取得 JSONL 下載網址
+    3. 逐行串流讀取 JSONL（不整份載入記憶體），轉成 webhook 的訂單格式，
+       用同一個 extract_ref_code 找推薦碼（代購業者對照表預先載入記憶體）；
+       商品明細是緊接在訂單後面、帶 __parentId 的行，與 Webhook 一樣依佣金規則逐項計算佣金
+    4. 每 batch_size 筆以 shopify_order_id 為唯一鍵批次寫入，已存在的訂單略過，
+       所以中斷後重新執行是安全的
+新建立的訂單若在 Shopify 上已出貨、取消或退款，會再走 update_order_status 更新狀態與佣金。
+"""
+import time
+
+from config import Config
+from services.webhook_payload import loads
+
+API_VERSION = '2024-01'
+
+BULK_ORDERS_MUTATION = '''
+mutation {
+    bulkOperationRunQuery(
+        query: """
+        {
+            orders(query: "%s") {
+                edges {
+                    node {
+                        id
+                        name
+                        createdAt
+                        email
+                        note
+                        customAttributes { key value }
+                        discountCodes
+                        totalPriceSet { shopMoney { amount currencyCode } }
+                        customerJourneySummary { lastVisit { landingPage } }
+                        cancelledAt
+                        displayFinancialStatus
+                        displayFulfillmentStatus
+                        lineItems {
+                            edges {
+                                node {
+                                    id
+                                    title
+                                    vendor
+                                    quantity
+                                    isGiftCard
+                                    product { id }
+                                    originalUnitPriceSet { shopMoney { amount } }
+                                    discountAllocations { allocatedAmountSet { shopMoney { amount } } }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        """
+    ) {
+        bulkOperation { id status }
+        userErrors { field message }
+    }
+}
+'''
+
+CURRENT_BULK_OPERATION_QUERY = '''
+{
+    currentBulkOperation {
+        id
+        status
+        errorCode
+        objectCount
+        url
+    }
+}
+'''
+
+
+class BackfillError(Exception):
+    """Shopify bulk operation 失敗"""
+
+
+def _graphql(query: str):
+    from routes.affiliate import get_shopify_session
+
+    if not Config.SHOPIFY_SHOP_DOMAIN or not Config.SHOPIFY_ACCESS_TOKEN:
+        raise BackfillError('SHOPIFY_SHOP_DOMAIN / SHOPIFY_ACCESS_TOKEN not set')
+
+    response = get_shopify_session().post(
+        f"https://{Config.SHOPIFY_SHOP_DOMAIN}/admin/api/{API_VERSION}/graphql.json",
+        headers={'X-Shopify-Access-Token': Config.SHOPIFY_ACCESS_TOKEN},
+        json={'query': query},
+        timeout=30
+    )
+    if response.status_code != 200:
+        raise BackfillError(f"GraphQL error: {response.status_code}")
+    data = response.json()
+    if 'errors' in data:
+        raise BackfillError(f"GraphQL errors: {data['errors']}")
+    return data['data']
+
+
+def start_bulk_export(since: str, until: str):
+    """開始匯出 [since, until) 期間的訂單，回傳 bulk operation ID"""
+    search = f"created_at:>='{since}' AND created_at:<'{until}'".replace('"', '\\"')
+    result = _graphql(BULK_ORDERS_MUTATION % search)['bulkOperationRunQuery']
+    if result['userErrors']:
+        raise BackfillError(f"Bulk operation rejected: {result['userErrors']}")
+    return result['bulkOperation']['id']
+
+
+def wait_for_bulk_export(poll_interval: float = 5, timeout: float = 3600, progress=None):
+    """等待目前的 bulk operation 完成，回傳 JSONL 下載網址（沒有訂單時為 None）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        operation = _graphql(CURRENT_BULK_OPERATION_QUERY)['currentBulkOperation']
+        if operation is None:
+            raise BackfillError('No bulk operation running')
+        if progress:
+            progress(operation)
+        if operation['status'] == 'COMPLETED':
+            return operation['url']
+        if operation['status'] in ('FAILED', 'CANCELED', 'EXPIRED'):
+            raise BackfillError(f"Bulk operation {operation['status']}: {operation.get('errorCode')}")
+        time.sleep(poll_interval)
+    raise BackfillError('Timed out waiting for bulk operation')
+
+
+def stream_lines(url: str):
+    """逐行下載 JSONL"""
+    from routes.affiliate import get_shopify_session
+
+    with get_shopify_session().get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield line
+
+
+def read_lines(path: str):
+    """逐行讀取先前下載的 JSONL 檔"""
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def _gid(value: str):
+    return value.rsplit('/', 1)[-1] if value else None
+
+
+def to_line_item(node: dict) -> dict:
+    """把 GraphQL 商品明細轉成 webhook（REST）的欄位格式"""
+    price = ((node.get('originalUnitPriceSet') or {}).get('shopMoney')) or {}
+    return {
+        'id': _gid(node.get('id')),
+        'product_id': _gid((node.get('product') or {}).get('id')),
+        'title': node.get('title'),
+        'vendor': node.get('vendor'),
+        'price': price.get('amount', 0),
+        'quantity': node.get('quantity') or 0,
+        'gift_card': bool(node.get('isGiftCard')),
+        'discount_allocations': [
+            {'amount': ((allocation.get('allocatedAmountSet') or {}).get('shopMoney') or {}).get('amount', 0)}
+            for allocation in node.get('discountAllocations') or []
+        ]
+    }
+
+
+def to_order_data(node: dict, line_items: list = ()) -> dict:
+    """把 GraphQL 訂單轉成 webhook（REST）的欄位格式"""
+    money = ((node.get('totalPriceSet') or {}).get('shopMoney')) or {}
+    last_visit = ((node.get('customerJourneySummary') or {}).get('lastVisit')) or {}
+    return {
+        'id': node['id'].rsplit('/', 1)[-1],
+        'name': node.get('name') or '',
+        'email': node.get('email'),
+        'note': node.get('note') or '',
+        'note_attributes': [{'name': attr['key'], 'value': attr['value']}
+                            for attr in node.get('customAttributes') or []],
+        'discount_codes': [{'code': code} for code in node.get('discountCodes') or []],
+        'landing_site': last_visit.get('landingPage') or '',
+        'total_price': money.get('amount', 0),
+        'currency': money.get('currencyCode', 'JPY'),
+        'created_at': node.get('createdAt'),
+        'line_items': list(line_items)
+    }
+
+
+def target_status(node: dict):
+    """依 Shopify 上目前的狀態決定推薦訂單應有的狀態（None 表示維持 pending）"""
+    if node.get('cancelledAt'):
+        return 'cancelled'
+    if node.get('displayFinancialStatus') == 'REFUNDED':
+        return 'refunded'
+    if node.get('displayFulfillmentStatus') == 'FULFILLED':
+        return 'confirmed'
+    return None
+
+
+def backfill_orders(lines, batch_size: int = 500, progress=None):
+    """處理 JSONL 訂單並批次寫入推薦訂單，回傳統計"""
+    from models import (ORDER_HELD, bulk_create_referral_orders, get_affiliates_for_index, split_ref_value,
+                        update_order_status)
+    from routes.webhook import extract_ref_code
+    from services.commission_rules import load_rules
+    from services.webhook_payload import order_record
+
+    affiliates = {affiliate['ref_code']: affiliate for affiliate in get_affiliates_for_index()}
+    # 補登時一次載入完整的規則（含系列展開），所有訂單共用
+    rules = load_rules()
+    if rules is None:
+        raise BackfillError('Failed to load commission rules')
+    stats = {'orders': 0, 'referral': 0, 'created': 0, 'status_updates': 0, 'held': 0}
+    batch = []
+    statuses = {}
+
+    def flush():
+        created = bulk_create_referral_orders(batch, rules=rules)
+        if created is None:
+            raise BackfillError('Failed to write referral orders')
+        stats['created'] += len(created)
+        for order in created:
+            status = statuses.get(order['shopify_order_id'])
+            if not status:
+                continue
+            result = update_order_status(order['id'], status)
+            if result == ORDER_HELD:
+                stats['held'] += 1
+            elif result:
+                stats['status_updates'] += 1
+        batch.clear()
+        statuses.clear()
+        if progress:
+            progress(stats)
+
+    def add_order(node, line_items):
+        stats['orders'] += 1
+        try:
+            order = order_record(to_order_data(node, line_items))
+        except ValueError as e:
+            print(f"Error in backfill_orders: {e}")
+            return
+        ref_code, click_id = split_ref_value(extract_ref_code(order, find_affiliate=affiliates.get))
+        affiliate = affiliates.get(ref_code) if ref_code else None
+        if not affiliate or affiliate['status'] != 'active':
+            return
+
+        stats['referral'] += 1
+        batch.append({
+            'affiliate_id': affiliate['id'],
+            'commission_rate': affiliate['commission_rate'],
+            'shopify_order_id': order.id,
+            'order_number': order.name,
+            'order_total': order.total_price,
+            'currency': order.currency,
+            'customer_email': order.email,
+            'order_created_at': order.created_at,
+            'click_id': click_id,
+            'line_items': list(order.line_items)
+        })
+        status = target_status(node)
+        if status:
+            statuses[order.id] = status
+        if len(batch) >= batch_size:
+            flush()
+
+    # 訂單的商品明細接在訂單那一行之後，讀到下一筆訂單（或檔案結尾）時才處理前一筆
+    current, line_items = None, []
+    for line in lines:
+        node = loads(line)
+        if '__parentId' in node:
+            if current is not None and node['__parentId'] == current['id']:
+                line_items.append(to_line_item(node))
+            continue
+        if current is not None:
+            add_order(current, line_items)
+        current, line_items = node, []
+    if current is not None:
+        add_order(current, line_items)
+
+    if batch:
+        flush()
+    return stats
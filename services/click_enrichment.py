@@ -0,0 +1,163 @@
+"""
+點擊維度解析（enrich-clicks）
+
+點擊只存原始的 User-Agent 與 Referer。這裡批次讀取還沒解析的點擊，
+把 User-Agent 解析成裝置 / 瀏覽器 / 作業系統、Referer 解析成來源網站，
+換成 click_dimensions 的整數 id 寫回 clicks，之後的分組統計只需要 GROUP BY id。
+
+同一個 User-Agent 會重複出現非常多次，解析結果以原始字串為鍵放在 LRU 快取；
+維度 id 對照表整份載入記憶體，只有遇到新的值才寫入資料庫。
+"""
+import re
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from models import apply_click_dimensions, ensure_click_dimensions, get_click_dimensions, get_unenriched_clicks
+
+PARSE_CACHE_SIZE = 20000
+MAX_VALUE_LENGTH = 100
+
+BOT_PATTERN = re.compile(r'bot|crawl|spider|slurp|facebookexternalhit|preview|headless', re.I)
+
+# 依序比對，第一個符合的就是結果（App 內建瀏覽器要排在一般瀏覽器前面）
+BROWSER_RULES = [
+    (re.compile(r'FBAN|FBAV|FB_IAB'), 'facebook'),
+    (re.compile(r'Instagram'), 'instagram'),
+    (re.compile(r'Barcelona'), 'threads'),
+    (re.compile(r'\bLine/', re.I), 'line'),
+    (re.compile(r'musical_ly|BytedanceWebview|TikTok'), 'tiktok'),
+    (re.compile(r'Twitter'), 'twitter'),
+    (re.compile(r'Edg(e|A|iOS)?/'), 'edge'),
+    (re.compile(r'OPR/|Opera'), 'opera'),
+    (re.compile(r'SamsungBrowser'), 'samsung'),
+    (re.compile(r'CriOS|Chrome/'), 'chrome'),
+    (re.compile(r'FxiOS|Firefox/'), 'firefox'),
+    (re.compile(r'Safari/'), 'safari'),
+]
+
+OS_RULES = [
+    (re.compile(r'iPhone|iPad|iPod'), 'ios'),
+    (re.compile(r'Android'), 'android'),
+    (re.compile(r'Windows'), 'windows'),
+    (re.compile(r'CrOS'), 'chromeos'),
+    (re.compile(r'Macintosh|Mac OS X'), 'macos'),
+    (re.compile(r'Linux'), 'linux'),
+]
+
+# 來源網站對照到平台名稱（與短網址的 ?s= 來源代碼一致），其他網站保留主機名稱
+REFERRER_PLATFORMS = {
+    'facebook.com': 'facebook',
+    'fb.com': 'facebook',
+    'fb.me': 'facebook',
+    'instagram.com': 'instagram',
+    'threads.net': 'threads',
+    'youtube.com': 'youtube',
+    'youtu.be': 'youtube',
+    'tiktok.com': 'tiktok',
+    'twitter.com': 'twitter',
+    'x.com': 'twitter',
+    't.co': 'twitter',
+    'line.me': 'line',
+    'bing.com': 'bing',
+    'yahoo.co.jp': 'yahoo',
+    'yahoo.com': 'yahoo',
+}
+HOST_PREFIXES = ('www.', 'm.', 'l.', 'lm.', 'mobile.')
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_user_agent(user_agent: str) -> tuple:
+    """回傳 (device, browser, os)"""
+    if not user_agent:
+        return 'unknown', 'unknown', 'unknown'
+    if BOT_PATTERN.search(user_agent):
+        return 'bot', 'bot', 'other'
+
+    if re.search(r'iPad|Tablet', user_agent) or ('Android' in user_agent and 'Mobile' not in user_agent):
+        device = 'tablet'
+    elif re.search(r'Mobi|iPhone|iPod|Android', user_agent):
+        device = 'mobile'
+    else:
+        device = 'desktop'
+
+    browser = next((name for pattern, name in BROWSER_RULES if pattern.search(user_agent)), 'other')
+    os_name = next((name for pattern, name in OS_RULES if pattern.search(user_agent)), 'other')
+    return device, browser, os_name
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_referer(referer: str) -> str:
+    """回傳來源平台或主機名稱；沒有 Referer 時為 direct"""
+    if not referer:
+        return 'direct'
+    try:
+        host = (urlsplit(referer).hostname or '').lower()
+    except ValueError:
+        return 'other'
+    if not host:
+        return 'other'
+
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    if host.startswith('google.') or '.google.' in host:
+        return 'google'
+    parts = host.split('.')
+    for i in range(len(parts) - 1):
+        platform = REFERRER_PLATFORMS.get('.'.join(parts[i:]))
+        if platform:
+            return platform
+    return host[:MAX_VALUE_LENGTH]
+
+
+def dimensions_for(click: dict) -> dict:
+    """一次點擊的四個維度值"""
+    device, browser, os_name = parse_user_agent(click.get('user_agent') or '')
+    return {
+        'device': device,
+        'browser': browser,
+        'os': os_name,
+        'referrer': parse_referer(click.get('referer') or '')
+    }
+
+
+def enrich_clicks(batch_size: int = 5000, max_batches: int = None, progress=None):
+    """解析所有還沒處理的點擊，回傳處理筆數"""
+    ids = get_click_dimensions()
+    if ids is None:
+        return None
+
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        clicks = get_unenriched_clicks(batch_size)
+        if clicks is None:
+            return None
+        if not clicks:
+            break
+
+        values = [dimensions_for(click) for click in clicks]
+        missing = {(kind, value) for row in values for kind, value in row.items() if (kind, value) not in ids}
+        if missing:
+            created = ensure_click_dimensions(sorted(missing))
+            if created is None:
+                return None
+            ids.update(created)
+
+        updates = [{
+            'id': click['id'],
+            'created_at': click['created_at'],
+            **{f"{kind}_id": ids[(kind, value)] for kind, value in row.items()}
+        } for click, row in zip(clicks, values)]
+        updated = apply_click_dimensions(updates)
+        if not updated:
+            return None if updated is None else total
+
+        total += updated
+        batches += 1
+        if progress:
+            progress(total)
+        if len(clicks) < batch_size:
+            break
+    return total
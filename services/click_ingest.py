@@ -0,0 +1,112 @@
+"""
+把獨立轉址程序（redirector.py）的點擊記錄檔寫入資料庫（ingest-clicks）
+
+逐檔讀取 CLICK_LOG_DIR 下的 JSON lines，每 batch_size 行呼叫一次 ingest_clicks()
+（資料庫函式，依 click_id 略過已寫入的點擊並一次累加 total_clicks），
+成功後把讀到的位置寫進同名的 .offset 檔，下次從那裡繼續；中途失敗重跑也不會重複計算。
+還在寫入的檔案只讀到最後一個完整的行；已經換小時且超過 CLOSE_GRACE_SECONDS 沒有寫入的檔案
+全部讀完後刪除。
+"""
+import json
+import os
+import time
+
+from models import ingest_clicks
+from redirector import click_log_hour
+
+CLOSE_GRACE_SECONDS = 60
+REQUIRED_FIELDS = ('affiliate_id', 'click_id', 'created_at')
+
+
+def _read_offset(offset_path: str) -> int:
+    try:
+        with open(offset_path) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_offset(offset_path: str, offset: int):
+    tmp_path = f"{offset_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(str(offset))
+    os.replace(tmp_path, offset_path)
+
+
+def parse_line(line: bytes):
+    """解析一行點擊記錄；格式不對時回傳 None"""
+    try:
+        click = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(click, dict) or not all(click.get(field) for field in REQUIRED_FIELDS):
+        return None
+    return click
+
+
+def is_closed(path: str, current_hour: str) -> bool:
+    """轉址程序已經換到下一個小時的檔案，不會再有新的點擊"""
+    hour = click_log_hour(os.path.basename(path))
+    return hour < current_hour and time.time() - os.path.getmtime(path) > CLOSE_GRACE_SECONDS
+
+
+def ingest_file(path: str, batch_size: int, stats: dict, affected: set):
+    """寫入一個點擊記錄檔，回傳是否成功"""
+    offset_path = f"{path}.offset"
+    offset = _read_offset(offset_path)
+    closed = is_closed(path, time.strftime('%Y%m%d%H', time.gmtime()))
+
+    def flush(rows, end):
+        result = ingest_clicks(rows) if rows else {'inserted': 0, 'affiliate_ids': []}
+        if result is None:
+            return False
+        stats['inserted'] += result['inserted']
+        stats['duplicates'] += len(rows) - result['inserted']
+        affected.update(result['affiliate_ids'] or [])
+        _write_offset(offset_path, end)
+        return True
+
+    rows = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            # 轉址程序還在寫的最後一行等下次再讀
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            click = parse_line(line)
+            if click is None:
+                stats['skipped'] += 1
+            else:
+                rows.append(click)
+            if len(rows) >= batch_size:
+                if not flush(rows, offset):
+                    return False
+                rows = []
+        if not flush(rows, offset):
+            return False
+
+    if closed and offset >= os.path.getsize(path):
+        os.remove(path)
+        os.remove(offset_path)
+        stats['files_done'] += 1
+    return True
+
+
+def ingest_click_logs(directory: str, batch_size: int = 1000, progress=None):
+    """寫入目錄下所有點擊記錄檔，回傳統計與受影響的代購業者；資料庫失敗時回傳 None"""
+    stats = {'files': 0, 'files_done': 0, 'inserted': 0, 'duplicates': 0, 'skipped': 0}
+    affected = set()
+    try:
+        filenames = sorted(name for name in os.listdir(directory) if click_log_hour(name))
+    except FileNotFoundError:
+        filenames = []
+
+    for filename in filenames:
+        if not ingest_file(os.path.join(directory, filename), batch_size, stats, affected):
+            return None
+        stats['files'] += 1
+        if progress:
+            progress(stats)
+    stats['affiliate_ids'] = sorted(affected)
+    return stats
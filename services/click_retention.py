@@ -0,0 +1,105 @@
+"""
+點擊資料保存期限（clicks 依日本時間月份分區）
+
+retain-clicks 指令依序：
+    1. 預先建立未來幾個月的分區，並把已經落到 clicks_default 的點擊搬到各自的月份分區
+       （共用索引的 refresher 每 PARTITION_CHECK_INTERVAL 秒也會執行這一步）
+    2. 把超過 CLICK_IP_ANONYMIZE_DAYS 天的點擊 IP 匿名化（只處理上次執行後新超過期限的點擊）
+    3. 對整個月份都在保存期限外的分區：依 id 逐頁讀出，寫成 gzip 壓縮的 JSONL
+       （先寫暫存檔，重新讀取核對筆數後才改名），再呼叫 drop_click_partition 刪除；
+       資料庫會再比對一次筆數，並在刪除前把點擊數併入 archived_click_rollups
+封存檔已存在時視為已完成匯出，直接核對筆數後刪除，所以中斷後重新執行是安全的。
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+
+from models import (anonymize_click_ips, drop_click_partition, ensure_click_partitions, get_clicks_page,
+                    list_click_partitions)
+from services.timeseries import TIMEZONE
+
+PAGE_SIZE = 5000
+MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = 3600
+
+
+class RetentionError(Exception):
+    """封存或刪除分區失敗"""
+
+
+def retention_cutoff(months: int, now: datetime = None) -> datetime:
+    """保存期限的起點（日本時間月初）；結束時間不晚於此的分區可以封存"""
+    now = (now or datetime.now(TIMEZONE)).astimezone(TIMEZONE)
+    month_index = now.year * 12 + now.month - 1 - months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=TIMEZONE)
+
+
+def expired_partitions(partitions: list, cutoff: datetime):
+    """挑出整個月份都在 cutoff 之前的分區"""
+    return [partition for partition in partitions
+            if datetime.fromisoformat(partition['range_end']) <= cutoff]
+
+
+def _count_lines(path: str) -> int:
+    with gzip.open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def archive_partition(partition: dict, archive_dir: str, page_size: int = PAGE_SIZE) -> tuple:
+    """把一個分區匯出成 gzip JSONL，回傳 (檔案路徑, 筆數)"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{partition['name']}.jsonl.gz")
+    if os.path.exists(path):
+        return path, _count_lines(path)
+
+    tmp_path = f"{path}.tmp"
+    rows = 0
+    after_id = None
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        while True:
+            page = get_clicks_page(partition['range_start'], partition['range_end'], after_id, page_size)
+            if page is None:
+                raise RetentionError(f"Failed to read {partition['name']}")
+            for click in page:
+                f.write(json.dumps(click, ensure_ascii=False, separators=(',', ':')))
+                f.write('\n')
+            rows += len(page)
+            if len(page) < page_size:
+                break
+            after_id = page[-1]['id']
+
+    if _count_lines(tmp_path) != rows:
+        os.remove(tmp_path)
+        raise RetentionError(f"Archive of {partition['name']} is incomplete")
+    os.replace(tmp_path, path)
+    return path, rows
+
+
+def run_retention(retention_months: int, anonymize_days: int, archive_dir: str,
+                  dry_run: bool = False, progress=None):
+    """執行一次保存期限處理，回傳統計"""
+    stats = {'partitions_created': 0, 'ips_anonymized': 0, 'archived': []}
+
+    if not dry_run:
+        stats['partitions_created'] = ensure_click_partitions(MONTHS_AHEAD) or 0
+        stats['ips_anonymized'] = anonymize_click_ips(anonymize_days) or 0
+
+    partitions = list_click_partitions()
+    if partitions is None:
+        raise RetentionError('Failed to list click partitions')
+
+    for partition in expired_partitions(partitions, retention_cutoff(retention_months)):
+        if dry_run:
+            stats['archived'].append({'name': partition['name'], 'rows': partition['estimated_rows'], 'path': None})
+            continue
+
+        path, rows = archive_partition(partition, archive_dir)
+        dropped = drop_click_partition(partition['name'], rows)
+        if dropped is None:
+            raise RetentionError(f"Failed to drop {partition['name']} (archive {path} has {rows} rows)")
+        stats['archived'].append({'name': partition['name'], 'rows': rows, 'path': path})
+        if progress:
+            progress(stats['archived'][-1])
+
+    return stats
@@ -0,0 +1,280 @@
+"""
+佣金規則引擎
+
+Webhook 訂單的 line_items 逐項計算佣金：每個商品明細的金額扣掉分攤到的折扣（不含運費），
+再依商品 ID、所屬系列、品牌找出優先順序最高且在生效期間內的規則；沒有符合的規則時
+使用代購業者本身的佣金比例。
+
+規則表編譯成記憶體中的對照表（商品 ID → 規則、品牌 → 規則、全站規則），
+系列規則在編譯時展開成該系列的所有商品 ID，每個清單預先依優先順序排序，
+所以每個商品明細只需要幾次 dict 查詢。
+修改規則時 notify_rules_changed() 更新 SHARED_DIR 的版本檔，各 worker 下次計算時發現
+版本變了就重新編譯；另外每 RELOAD_INTERVAL 秒也會重新編譯一次，反映系列商品的變動。
+重新編譯在背景執行緒進行，Webhook 請求一律使用目前的對照表，不會等資料庫或 Shopify；
+系列展開的商品 ID 另外快取 COLLECTION_TTL 秒，規則變更時只重新讀取規則表。
+worker 第一次需要對照表時同步編譯一次，但只使用已快取的系列，其餘的留給背景執行緒。
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from config import Config
+
+RULE_TYPES = ('product', 'collection', 'vendor', 'all')
+# 同樣優先順序時，越精確的規則優先
+SPECIFICITY = {'product': 3, 'collection': 2, 'vendor': 1, 'all': 0}
+VERSION_FILENAME = 'commission_rules.version'
+RELOAD_INTERVAL = 300
+COLLECTION_TTL = 1800
+SHOPIFY_API_VERSION = '2024-01'
+
+
+class CompiledRules:
+    """編譯好的規則對照表；每個清單的元素為 (排序鍵, 開始, 結束, 比例, 規則 ID)"""
+
+    __slots__ = ('by_product', 'by_vendor', 'global_rules', 'count')
+
+    def __init__(self, by_product: dict, by_vendor: dict, global_rules: list, count: int):
+        self.by_product = by_product
+        self.by_vendor = by_vendor
+        self.global_rules = global_rules
+        self.count = count
+
+    def match(self, product_id: str, vendor: str, at: float):
+        """回傳 at 時間點適用的規則（沒有時為 None）"""
+        best = None
+        for candidates in (self.by_product.get(product_id, ()), self.by_vendor.get(vendor, ()), self.global_rules):
+            for entry in candidates:
+                if entry[1] <= at < entry[2]:
+                    if best is None or entry[0] < best[0]:
+                        best = entry
+                    break
+        return best
+
+
+def _timestamp(value, default: float) -> float:
+    if not value:
+        return default
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+
+def compile_rules(rules: list, collection_products: dict = None) -> CompiledRules:
+    """把規則列編譯成對照表；collection_products 為 {系列 ID: [商品 ID, ...]}"""
+    collection_products = collection_products or {}
+    by_product, by_vendor, global_rules = {}, {}, []
+
+    for rule in rules:
+        match_type = rule['match_type']
+        entry = (
+            (-int(rule.get('priority') or 0), -SPECIFICITY[match_type], rule['id']),
+            _timestamp(rule.get('starts_at'), float('-inf')),
+            _timestamp(rule.get('ends_at'), float('inf')),
+            float(rule['commission_rate']),
+            rule['id']
+        )
+        value = str(rule.get('match_value') or '').strip()
+        if match_type == 'product':
+            by_product.setdefault(value, []).append(entry)
+        elif match_type == 'collection':
+            for product_id in collection_products.get(value, ()):
+                by_product.setdefault(str(product_id), []).append(entry)
+        elif match_type == 'vendor':
+            by_vendor.setdefault(value.lower(), []).append(entry)
+        else:
+            global_rules.append(entry)
+
+    for entries in (*by_product.values(), *by_vendor.values(), global_rules):
+        entries.sort()
+    return CompiledRules(by_product, by_vendor, global_rules, len(rules))
+
+
+def line_amount(line: dict) -> float:
+    """商品明細扣掉折扣後的金額（禮品卡不計佣金）"""
+    if line.get('gift_card'):
+        return 0.0
+    amount = float(line.get('price') or 0) * int(line.get('quantity') or 0)
+    allocations = line.get('discount_allocations')
+    if allocations:
+        discount = sum(float(allocation.get('amount') or 0) for allocation in allocations)
+    else:
+        discount = float(line.get('total_discount') or 0)
+    return round(max(amount - discount, 0.0), 2)
+
+
+def compute_commission(line_items: list, default_rate: float, at=None, rules: CompiledRules = None):
+    """計算訂單佣金，回傳 (佣金, 實際佣金比例, 各明細的計算)"""
+    rules = rules or get_compiled_rules()
+    at = _timestamp(at, time.time())
+
+    breakdown = []
+    total_amount = 0.0
+    total_commission = 0.0
+    for line in line_items:
+        amount = line_amount(line)
+        product_id = str(line.get('product_id') or '')
+        entry = rules.match(product_id, (line.get('vendor') or '').lower(), at) if rules else None
+        rate = entry[3] if entry else default_rate
+        commission = round(amount * rate / 100, 2)
+
+        total_amount += amount
+        total_commission += commission
+        breakdown.append({
+            'line_item_id': line.get('id'),
+            'product_id': product_id or None,
+            'title': line.get('title'),
+            'quantity': line.get('quantity'),
+            'amount': amount,
+            'rate': rate,
+            'commission': commission,
+            'rule_id': entry[4] if entry else None
+        })
+
+    total_commission = round(total_commission, 2)
+    effective_rate = round(total_commission / total_amount * 100, 2) if total_amount else default_rate
+    return total_commission, effective_rate, breakdown
+
+
+# ============================================
+# 載入與重新編譯（每個 worker 一份）
+# ============================================
+
+_compiled = None
+_compiled_version = None
+_compiled_at = 0.0
+_compile_lock = threading.Lock()
+_refreshing = False
+
+# 系列 ID → (商品 ID 清單, 取得時間)
+_collection_cache = {}
+
+
+def _version_path():
+    return os.path.join(Config.SHARED_DIR, VERSION_FILENAME)
+
+
+def _current_version():
+    try:
+        return os.stat(_version_path()).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def notify_rules_changed():
+    """通知所有 worker 規則已變更"""
+    try:
+        os.makedirs(Config.SHARED_DIR, exist_ok=True)
+        with open(_version_path(), 'w') as f:
+            f.write(str(time.time_ns()))
+    except OSError as e:
+        print(f"Error in notify_rules_changed: {e}")
+
+
+def fetch_collection_product_ids(collection_id: str):
+    """從 Shopify 取得系列內所有商品 ID；失敗時回傳 None"""
+    from routes.affiliate import get_shopify_session
+
+    if not Config.SHOPIFY_SHOP_DOMAIN or not Config.SHOPIFY_ACCESS_TOKEN:
+        return None
+
+    url = (f"https://{Config.SHOPIFY_SHOP_DOMAIN}/admin/api/{SHOPIFY_API_VERSION}"
+           f"/collections/{collection_id}/products.json")
+    params = {'fields': 'id', 'limit': 250}
+    product_ids = []
+    try:
+        while url:
+            response = get_shopify_session().get(
+                url, params=params, timeout=15,
+                headers={'X-Shopify-Access-Token': Config.SHOPIFY_ACCESS_TOKEN}
+            )
+            response.raise_for_status()
+            product_ids.extend(str(product['id']) for product in response.json().get('products', []))
+            # 下一頁的網址已包含所有參數
+            url = response.links.get('next', {}).get('url')
+            params = None
+        return product_ids
+    except Exception as e:
+        print(f"Error in fetch_collection_product_ids: {e}")
+        return None
+
+
+def collection_products(collection_id: str, fetch: bool = True) -> list:
+    """系列內的商品 ID：快取未過期時直接使用；fetch 為 False 時不呼叫 Shopify（只用快取）"""
+    cached = _collection_cache.get(collection_id)
+    if cached and (not fetch or time.monotonic() - cached[1] < COLLECTION_TTL):
+        return cached[0]
+    if not fetch:
+        return []
+
+    product_ids = fetch_collection_product_ids(collection_id)
+    if product_ids is None:
+        # 取得失敗時沿用過期的快取
+        return cached[0] if cached else None
+    _collection_cache[collection_id] = (product_ids, time.monotonic())
+    return product_ids
+
+
+def load_rules(fetch_collections: bool = True):
+    """從資料庫載入啟用中的規則並編譯；讀取失敗時回傳 None"""
+    from models import get_commission_rules
+
+    rules = get_commission_rules(active_only=True)
+    if rules is None:
+        return None
+
+    expanded = {}
+    for rule in rules:
+        if rule['match_type'] == 'collection' and rule['match_value'] not in expanded:
+            product_ids = collection_products(rule['match_value'], fetch=fetch_collections)
+            if product_ids is None:
+                print(f"Collection {rule['match_value']} could not be loaded; rule {rule['id']} skipped")
+            expanded[rule['match_value']] = product_ids or []
+    return compile_rules(rules, expanded)
+
+
+def _refresh(version):
+    global _compiled, _compiled_version, _compiled_at, _refreshing
+    try:
+        compiled = load_rules()
+        # 載入失敗時沿用舊的對照表，稍後再試
+        if compiled is not None:
+            _compiled = compiled
+            _compiled_version = version
+    except Exception as e:
+        print(f"Error refreshing commission rules: {e}")
+    finally:
+        _compiled_at = time.monotonic()
+        _refreshing = False
+
+
+def _refresh_in_background(version):
+    """同一個 worker 同時只會有一個背景重新編譯"""
+    global _refreshing
+    with _compile_lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=_refresh, args=(version,), daemon=True, name='commission-rules-refresh').start()
+
+
+def get_compiled_rules():
+    """取得目前的規則對照表；版本變更或超過 RELOAD_INTERVAL 秒時在背景重新編譯，這次先用舊的"""
+    global _compiled, _compiled_version, _compiled_at
+
+    version = _current_version()
+    if _compiled is None:
+        with _compile_lock:
+            if _compiled is None:
+                _compiled = load_rules(fetch_collections=False)
+                _compiled_version = version
+                _compiled_at = time.monotonic()
+        # 第一次編譯沒有展開未快取的系列，馬上在背景補齊
+        if _compiled is not None:
+            _refresh_in_background(version)
+        return _compiled
+
+    if version != _compiled_version or time.monotonic() - _compiled_at >= RELOAD_INTERVAL:
+        _refresh_in_background(version)
+    return _compiled
@@ -0,0 +1,85 @@
+"""
+Supabase HTTP 傳輸層包裝
+
+所有 model 函式的查詢最後都會經過 postgrest 的 httpx client，
+在這裡包一層 transport 就能統一觀察與保護每一次資料庫呼叫：
+記錄到效能分析、套用請求時間預算、經過熔斷器。
+
+postgrest client 在登入狀態改變時會被 supabase 重新建立，所以不替換既有 session 的 transport，
+而是讓 supabase 每次建立 postgrest client 時都用 InstrumentedPostgrestClient，
+由 postgrest 的 create_session() 建立帶 transport 的 httpx client。
+"""
+import time
+
+import httpx
+from postgrest import SyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
+from postgrest.utils import SyncClient
+from supabase import Client
+
+from services import profiler
+from services.resilience import db_breaker, remaining_budget, DeadlineExceeded
+
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """記錄每次資料庫呼叫，並套用時間預算與熔斷器"""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        budget = remaining_budget()
+        if budget is not None:
+            if budget <= 0:
+                raise DeadlineExceeded('database budget exhausted for this request')
+            timeout = request.extensions.get('timeout') or {}
+            request.extensions['timeout'] = {
+                key: budget if timeout.get(key) is None else min(timeout[key], budget)
+                for key in ('connect', 'read', 'write', 'pool')
+            }
+        
+        db_breaker.before_call()
+        
+        started = time.perf_counter()
+        status = None
+        try:
+            response = self._transport.handle_request(request)
+            status = response.status_code
+        except Exception:
+            db_breaker.record_failure()
+            raise
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            url = request.url
+            target = url.path + (f"?{url.query.decode()}" if url.query else '')
+            profiler.record_db_call(request.method, target, status, duration_ms)
+        
+        if status >= 500:
+            db_breaker.record_failure()
+        else:
+            db_breaker.record_success()
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+class InstrumentedPostgrestClient(SyncPostgrestClient):
+    """httpx session 使用 InstrumentedTransport 的 postgrest client"""
+
+    def create_session(self, base_url, headers, timeout):
+        return SyncClient(base_url=base_url, headers=headers, timeout=timeout,
+                          transport=InstrumentedTransport(httpx.HTTPTransport()))
+
+
+class InstrumentedClient(Client):
+    """每次（重新）建立 postgrest client 時都使用 InstrumentedPostgrestClient"""
+
+    @staticmethod
+    def _init_postgrest_client(rest_url, headers, schema, timeout=DEFAULT_POSTGREST_CLIENT_TIMEOUT):
+        return InstrumentedPostgrestClient(rest_url, headers=headers, schema=schema, timeout=timeout)
+
+
+def create_instrumented_client(supabase_url: str, supabase_key: str) -> Client:
+    """建立所有資料庫呼叫都經過 InstrumentedTransport 的 Supabase client"""
+    return InstrumentedClient(supabase_url=supabase_url, supabase_key=supabase_key)
@@ -0,0 +1,189 @@
+"""
+即時事件（給管理後台 SSE 使用）
+
+寫入端（點擊、建立訂單、訂單狀態變更）呼叫 publish()，把一行 JSON 附加到
+SHARED_DIR 下的共用事件檔，不論請求落在哪個 worker 都會寫進同一個檔案。
+
+每個 worker 只有一條 tail 執行緒讀取事件檔（唯一的上游訂閱），
+再分送給該 worker 內所有連線中的儀表板；點擊事件會在每次讀取時先合併成
+各代購業者的點擊數，避免熱門時段對每個瀏覽器推送大量小事件。
+
+gthread worker 中每條 SSE 連線都佔用一條執行緒，所以每個 worker 的連線數有上限
+（Config.SSE_MAX_STREAMS）；超過時只回傳較長的 retry 讓瀏覽器稍後重連，不佔住執行緒。
+"""
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from config import Config
+
+EVENT_LOG_FILENAME = 'events.log'
+EVENT_LOG_MAX_BYTES = 1024 * 1024
+SUBSCRIBER_QUEUE_SIZE = 200
+BUSY_RETRY_MS = 30000
+
+
+def event_log_path():
+    return os.path.join(Config.SHARED_DIR, EVENT_LOG_FILENAME)
+
+
+def publish(event_type: str, data: dict):
+    """發佈事件（失敗只記 log，不影響主要流程）"""
+    line = json.dumps({
+        'type': event_type,
+        'at': datetime.now(timezone.utc).isoformat(),
+        'data': data
+    }, ensure_ascii=False, default=str) + '\n'
+
+    path = event_log_path()
+    try:
+        os.makedirs(Config.SHARED_DIR, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            if os.fstat(fd).st_size > EVENT_LOG_MAX_BYTES:
+                _rotate(path, fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Error in publish: {e}")
+
+
+def _rotate(path: str, fd: int):
+    """檔案太大就換新檔；tail 執行緒會讀完舊檔後再切換
+
+    多個 worker 可能同時發現檔案太大：在事件檔上加 flock 後再確認 path 仍是同一個檔案，
+    已經被其他 worker 換掉的就不再 replace（否則會把剛建立的新檔蓋到 .1，舊檔與其中的事件一起消失）
+    """
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        if os.stat(path).st_ino == os.fstat(fd).st_ino:
+            os.replace(path, f"{path}.1")
+    except FileNotFoundError:
+        pass
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class EventHub:
+    """單一 tail 執行緒 + 行程內 fan-out"""
+
+    def __init__(self, poll_interval: float = 0.5):
+        self.poll_interval = poll_interval
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, max_subscribers: int = None):
+        """訂閱事件；已達 max_subscribers 條連線時回傳 None"""
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if max_subscribers is not None and len(self._subscribers) >= max_subscribers:
+                return None
+            self._subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _broadcast(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # 讀太慢的連線直接丟事件，前端重新整理即可補上
+                pass
+
+    def _dispatch(self, lines):
+        click_counts = {}
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('type') == 'click':
+                affiliate_id = event['data'].get('affiliate_id')
+                click_counts[affiliate_id] = click_counts.get(affiliate_id, 0) + 1
+            else:
+                self._broadcast(event)
+
+        if click_counts:
+            self._broadcast({
+                'type': 'clicks',
+                'at': datetime.now(timezone.utc).isoformat(),
+                'data': {'total': sum(click_counts.values()), 'by_affiliate': click_counts}
+            })
+
+    def _open_log(self, seek_end: bool):
+        path = event_log_path()
+        os.makedirs(Config.SHARED_DIR, exist_ok=True)
+        f = open(path, 'a+', encoding='utf-8')
+        f.seek(0, os.SEEK_END if seek_end else os.SEEK_SET)
+        return f, os.fstat(f.fileno()).st_ino
+
+    def _run(self):
+        f, inode = self._open_log(seek_end=True)
+        pending = ''
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    f.close()
+                    return
+
+            chunk = f.read()
+            if chunk:
+                pending += chunk
+                *lines, pending = pending.split('\n')
+                self._dispatch(lines)
+            else:
+                try:
+                    rotated = os.stat(event_log_path()).st_ino != inode
+                except OSError:
+                    rotated = True
+                if rotated:
+                    f.close()
+                    f, inode = self._open_log(seek_end=False)
+                    pending = ''
+                    continue
+
+            time.sleep(self.poll_interval)
+
+
+event_hub = EventHub()
+
+
+def sse_stream(max_seconds: float = 300, keepalive: float = 15, max_streams: int = None):
+    """產生 text/event-stream 內容；連線最長 max_seconds 秒後結束，由瀏覽器自動重連"""
+    subscriber = event_hub.subscribe(max_streams)
+    if subscriber is None:
+        # 這個 worker 的 SSE 連線已滿，請瀏覽器晚一點再連
+        yield f"retry: {BUSY_RETRY_MS}\n\n"
+        return
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            try:
+                event = subscriber.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            payload = json.dumps(event, ensure_ascii=False, default=str)
+            yield f"event: {event['type']}\ndata: {payload}\n\n"
+    finally:
+        event_hub.unsubscribe(subscriber)
@@ -0,0 +1,148 @@
+"""
+自我推薦與點擊灌水偵測（score-fraud）
+
+1. 依 id 逐頁讀取回溯期間的點擊（只取需要的欄位），以
+   (代購業者, IP, User-Agent 雜湊, 時段) 為鍵在記憶體中計數，
+   達到門檻的鍵就是點擊暴增，寫入 click_bursts 供後台檢視
+2. 所有代購業者的 Email 正規化後放進 dict（Email → 代購業者）
+3. 逐批讀取尚未評分的待確認訂單：
+   - 顧客 Email 是自己的 → self_referral
+   - 顧客 Email 是其他代購業者的 → affiliate_customer
+   - 訂單帶來的點擊落在暴增的鍵裡 → click_burst
+   分數批次寫回訂單；update_order_status 確認前會讀取分數，達門檻的訂單維持待確認。
+"""
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from config import Config
+from models import (apply_fraud_scores, fraud_score, get_affiliate_emails, get_clicks_by_click_ids,
+                    get_clicks_page, get_unscored_orders, normalize_email, save_click_bursts)
+
+PAGE_SIZE = 10000
+CLICK_COLUMNS = 'id, affiliate_id, ip_address, user_agent, created_at'
+
+
+@lru_cache(maxsize=20000)
+def ua_hash(user_agent: str) -> str:
+    """User-Agent 的短雜湊（同一個字串大量重複，結果快取起來）"""
+    return hashlib.blake2b((user_agent or '').encode('utf-8'), digest_size=8).hexdigest()
+
+
+def burst_key(click: dict, window_seconds: int) -> tuple:
+    """點擊所屬的 (代購業者, IP, User-Agent 雜湊, 時段)"""
+    bucket = int(datetime.fromisoformat(click['created_at']).timestamp() // window_seconds)
+    return click['affiliate_id'], click.get('ip_address') or '', ua_hash(click.get('user_agent') or ''), bucket
+
+
+def detect_click_bursts(lookback_days: int, window_minutes: int, min_clicks: int,
+                        page_size: int = PAGE_SIZE, progress=None):
+    """掃描回溯期間的點擊，回傳 {burst_key: 點擊數}（只包含達到門檻的鍵）"""
+    window_seconds = window_minutes * 60
+    until = datetime.now(timezone.utc)
+    since = (until - timedelta(days=lookback_days)).isoformat()
+    until = until.isoformat()
+
+    counts = Counter()
+    scanned = 0
+    after_id = None
+    while True:
+        page = get_clicks_page(since, until, after_id, page_size, columns=CLICK_COLUMNS)
+        if page is None:
+            return None
+        for click in page:
+            if click.get('affiliate_id'):
+                counts[burst_key(click, window_seconds)] += 1
+        scanned += len(page)
+        if progress:
+            progress(scanned)
+        if len(page) < page_size:
+            break
+        after_id = page[-1]['id']
+
+    return {key: count for key, count in counts.items() if count >= min_clicks}
+
+
+def burst_rows(bursts: dict, window_minutes: int) -> list:
+    """把暴增的鍵轉成 click_bursts 的資料列"""
+    window_seconds = window_minutes * 60
+    return [{
+        'affiliate_id': affiliate_id,
+        'ip_address': ip_address,
+        'ua_hash': ua,
+        'window_start': datetime.fromtimestamp(bucket * window_seconds, timezone.utc).isoformat(),
+        'clicks': count
+    } for (affiliate_id, ip_address, ua, bucket), count in bursts.items()]
+
+
+def order_reasons(order: dict, emails: dict, bursts: dict, clicks: dict, window_seconds: int) -> list:
+    """一筆訂單的可疑原因"""
+    reasons = []
+    owner = emails.get(normalize_email(order.get('customer_email')))
+    if owner == order['affiliate_id']:
+        reasons.append('self_referral')
+    elif owner:
+        reasons.append('affiliate_customer')
+
+    click = clicks.get(order.get('click_id'))
+    if click and click.get('affiliate_id') == order['affiliate_id'] and burst_key(click, window_seconds) in bursts:
+        reasons.append('click_burst')
+    return reasons
+
+
+def score_orders(bursts: dict, window_minutes: int, batch_size: int = 1000):
+    """為尚未評分的待確認訂單評分，回傳 {'scored': n, 'flagged': n}"""
+    window_seconds = window_minutes * 60
+    affiliates = get_affiliate_emails()
+    if affiliates is None:
+        return None
+    emails = {}
+    for affiliate in affiliates:
+        email = normalize_email(affiliate['email'])
+        if email:
+            emails.setdefault(email, affiliate['id'])
+
+    stats = {'scored': 0, 'flagged': 0}
+    while True:
+        orders = get_unscored_orders(batch_size)
+        if orders is None:
+            return None
+        if not orders:
+            break
+
+        click_ids = list({order['click_id'] for order in orders if order.get('click_id')})
+        clicks = get_clicks_by_click_ids(click_ids, columns=f"click_id, {CLICK_COLUMNS}")
+        if clicks is None:
+            return None
+        clicks = {click['click_id']: click for click in clicks}
+
+        scores = []
+        for order in orders:
+            reasons = order_reasons(order, emails, bursts, clicks, window_seconds)
+            score = fraud_score(reasons)
+            scores.append({'id': order['id'], 'fraud_score': score, 'fraud_reasons': reasons})
+            if score >= Config.FRAUD_HOLD_SCORE:
+                stats['flagged'] += 1
+
+        updated = apply_fraud_scores(scores)
+        if not updated:
+            return None if updated is None else stats
+        stats['scored'] += updated
+        if len(orders) < batch_size:
+            break
+    return stats
+
+
+def run_fraud_scoring(lookback_days: int, window_minutes: int, min_clicks: int,
+                      batch_size: int = 1000, progress=None):
+    """偵測點擊暴增並為待確認訂單評分，回傳統計"""
+    bursts = detect_click_bursts(lookback_days, window_minutes, min_clicks, progress=progress)
+    if bursts is None or save_click_bursts(burst_rows(bursts, window_minutes)) is None:
+        return None
+
+    stats = score_orders(bursts, window_minutes, batch_size)
+    if stats is None:
+        return None
+    stats['bursts'] = len(bursts)
+    return stats
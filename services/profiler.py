@@ -0,0 +1,254 @@
+"""
+取樣式效能分析器（Sampling Profiler）
+
+- 管理員在請求加上 `X-Profile: 1` 標頭或 `?__profile=1` 參數時，強制分析該次請求
+- 設定 PROFILE_SLOW_MS 後，超過門檻的請求會自動保存分析結果
+- 每個 worker 只有一條取樣執行緒，定期讀取被追蹤請求的 call stack，
+  彙整成 collapsed stack 格式（可直接丟給 flamegraph.pl / speedscope）
+- 分析結果與該次請求的資料庫呼叫清單以 JSON 存在 PROFILE_DIR，所有 worker 共用
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request, session
+from config import Config
+
+# 不分析的 endpoint（靜態檔與分析結果頁本身）
+SKIP_ENDPOINTS = {'static', 'admin.profiles_list', 'admin.profiles_detail', 'admin.profiles_download'}
+
+MAX_STACK_DEPTH = 128
+MAX_DB_CALLS = 500
+
+_project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ============================================
+# 取樣執行緒
+# ============================================
+
+class _Sampler:
+    """定期對已登記的執行緒取樣 call stack"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, thread_id: int) -> Counter:
+        stacks = Counter()
+        with self._lock:
+            self._targets[thread_id] = stacks
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._thread.start()
+        return stacks
+
+    def unregister(self, thread_id: int):
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._targets:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_collapse(frame)] += 1
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(_project_root):
+        filename = os.path.relpath(filename, _project_root)
+    elif 'site-packages' in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _collapse(frame):
+    """把 frame 轉成 root;...;leaf 格式"""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+_sampler = _Sampler(Config.PROFILE_INTERVAL_MS / 1000)
+
+
+# ============================================
+# Flask 掛鉤
+# ============================================
+
+def _profile_forced():
+    if not session.get('admin_logged_in'):
+        return False
+    return request.headers.get('X-Profile') == '1' or request.args.get('__profile') == '1'
+
+
+def _start_profile():
+    if request.endpoint in SKIP_ENDPOINTS:
+        return
+    forced = _profile_forced()
+    if not forced and Config.PROFILE_SLOW_MS <= 0:
+        return
+    g.profile = {
+        'forced': forced,
+        'started': time.perf_counter(),
+        'thread_id': threading.get_ident(),
+        'stacks': _sampler.register(threading.get_ident()),
+        'db_calls': []
+    }
+
+
+def _finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    _sampler.unregister(profile['thread_id'])
+
+    duration_ms = (time.perf_counter() - profile['started']) * 1000
+    if not profile['forced'] and duration_ms < Config.PROFILE_SLOW_MS:
+        return response
+
+    profile_id = save_profile({
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 1),
+        'forced': profile['forced'],
+        'interval_ms': Config.PROFILE_INTERVAL_MS,
+        'stacks': dict(profile['stacks']),
+        'db_calls': profile['db_calls']
+    })
+    if profile_id and profile['forced']:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _teardown_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _sampler.unregister(profile['thread_id'])
+
+
+def init_profiler(app):
+    """註冊請求前後的分析掛鉤"""
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_teardown_profile)
+
+
+def record_db_call(method: str, url: str, status: int, duration_ms: float):
+    """記錄一次資料庫呼叫（只在當前請求正在分析時）"""
+    if not has_request_context():
+        return
+    profile = g.get('profile')
+    if profile is None or len(profile['db_calls']) >= MAX_DB_CALLS:
+        return
+    profile['db_calls'].append({
+        'method': method,
+        'url': url,
+        'status': status,
+        'offset_ms': round((time.perf_counter() - profile['started']) * 1000 - duration_ms, 1),
+        'duration_ms': round(duration_ms, 1)
+    })
+
+
+# ============================================
+# 儲存與讀取
+# ============================================
+
+def save_profile(data: dict):
+    """寫入分析結果，並只保留最新 PROFILE_KEEP 筆"""
+    now = datetime.now(timezone.utc)
+    profile_id = f"{now.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    data = {'id': profile_id, 'created_at': now.isoformat(), **data}
+    data['samples'] = sum(data['stacks'].values())
+
+    try:
+        os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(Config.PROFILE_DIR, f"{profile_id}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        names = sorted(n for n in os.listdir(Config.PROFILE_DIR) if n.endswith('.json'))
+        for name in names[:-Config.PROFILE_KEEP]:
+            os.remove(os.path.join(Config.PROFILE_DIR, name))
+        return profile_id
+    except OSError as e:
+        print(f"Error in save_profile: {e}")
+        return None
+
+
+def list_profiles(limit: int = 100):
+    """取得最近的分析結果摘要（不含 stack）"""
+    try:
+        names = sorted((n for n in os.listdir(Config.PROFILE_DIR) if n.endswith('.json')), reverse=True)
+    except OSError:
+        return []
+
+    profiles = []
+    for name in names[:limit]:
+        profile = get_profile(name[:-5])
+        if profile:
+            profile['db_call_count'] = len(profile.pop('db_calls', []))
+            profile.pop('stacks', None)
+            profiles.append(profile)
+    return profiles
+
+
+def get_profile(profile_id: str):
+    """讀取單筆分析結果"""
+    if not profile_id or os.sep in profile_id or profile_id.startswith('.'):
+        return None
+    try:
+        with open(os.path.join(Config.PROFILE_DIR, f"{profile_id}.json"), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def to_collapsed(profile: dict) -> str:
+    """輸出 collapsed stack 文字（每行 `stack count`）"""
+    stacks = sorted(profile.get('stacks', {}).items(), key=lambda item: item[1], reverse=True)
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+
+def top_functions(profile: dict, limit: int = 30):
+    """統計每個函式出現在最上層（self）與整條 stack（total）的取樣數"""
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in profile.get('stacks', {}).items():
+        frames = stack.split(';')
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+
+    samples = profile.get('samples') or 1
+    return [
+        {
+            'frame': frame,
+            'total': total,
+            'total_pct': round(total * 100 / samples, 1),
+            'self': self_counts.get(frame, 0),
+            'self_pct': round(self_counts.get(frame, 0) * 100 / samples, 1)
+        }
+        for frame, total in total_counts.most_common(limit)
+    ]
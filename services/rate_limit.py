@@ -0,0 +1,208 @@
+"""
+跨 worker 共用的 token bucket 限流
+
+短網址、商品搜尋與分享圖在查資料庫、呼叫 Shopify 或繪圖之前先檢查限流，超過就直接回 429，
+不做任何 I/O。各 worker 共用 SHARED_DIR 下的一個 mmap 檔：
+
+    header    magic(8s)
+    counters  每個限流器 [allowed(Q) rejected(Q)]
+    slots     SLOT_COUNT × [key_hash(Q) tokens(d) updated_at(d)]
+
+key（限流器名稱 + IP 或代購業者）以 hash 分配槽位；槽位被其他 key 佔用時直接重設成滿的桶，
+最壞情況只是讓某個 key 多放行幾次，不會誤擋。讀改寫以 fcntl 檔案鎖（跨程序）
+加 threading.Lock（同一程序的多條執行緒）保護，每次檢查只是一次加鎖與幾十 bytes 的讀寫。
+共用檔無法使用時一律放行。
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import wraps
+
+from flask import Response, jsonify, request, session
+
+from config import Config
+
+LIMITS_FILENAME = 'rate_limits.bin'
+MAGIC = b'GYRATE01'
+SLOT_COUNT = 65536
+COUNTER = struct.Struct('<QQ')
+SLOT = struct.Struct('<Qdd')
+
+# 限流器名稱 → 設定（「次數/秒數」，例如 120/60 表示每 60 秒 120 次，可瞬間用完）
+LIMITERS = {
+    'redirect_ip': Config.RATE_LIMIT_REDIRECT_IP,
+    'redirect_affiliate': Config.RATE_LIMIT_REDIRECT_AFFILIATE,
+    'search_ip': Config.RATE_LIMIT_SEARCH_IP,
+    'search_affiliate': Config.RATE_LIMIT_SEARCH_AFFILIATE,
+    'share_ip': Config.RATE_LIMIT_SHARE_IP,
+}
+COUNTER_OFFSETS = {name: len(MAGIC) + COUNTER.size * i for i, name in enumerate(LIMITERS)}
+SLOTS_OFFSET = len(MAGIC) + COUNTER.size * len(LIMITERS)
+FILE_SIZE = SLOTS_OFFSET + SLOT.size * SLOT_COUNT
+
+
+def parse_limit(value: str) -> tuple:
+    """'120/60' → (容量 120, 每秒補充 2.0)"""
+    count, _, seconds = value.partition('/')
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+_limits = {name: parse_limit(value) for name, value in LIMITERS.items()}
+
+_map = None
+_fd = None
+_open_lock = threading.Lock()
+_lock = threading.Lock()
+
+
+def _new_file(path: str) -> str:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, FILE_SIZE)
+        os.pwrite(fd, MAGIC, 0)
+    finally:
+        os.close(fd)
+    return tmp_path
+
+
+def _open():
+    global _map, _fd
+    if _map is not None:
+        return _map
+    with _open_lock:
+        if _map is None:
+            try:
+                os.makedirs(Config.SHARED_DIR, exist_ok=True)
+                path = os.path.join(Config.SHARED_DIR, LIMITS_FILENAME)
+                for _ in range(3):
+                    try:
+                        fd = os.open(path, os.O_RDWR)
+                    except FileNotFoundError:
+                        # 以 link 建立，多個 worker 同時啟動時只有一個會成功，其他人開啟同一份
+                        tmp_path = _new_file(path)
+                        try:
+                            os.link(tmp_path, path)
+                        except FileExistsError:
+                            pass
+                        finally:
+                            os.remove(tmp_path)
+                        continue
+                    if os.fstat(fd).st_size == FILE_SIZE and os.pread(fd, len(MAGIC), 0) == MAGIC:
+                        _map = mmap.mmap(fd, FILE_SIZE)
+                        _fd = fd
+                        break
+                    # 格式不同（例如限流器數量改變）時換成新檔；仍在使用舊檔的 worker 不受影響
+                    os.close(fd)
+                    os.replace(_new_file(path), path)
+            except (OSError, ValueError) as e:
+                print(f"Error opening rate limits: {e}")
+                return None
+    return _map
+
+
+def _slot_offset(key_hash: int) -> int:
+    return SLOTS_OFFSET + SLOT.size * (key_hash % SLOT_COUNT)
+
+
+def hit(name: str, key: str):
+    """消耗一個 token，回傳 (是否放行, 建議的重試秒數)"""
+    if not Config.RATE_LIMIT_ENABLED or not key:
+        return True, 0
+    mapped = _open()
+    if mapped is None:
+        return True, 0
+
+    capacity, rate = _limits[name]
+    key_hash = int.from_bytes(hashlib.blake2b(f"{name}:{key}".encode('utf-8'), digest_size=8).digest(), 'little')
+    offset = _slot_offset(key_hash)
+    counter_offset = COUNTER_OFFSETS[name]
+    now = time.time()
+
+    with _lock:
+        fcntl.lockf(_fd, fcntl.LOCK_EX)
+        try:
+            stored_hash, tokens, updated_at = SLOT.unpack_from(mapped, offset)
+            if stored_hash != key_hash:
+                tokens, updated_at = capacity, now
+            tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            SLOT.pack_into(mapped, offset, key_hash, tokens, now)
+
+            allowed_count, rejected_count = COUNTER.unpack_from(mapped, counter_offset)
+            if allowed:
+                allowed_count += 1
+            else:
+                rejected_count += 1
+            COUNTER.pack_into(mapped, counter_offset, allowed_count, rejected_count)
+        finally:
+            fcntl.lockf(_fd, fcntl.LOCK_UN)
+
+    return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+def counters():
+    """所有 worker 合計的放行 / 拒絕次數"""
+    mapped = _open()
+    result = {}
+    for name, offset in COUNTER_OFFSETS.items():
+        allowed, rejected = COUNTER.unpack_from(mapped, offset) if mapped is not None else (0, 0)
+        result[name] = {'allowed': allowed, 'rejected': rejected}
+    return result
+
+
+def prometheus_metrics() -> str:
+    """Prometheus 文字格式的限流計數"""
+    lines = [
+        '# HELP goyoulink_rate_limit_requests_total Requests checked by each rate limiter.',
+        '# TYPE goyoulink_rate_limit_requests_total counter'
+    ]
+    for name, counts in counters().items():
+        for result, value in counts.items():
+            lines.append(f'goyoulink_rate_limit_requests_total{{limiter="{name}",result="{result}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================
+# 路由裝飾器
+# ============================================
+
+def client_ip():
+    """訪客 IP（app.py 以 ProxyFix 依 PROXY_FIX_HOPS 從 X-Forwarded-For 取得，不是反向代理的 IP）"""
+    return request.remote_addr
+
+
+def view_arg(name: str):
+    return lambda: (request.view_args or {}).get(name)
+
+
+def session_value(name: str):
+    return lambda: session.get(name)
+
+
+def rate_limited(*checks, json_error: str = None):
+    """依序檢查 (限流器名稱, 取得 key 的函式)，任一個超過就回 429
+
+    json_error 有值時以 JSON 回應（給前端 AJAX 用），否則回純文字
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            for name, key_func in checks:
+                allowed, retry_after = hit(name, key_func())
+                if not allowed:
+                    headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+                    if json_error:
+                        return jsonify({'error': json_error}), 429, headers
+                    return Response('Too Many Requests', 429, headers, mimetype='text/plain')
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
@@ -0,0 +1,80 @@
+"""
+代購業者金額欄位對帳
+
+affiliates 上的 total_sales / total_commission / pending_commission / paid_commission
+是由各個寫入路徑逐筆加減的，重試、並行更新或中途失敗都可能讓它們和
+referral_orders、payouts 的實際資料不一致。
+
+reconcile() 只處理上次對帳之後有變動的代購業者（checkpoint 存在 settings 表），
+每批 id 用一次 compute_affiliate_totals RPC 在資料庫端彙總，
+回報差異，指定 repair 時再以一次 apply_affiliate_totals RPC 寫回整批修正值。
+"""
+from models import (apply_affiliate_totals, compute_affiliate_totals,
+                    get_affiliates_changed_since, get_setting, set_setting)
+from services import affiliate_versions
+
+CHECKPOINT_KEY = 'reconcile_checkpoint'
+TOTAL_FIELDS = ('total_sales', 'total_commission', 'pending_commission', 'paid_commission')
+TOLERANCE = 0.005
+
+
+def _amount(value) -> float:
+    return float(value or 0)
+
+
+def find_discrepancies(rows: list) -> list:
+    """比對目前值與正確值，回傳有差異的代購業者"""
+    discrepancies = []
+    for row in rows:
+        diffs = {}
+        for field in TOTAL_FIELDS:
+            stored = _amount(row.get(field))
+            expected = _amount(row.get(f"expected_{field}"))
+            if abs(stored - expected) >= TOLERANCE:
+                diffs[field] = {'stored': stored, 'expected': expected}
+        if diffs:
+            discrepancies.append({
+                'id': row['id'],
+                'name': row.get('name'),
+                'diffs': diffs,
+                'expected': {field: _amount(row.get(f"expected_{field}")) for field in TOTAL_FIELDS}
+            })
+    return discrepancies
+
+
+def reconcile(full: bool = False, repair: bool = False, batch_size: int = 1000):
+    """對帳一輪並回傳報告；查詢失敗時回傳 None（不推進 checkpoint）"""
+    since = None if full else get_setting(CHECKPOINT_KEY)
+    changed = get_affiliates_changed_since(since)
+    if changed is None:
+        return None
+
+    affiliate_ids = changed['affiliate_ids']
+    report = {
+        'since': since,
+        'checked': 0,
+        'discrepancies': [],
+        'repaired': 0,
+        'checkpoint_advanced': False
+    }
+
+    for start in range(0, len(affiliate_ids), batch_size):
+        rows = compute_affiliate_totals(affiliate_ids[start:start + batch_size])
+        if rows is None:
+            return None
+        report['checked'] += len(rows)
+        batch = find_discrepancies(rows)
+        report['discrepancies'].extend(batch)
+
+        if repair and batch:
+            updated = apply_affiliate_totals([{'id': item['id'], **item['expected']} for item in batch])
+            if updated is None:
+                return None
+            report['repaired'] += updated
+            for item in batch:
+                affiliate_versions.touch(item['id'])
+
+    # 只回報不修正時保留 checkpoint，下次對帳仍會看到這些差異
+    if repair or not report['discrepancies']:
+        report['checkpoint_advanced'] = set_setting(CHECKPOINT_KEY, changed['now']) is not None
+    return report
@@ -0,0 +1,88 @@
+"""
+給獨立轉址程序（redirector.py）使用的短網址對照檔
+
+把啟用中的代購業者（短網址 → 目標網址與推薦碼）與活動連結（「短網址/c/slug」
+與活動自己的短網址）編譯成 redirector.py 定義的二進位格式，寫入暫存檔後 os.replace 原子替換。
+轉址程序需要的設定（預設目標、來源代碼、點擊 ID 格式、分享圖網址、商品路徑規則）寫在檔案的 meta，
+轉址程序本身不讀 config.py。
+
+共用索引的 refresher 每次重建索引時一併更新；轉址程序在其他主機時以 build-redirect-map --loop 維護。
+"""
+import json
+import os
+import time
+import uuid
+
+from config import Config
+from redirector import ENTRY, HEADER, MAGIC, MAP_FILENAME, campaign_key, key_hash
+from routes.redirect import SOURCE_CODES
+from models import CLICK_ID_LENGTH, CLICK_ID_SEPARATOR
+from services.share_images import LINK_PREVIEW_PATTERN, PRODUCT_PATH_PATTERN
+
+
+def map_path():
+    return Config.REDIRECT_MAP_PATH or os.path.join(Config.SHARED_DIR, MAP_FILENAME)
+
+
+def target_url(target_path: str = None) -> str:
+    return f"{Config.REDIRECT_TARGET}/{target_path}" if target_path else Config.REDIRECT_TARGET
+
+
+def build_redirect_map(affiliates, campaigns=(), path: str = None):
+    """把啟用中的代購業者與活動連結寫成對照檔並原子替換，回傳 (版本號, 筆數)"""
+    path = path or map_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    pool = bytearray()
+    pool_offsets = {}
+
+    def add_string(value):
+        data = (value or '').encode('utf-8')
+        if data not in pool_offsets:
+            pool_offsets[data] = len(pool)
+            pool.extend(data)
+        return pool_offsets[data], len(data)
+
+    active = {str(affiliate['id']): affiliate for affiliate in affiliates if affiliate.get('status') == 'active'}
+    entries = []
+    for affiliate_id, affiliate in active.items():
+        entries.append((
+            key_hash(affiliate['short_code']), *add_string(affiliate['short_code']), uuid.UUID(affiliate_id).bytes,
+            *add_string(affiliate['ref_code']), *add_string(affiliate.get('name')),
+            *add_string(target_url()), *add_string(None), 0
+        ))
+
+    for campaign in campaigns:
+        affiliate = active.get(str(campaign['affiliate_id']))
+        if affiliate is None:
+            continue
+        keys = [campaign_key(affiliate['short_code'], campaign['slug'])]
+        if campaign.get('short_code'):
+            keys.append(campaign['short_code'])
+        for key in keys:
+            entries.append((
+                key_hash(key), *add_string(key), uuid.UUID(str(affiliate['id'])).bytes,
+                *add_string(affiliate['ref_code']), *add_string(affiliate.get('name')),
+                *add_string(target_url(campaign.get('target_path'))), *add_string(campaign.get('source')),
+                int(campaign['id'])
+            ))
+
+    meta = add_string(json.dumps({
+        'default_target': Config.REDIRECT_TARGET,
+        'short_url_domain': Config.SHORT_URL_DOMAIN,
+        'share_base': f"{Config.SHORT_URL_DOMAIN}/share",
+        'sources': SOURCE_CODES,
+        'click_id_length': CLICK_ID_LENGTH,
+        'click_id_separator': CLICK_ID_SEPARATOR,
+        'preview_pattern': LINK_PREVIEW_PATTERN.pattern,
+        'product_path_pattern': PRODUCT_PATH_PATTERN.pattern
+    }, ensure_ascii=False))
+
+    version = time.time_ns()
+    tmp_path = f"{path}.{version}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, version, time.time(), len(entries), *meta))
+        f.write(b''.join(ENTRY.pack(*entry) for entry in sorted(entries)))
+        f.write(pool)
+    os.replace(tmp_path, path)
+    return version, len(entries)
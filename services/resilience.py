@@ -0,0 +1,94 @@
+"""
+資料庫保護機制
+
+- CircuitBreaker：連續失敗達門檻後「斷路」，冷卻期間所有資料庫呼叫立即失敗，
+  不再卡住 worker 等 HTTP timeout；冷卻結束後放行一次試探，成功才恢復
+- 請求時間預算：每個請求有一個 deadline，資料庫呼叫的 timeout 不會超過剩餘時間
+"""
+import threading
+import time
+
+from flask import g, has_request_context
+from config import Config
+
+
+class CircuitOpenError(Exception):
+    """熔斷器開啟中，呼叫被直接拒絕"""
+
+
+class DeadlineExceeded(Exception):
+    """請求的資料庫時間預算已用完"""
+
+
+class CircuitBreaker:
+    """closed → open → half-open 三態熔斷器（每個 worker 各自一份）"""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def is_open(self) -> bool:
+        return self.state == 'open'
+
+    def before_call(self):
+        """呼叫前檢查，斷路中直接丟出 CircuitOpenError"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+        raise CircuitOpenError('database circuit breaker is open')
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                print(f"Database circuit breaker opened after {self._failures} failures")
+
+
+db_breaker = CircuitBreaker(Config.DB_BREAKER_FAILURES, Config.DB_BREAKER_COOLDOWN)
+
+
+# ============================================
+# 請求時間預算
+# ============================================
+
+def set_deadline(budget_ms: int):
+    """設定目前請求的資料庫時間預算"""
+    g.db_deadline = time.monotonic() + budget_ms / 1000
+
+
+def remaining_budget():
+    """剩餘秒數；不在請求中或沒有設定預算時回傳 None"""
+    if not has_request_context():
+        return None
+    deadline = g.get('db_deadline')
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
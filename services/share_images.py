@@ -0,0 +1,226 @@
+"""
+代購業者專屬的分享圖（OG image）與 QR code
+
+分享圖畫上代購業者名稱、連結與 QR code；QR code 另外可單獨下載（商品連結各自一張）。
+圖片依內容（種類、名稱、連結、字型、RENDER_VERSION）的 hash 存成 SHARE_IMAGE_DIR 下的檔案，
+名稱或連結沒變就直接讀檔、不會重新繪製；網址帶 hash，所以可以永久快取，
+名稱或連結改變時 hash 跟著改變，舊網址轉到新網址。
+快取檔超過 SHARE_IMAGE_MAX_FILES 個時，依最後使用時間（讀取時更新 mtime）刪除最舊的圖片。
+
+LINE / Facebook 等爬蟲抓短網址時回傳帶 og:image 的頁面（不記點擊），
+預覽圖指向帶 hash 的網址，爬蟲重複抓取只會讀到同一個檔案。
+
+繪圖使用 Pillow、QR code 使用 segno（requirements.txt），兩者都較重，第一次繪圖時才 import，
+轉址路徑載入這個模組不會載入它們；找不到中文字型時分享圖退回共用的 og-image.png。
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from io import BytesIO
+from urllib.parse import quote
+
+from config import Config
+
+# 版面改變時加一，所有圖片重新產生
+RENDER_VERSION = 1
+IMAGE_KINDS = ('og', 'qr')
+OG_SIZE = (1200, 630)
+QR_SCALE = 12
+# 讀取快取檔時，mtime 超過這個秒數才更新（不必每次都寫 inode）
+TOUCH_INTERVAL = 3600
+# 超過上限時刪到上限的這個比例，不必每產生一張就掃一次目錄
+PRUNE_RATIO = 0.9
+
+# 連結預覽用的爬蟲（LINE 的 App 內瀏覽器 UA 含 Line/，爬蟲則是 line-poker）
+LINK_PREVIEW_PATTERN = re.compile(
+    r'facebookexternalhit|Facebot|line-poker|Twitterbot|Slackbot|Discordbot|TelegramBot|'
+    r'WhatsApp|LinkedInBot|Pinterestbot|SkypeUriPreview|redditbot|Applebot', re.I)
+PRODUCT_PATH_PATTERN = re.compile(r'^(products|collections)/[\w%\-.]{1,200}$')
+
+# 沒有設定 SHARE_IMAGE_FONT 時依序嘗試的中文字型
+FONT_CANDIDATES = (
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc',
+    '/usr/share/fonts/google-noto-cjk/NotoSansCJK-Bold.ttc',
+    '/System/Library/Fonts/PingFang.ttc',
+)
+
+BACKGROUND = ((29, 53, 87), (69, 123, 157))   # 與 og-image-template.html 相同的漸層
+ACCENT = (230, 57, 70)
+
+_render_lock = threading.Lock()
+
+
+def is_link_preview(user_agent: str) -> bool:
+    """是否為產生連結預覽的爬蟲"""
+    return bool(user_agent) and bool(LINK_PREVIEW_PATTERN.search(user_agent))
+
+
+def valid_product_path(product_path: str) -> bool:
+    return bool(product_path) and bool(PRODUCT_PATH_PATTERN.match(product_path))
+
+
+def available(kind: str) -> bool:
+    """這種圖片是否能產生（分享圖需要中文字型，否則名稱會變成方塊）"""
+    if kind == 'qr':
+        return True
+    return bool(_font_path())
+
+
+def share_link(affiliate: dict, product_path: str = None) -> str:
+    """分享圖與 QR code 上的連結"""
+    link = f"{Config.SHORT_URL_DOMAIN}/{affiliate['short_code']}"
+    return f"{link}/{product_path}" if product_path else link
+
+
+def _font_path():
+    if Config.SHARE_IMAGE_FONT:
+        return Config.SHARE_IMAGE_FONT if os.path.exists(Config.SHARE_IMAGE_FONT) else ''
+    return next((path for path in FONT_CANDIDATES if os.path.exists(path)), '')
+
+
+def content_hash(kind: str, affiliate: dict, product_path: str = None) -> str:
+    """圖片內容的 hash：名稱、連結、字型或版面改變時才會改變"""
+    key = '\x1f'.join((str(RENDER_VERSION), kind, affiliate.get('name') or '',
+                       share_link(affiliate, product_path), _font_path()))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def image_path(kind: str, digest: str) -> str:
+    return os.path.join(Config.SHARE_IMAGE_DIR, f"{kind}.{digest}.png")
+
+
+def share_image_url(kind: str, affiliate: dict, product_path: str = None, hashed: bool = True) -> str:
+    """圖片網址；hashed 時帶內容 hash（可永久快取，給 og:image 用），否則為固定網址（給下載連結用）"""
+    filename = f"{kind}.{content_hash(kind, affiliate, product_path)}.png" if hashed else f"{kind}.png"
+    url = f"{Config.SHORT_URL_DOMAIN}/share/{affiliate['short_code']}/{filename}"
+    return f"{url}?p={quote(product_path, safe='/%')}" if product_path else url
+
+
+# ============================================
+# 繪圖
+# ============================================
+
+def render_qr(link: str) -> bytes:
+    """QR code PNG"""
+    import segno
+    buffer = BytesIO()
+    segno.make(link, error='m').save(buffer, kind='png', scale=QR_SCALE, border=2)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=32)
+def _font(size: int):
+    from PIL import ImageFont
+    path = _font_path()
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            pass
+    return ImageFont.load_default(size)
+
+
+def _fit_text(draw, text: str, size: int, max_width: int):
+    """縮小字級直到文字寬度放得下，最小字級仍放不下時截斷"""
+    while size > 28 and draw.textlength(text, font=_font(size)) > max_width:
+        size -= 4
+    font = _font(size)
+    while len(text) > 1 and draw.textlength(text, font=font) > max_width:
+        text = text[:-2] + '…'
+    return text, font
+
+
+def render_og(name: str, link: str) -> bytes:
+    """1200×630 的分享圖 PNG：左邊名稱與連結，右邊 QR code"""
+    from PIL import Image, ImageChops, ImageDraw
+    width, height = OG_SIZE
+    # 左上到右下的斜向漸層：水平與垂直漸層各取一半
+    gradient = Image.linear_gradient('L')
+    mask = ImageChops.add(gradient.rotate(90).resize(OG_SIZE), gradient.resize(OG_SIZE), scale=2.0)
+    image = Image.composite(Image.new('RGB', OG_SIZE, BACKGROUND[1]), Image.new('RGB', OG_SIZE, BACKGROUND[0]), mask)
+
+    overlay = Image.new('RGBA', OG_SIZE, (0, 0, 0, 0))
+    decoration = ImageDraw.Draw(overlay)
+    decoration.ellipse((width - 100, -100, width + 100, 100), fill=ACCENT + (77,))
+    decoration.ellipse((-100, height - 100, 100, height + 100), fill=ACCENT + (77,))
+    image = Image.alpha_composite(image.convert('RGBA'), overlay)
+
+    draw = ImageDraw.Draw(image)
+    draw.text((80, 120), 'GOYOULINK', font=_font(40), fill='white')
+    title, title_font = _fit_text(draw, name, 72, 600)
+    draw.text((80, 200), title, font=title_font, fill='white')
+    draw.text((80, 310), '推薦的日本好物', font=_font(48), fill=(244, 162, 97))
+    link_text, link_font = _fit_text(draw, link.split('://', 1)[-1], 30, 600)
+    draw.text((80, 460), link_text, font=link_font, fill=(230, 236, 242))
+
+    # QR code 放在白色圓角底板上
+    draw.rounded_rectangle((780, 155, 1120, 495), radius=24, fill='white')
+    qr = Image.open(BytesIO(render_qr(link))).convert('RGB').resize((300, 300), Image.NEAREST)
+    image.paste(qr, (800, 175))
+
+    buffer = BytesIO()
+    image.convert('RGB').save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _touch(path: str):
+    """更新最後使用時間，刪除快取時保留常用的圖片"""
+    try:
+        if os.path.getmtime(path) < time.time() - TOUCH_INTERVAL:
+            os.utime(path)
+    except OSError:
+        pass
+
+
+def prune_cache(max_files: int = None):
+    """快取檔超過上限時，刪除最久沒用到的圖片，回傳刪除的數量"""
+    max_files = Config.SHARE_IMAGE_MAX_FILES if max_files is None else max_files
+    try:
+        entries = [entry for entry in os.scandir(Config.SHARE_IMAGE_DIR)
+                   if entry.name.endswith('.png') and entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    if len(entries) <= max_files:
+        return 0
+
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    removed = 0
+    for entry in entries[:len(entries) - int(max_files * PRUNE_RATIO)]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def get_share_image(kind: str, affiliate: dict, product_path: str = None):
+    """取得圖片檔，回傳 (hash, 檔案路徑)；沒有快取檔時產生一次；無法產生時回傳 None"""
+    if kind not in IMAGE_KINDS or not available(kind):
+        return None
+    digest = content_hash(kind, affiliate, product_path)
+    path = image_path(kind, digest)
+    if os.path.exists(path):
+        _touch(path)
+        return digest, path
+
+    link = share_link(affiliate, product_path)
+    # 同一個 worker 內避免同時繪製多次；不同 worker 同時產生時以 os.replace 覆蓋，內容相同
+    with _render_lock:
+        if not os.path.exists(path):
+            try:
+                data = render_qr(link) if kind == 'qr' else render_og(affiliate.get('name') or '', link)
+                os.makedirs(Config.SHARE_IMAGE_DIR, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                prune_cache()
+            except Exception as e:
+                print(f"Error in get_share_image: {e}")
+                return None
+    return digest, path
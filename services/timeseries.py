@@ -0,0 +1,109 @@
+"""
+時間序列統計 API 的共用邏輯
+
+資料來自 affiliate_stats_hourly / affiliate_stats_daily（由資料庫觸發器即時累加），
+查詢時只讀取範圍內的統計列，這裡負責解析查詢參數、補上沒有資料的時段，
+並為後台的全站查詢提供短時間的回應快取（代購業者入口改用資料版本快取）。
+"""
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from models import get_stats_timeseries
+
+# 與 schema.sql 的每日統計相同，以日本時間切日
+TIMEZONE = ZoneInfo('Asia/Tokyo')
+
+STEPS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+DEFAULT_DAYS = {'hour': 2, 'day': 30}
+MAX_DAYS = {'hour': 31, 'day': 366}
+METRICS = ('clicks', 'orders', 'sales', 'commission')
+
+
+def parse_range(args):
+    """從查詢參數取得 (granularity, since, until)；參數錯誤時拋出 ValueError
+
+    支援 granularity=hour|day、from / to（YYYY-MM-DD，含當天）或 days=N（到今天為止）
+    """
+    granularity = args.get('granularity', 'day')
+    if granularity not in STEPS:
+        raise ValueError('granularity 必須是 hour 或 day')
+
+    today = datetime.now(TIMEZONE).date()
+    end = date.fromisoformat(args['to']) if args.get('to') else today
+    if args.get('from'):
+        start = date.fromisoformat(args['from'])
+    else:
+        start = end - timedelta(days=int(args.get('days', DEFAULT_DAYS[granularity])) - 1)
+
+    if start > end:
+        raise ValueError('from 不能晚於 to')
+    if (end - start).days + 1 > MAX_DAYS[granularity]:
+        raise ValueError(f"{granularity} 最多查詢 {MAX_DAYS[granularity]} 天")
+
+    since = datetime.combine(start, datetime.min.time(), TIMEZONE)
+    until = datetime.combine(end + timedelta(days=1), datetime.min.time(), TIMEZONE)
+    return granularity, since, until
+
+
+def build_timeseries(affiliate_id, granularity: str, since: datetime, until: datetime):
+    """查詢並補齊每個時段，回傳 API 回應內容；查詢失敗時回傳 None"""
+    rows = get_stats_timeseries(affiliate_id, granularity, since.isoformat(), until.isoformat())
+    if rows is None:
+        return None
+
+    by_bucket = {datetime.fromisoformat(row['bucket']).timestamp(): row for row in rows}
+    buckets = []
+    totals = dict.fromkeys(METRICS, 0)
+    current = since
+    while current < until:
+        row = by_bucket.get(current.timestamp(), {})
+        bucket = {'t': current.isoformat()}
+        for metric in METRICS:
+            value = row.get(metric) or 0
+            value = int(value) if metric in ('clicks', 'orders') else round(float(value), 2)
+            bucket[metric] = value
+            totals[metric] += value
+        buckets.append(bucket)
+        # 日本沒有夏令時間，每天固定 24 小時，直接累加即可
+        current += STEPS[granularity]
+
+    totals['sales'] = round(totals['sales'], 2)
+    totals['commission'] = round(totals['commission'], 2)
+    return {
+        'granularity': granularity,
+        'from': since.isoformat(),
+        'to': until.isoformat(),
+        'buckets': buckets,
+        'totals': totals
+    }
+
+
+# ============================================
+# 後台回應快取（每個 worker 一份）
+# ============================================
+
+CACHE_TTL = 60
+CACHE_SIZE = 200
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def cached_timeseries(affiliate_id, granularity: str, since: datetime, until: datetime):
+    """與 build_timeseries 相同，但在 CACHE_TTL 秒內重複的查詢直接回傳上次結果"""
+    key = (affiliate_id, granularity, since, until)
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and now - entry[0] < CACHE_TTL:
+            return entry[1]
+
+    value = build_timeseries(affiliate_id, granularity, since, until)
+    if value is not None:
+        with _cache_lock:
+            if len(_cache) >= CACHE_SIZE:
+                _cache.clear()
+            _cache[key] = (now, value)
+    return value
@@ -0,0 +1,108 @@
+"""
+Worker 啟動預熱
+
+gunicorn 在 worker 載入 app 之後、開始接請求之前呼叫 warm_up()
+（見 gunicorn.conf.py 的 post_worker_init），依序：
+    imports     載入 supabase / requests 等較重的套件
+    database    建立 Supabase client 並打一次輕量查詢，建立連線池
+    affiliates  開啟共用索引，沒有索引時把啟用中的代購業者載入短網址快取
+    shopify     建立 Shopify API 的 keep-alive 連線
+    commission_rules  編譯佣金規則對照表（系列展開在背景進行）
+    templates   預先編譯所有 Jinja 模板
+每個階段的耗時會印在 log，並可從 /health 查看。
+"""
+import os
+import time
+
+from config import Config
+
+_startup_report = {}
+
+
+def _phase_imports(app):
+    import supabase  # noqa: F401
+    import requests  # noqa: F401
+    return 'ok'
+
+
+def _phase_database(app):
+    from models import get_supabase
+
+    db = get_supabase()
+    if db is None:
+        return 'skipped (SUPABASE_URL not set)'
+    db.table('affiliates').select('id').limit(1).execute()
+    return 'ok'
+
+
+def _phase_affiliates(app):
+    from models import preload_redirect_cache
+    from services.affiliate_index import affiliate_index
+
+    stats = affiliate_index.stats()
+    if stats:
+        return f"shared index v{stats['version']} ({stats['count']} affiliates)"
+    return f"{preload_redirect_cache()} affiliates cached"
+
+
+def _phase_shopify(app):
+    from routes.affiliate import get_shopify_session
+
+    session = get_shopify_session()
+    if not Config.SHOPIFY_SHOP_DOMAIN:
+        return 'skipped (SHOPIFY_SHOP_DOMAIN not set)'
+    session.head(f"https://{Config.SHOPIFY_SHOP_DOMAIN}", timeout=3)
+    return 'ok'
+
+
+def _phase_commission_rules(app):
+    from services.commission_rules import get_compiled_rules
+
+    rules = get_compiled_rules()
+    return f"{rules.count} rules" if rules else 'not loaded'
+
+
+def _phase_templates(app):
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return f"{len(names)} templates"
+
+
+PHASES = [
+    ('imports', _phase_imports),
+    ('database', _phase_database),
+    ('affiliates', _phase_affiliates),
+    ('shopify', _phase_shopify),
+    ('commission_rules', _phase_commission_rules),
+    ('templates', _phase_templates),
+]
+
+
+def warm_up(app):
+    """執行所有預熱階段；單一階段失敗不影響其他階段與啟動"""
+    report = {'pid': os.getpid(), 'phases': []}
+    started = time.perf_counter()
+
+    with app.app_context():
+        for name, phase in PHASES:
+            phase_started = time.perf_counter()
+            try:
+                result = phase(app)
+            except Exception as e:
+                result = f"error: {e}"
+            elapsed_ms = round((time.perf_counter() - phase_started) * 1000, 1)
+            report['phases'].append({'name': name, 'ms': elapsed_ms, 'result': result})
+            print(f"[warm-up {report['pid']}] {name}: {elapsed_ms} ms ({result})")
+
+    report['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"[warm-up {report['pid']}] total: {report['total_ms']} ms")
+
+    _startup_report.clear()
+    _startup_report.update(report)
+    return report
+
+
+def get_startup_report():
+    """取得本 worker 的預熱報告（尚未預熱時為空）"""
+    return dict(_startup_report)
@@ -0,0 +1,203 @@
+"""
+Shopify Webhook 內容解析
+
+Shopify 的訂單 Webhook 常有數百 KB（商品明細、地址、稅金、metafields），
+但分潤只用到十幾個欄位。這裡把原始 body（只讀一次、先驗證簽名）用 orjson 解析
+（沒安裝時退回標準 json），立刻抽出需要的欄位成 OrderRecord，
+完整的 dict 在函式結束後就能釋放，不會跟著請求一路傳下去。
+
+bench-webhook 指令用 benchmark() 量測每個 Webhook 的 CPU 時間與記憶體高峰。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import math
+import time
+import tracemalloc
+from typing import NamedTuple, Optional
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# 商品明細只保留佣金規則用到的欄位（折扣分攤先加總成 total_discount）
+LINE_ITEM_FIELDS = ('id', 'product_id', 'title', 'vendor', 'price', 'quantity', 'gift_card')
+
+
+class OrderRecord(NamedTuple):
+    """分潤用到的訂單欄位"""
+    id: str
+    name: str
+    email: Optional[str]
+    total_price: float
+    currency: str
+    created_at: Optional[str]
+    note: str
+    note_attributes: tuple      # ((name, value), ...)
+    discount_codes: tuple       # (code, ...)
+    landing_site: str
+    line_items: tuple           # 精簡後的商品明細 dict
+
+
+def verify_signature(body: bytes, hmac_header: str, secret: str) -> bool:
+    """以原始 body 驗證 X-Shopify-Hmac-Sha256"""
+    try:
+        expected = base64.b64decode(hmac_header, validate=True)
+    except (ValueError, TypeError):
+        return False
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, expected)
+
+
+def parse_amount(value) -> float:
+    """解析金額字串；沒有值視為 0，格式錯誤或非有限數時丟 ValueError"""
+    if value is None or value == '':
+        return 0.0
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not math.isfinite(amount):
+        raise ValueError(f"Invalid amount: {value!r}")
+    return amount
+
+
+def _discount_amount(value) -> float:
+    # 折扣只影響佣金計算基礎，格式錯誤時當作沒有折扣
+    try:
+        return parse_amount(value)
+    except ValueError:
+        return 0.0
+
+
+def _slim_line_item(line: dict) -> dict:
+    item = {field: line.get(field) for field in LINE_ITEM_FIELDS}
+    allocations = line.get('discount_allocations')
+    if allocations:
+        item['total_discount'] = sum(_discount_amount(allocation.get('amount')) for allocation in allocations)
+    else:
+        item['total_discount'] = _discount_amount(line.get('total_discount'))
+    return item
+
+
+def order_record(data: dict) -> OrderRecord:
+    """把 REST 格式的訂單 dict 轉成 OrderRecord；total_price 格式錯誤時丟 ValueError"""
+    return OrderRecord(
+        id=str(data.get('id')),
+        name=data.get('name') or '',
+        email=data.get('email'),
+        total_price=parse_amount(data.get('total_price')),
+        currency=data.get('currency') or 'JPY',
+        created_at=data.get('created_at'),
+        note=data.get('note') or '',
+        note_attributes=tuple((attr.get('name'), attr.get('value')) for attr in data.get('note_attributes') or ()),
+        discount_codes=tuple(discount.get('code') or '' for discount in data.get('discount_codes') or ()),
+        landing_site=data.get('landing_site') or '',
+        line_items=tuple(_slim_line_item(line) for line in data.get('line_items') or ())
+    )
+
+
+def parse_order(body: bytes) -> Optional[OrderRecord]:
+    """解析訂單 Webhook；內容不是 JSON 物件或金額格式錯誤時回傳 None"""
+    try:
+        data = loads(body)
+        return order_record(data) if isinstance(data, dict) else None
+    except ValueError as e:
+        print(f"Error in parse_order: {e}")
+        return None
+
+
+def parse_field(body: bytes, field: str) -> Optional[str]:
+    """只需要單一欄位的 Webhook（出貨、取消、退款）"""
+    try:
+        data = loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get(field) is None:
+        return None
+    return str(data[field])
+
+
+# ============================================
+# 效能量測（bench-webhook）
+# ============================================
+
+def sample_order_payload(line_items: int = 50) -> bytes:
+    """產生接近實際大小的 Shopify 訂單 Webhook"""
+    address = {
+        'first_name': '太郎', 'last_name': '山田', 'address1': '千代田区丸の内1-1-1', 'address2': 'ビル 10F',
+        'city': '千代田区', 'province': '東京都', 'country': 'Japan', 'zip': '100-0005',
+        'phone': '+81-3-0000-0000', 'company': None, 'latitude': 35.68, 'longitude': 139.76,
+        'country_code': 'JP', 'province_code': 'JP-13'
+    }
+    money = lambda amount: {'shop_money': {'amount': amount, 'currency_code': 'JPY'},
+                            'presentment_money': {'amount': amount, 'currency_code': 'JPY'}}
+    lines = [{
+        'id': 13000000000 + i, 'product_id': 8000000000 + i, 'variant_id': 45000000000 + i,
+        'title': f'商品 {i} プレミアムエディション', 'variant_title': 'M / ブラック', 'vendor': f'Brand {i % 7}',
+        'sku': f'SKU-{i:05d}', 'quantity': 1 + i % 3, 'price': f'{1000 + i * 37}.00', 'grams': 250,
+        'gift_card': False, 'taxable': True, 'requires_shipping': True, 'fulfillment_status': None,
+        'price_set': money(f'{1000 + i * 37}.00'), 'total_discount': '0.00', 'total_discount_set': money('0.00'),
+        'discount_allocations': [{'amount': '100.00', 'amount_set': money('100.00'), 'discount_application_index': 0}],
+        'tax_lines': [{'title': '消費税', 'price': '100.00', 'rate': 0.1, 'price_set': money('100.00')}],
+        'properties': [{'name': 'ギフト包装', 'value': 'なし'}],
+        'duties': [], 'attributed_staffs': [], 'origin_location': address
+    } for i in range(line_items)]
+    order = {
+        'id': 5500000000000, 'name': '#1001', 'email': 'customer@example.com', 'currency': 'JPY',
+        'total_price': '125000.00', 'subtotal_price': '120000.00', 'total_tax': '11000.00',
+        'created_at': '2024-01-15T10:00:00+09:00', 'updated_at': '2024-01-15T10:00:05+09:00',
+        'note': 'ref:alice123', 'note_attributes': [{'name': 'ref', 'value': 'alice123.k3m9x2p7qa'}],
+        'discount_codes': [{'code': 'WELCOME', 'amount': '1000.00', 'type': 'fixed_amount'}],
+        'landing_site': '/products/sample?ref=alice123.k3m9x2p7qa', 'referring_site': 'https://www.instagram.com/',
+        'billing_address': address, 'shipping_address': address,
+        'customer': {'id': 7000000000, 'email': 'customer@example.com', 'first_name': '太郎', 'last_name': '山田',
+                     'default_address': address, 'tags': 'vip, repeat', 'note': None},
+        'line_items': lines,
+        'shipping_lines': [{'title': '宅配便', 'price': '800.00', 'price_set': money('800.00'), 'tax_lines': []}],
+        'tax_lines': [{'title': '消費税', 'price': '11000.00', 'rate': 0.1, 'price_set': money('11000.00')}],
+        'total_price_set': money('125000.00'), 'subtotal_price_set': money('120000.00'),
+        'client_details': {'browser_ip': '203.0.113.1', 'user_agent': 'Mozilla/5.0 (iPhone) Safari/604.1'},
+        'payment_gateway_names': ['shopify_payments'], 'tags': '', 'fulfillments': [], 'refunds': []
+    }
+    return json.dumps(order, ensure_ascii=False).encode('utf-8')
+
+
+def _legacy_handler(body: bytes, hmac_header: str, secret: str):
+    """原本的流程：base64 字串比對簽名，json 解析完整訂單並整份往下傳"""
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    hmac.compare_digest(base64.b64encode(digest).decode('utf-8'), hmac_header)
+    return json.loads(body)
+
+
+def _lean_handler(body: bytes, hmac_header: str, secret: str):
+    verify_signature(body, hmac_header, secret)
+    return parse_order(body)
+
+
+def benchmark(body: bytes, iterations: int = 200, secret: str = 'bench-secret'):
+    """量測原本與精簡流程每個 Webhook 的 CPU 時間（微秒）、記憶體高峰與解析後保留的大小（KB）"""
+    hmac_header = base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode()
+    results = {}
+    for name, handler in (('legacy', _legacy_handler), ('lean', _lean_handler)):
+        started = time.process_time()
+        for _ in range(iterations):
+            handler(body, hmac_header, secret)
+        cpu_us = (time.process_time() - started) / iterations * 1e6
+
+        # 記憶體高峰包含解析中的暫存物件與最後保留下來的結果
+        tracemalloc.start()
+        kept = handler(body, hmac_header, secret)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del kept
+
+        results[name] = {'cpu_us': round(cpu_us, 1), 'peak_kb': round(peak / 1024, 1),
+                         'retained_kb': round(retained / 1024, 1)}
+    results['parser'] = 'orjson' if orjson else 'json'
+    results['payload_kb'] = round(len(body) / 1024, 1)
+    return results
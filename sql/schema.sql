@@ -1,10 +1,13 @@
 -- ============================================
 -- GoyouLink 分潤系統 Database Schema
 -- 在 Supabase SQL Editor 中執行此腳本
+-- 新安裝與升級既有資料庫都執行同一份腳本，可以重複執行：
+-- 資料表與索引只在不存在時建立，後來新增的欄位以 ADD COLUMN IF NOT EXISTS 補上，
+-- 原本未分區的 clicks 會改名後搬進分區表（copy-and-swap）
 -- ============================================
 
 -- 1. 代購業者（推廣者）表
-CREATE TABLE affiliates (
+CREATE TABLE IF NOT EXISTS affiliates (
     id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
     name VARCHAR(255) NOT NULL,                    -- 代購業者名稱
     email VARCHAR(255) UNIQUE,                     -- Email
@@ -23,19 +26,57 @@ CREATE TABLE affiliates (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
--- 2. 點擊記錄表
-CREATE TABLE clicks (
-    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+-- 2. 點擊記錄表（依月份分區，見下方「點擊分區與保存期限」）
+
+-- 既有資料庫的 clicks 是一般資料表：先改名，建立分區表後再把點擊搬過去；
+-- 舊表的主鍵與索引名稱會和新表相同，一併改名或刪除
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class
+               WHERE relname = 'clicks' AND relkind = 'r' AND relnamespace = 'public'::regnamespace) THEN
+        ALTER TABLE clicks RENAME TO clicks_unpartitioned;
+        ALTER INDEX IF EXISTS clicks_pkey RENAME TO clicks_unpartitioned_pkey;
+        DROP INDEX IF EXISTS idx_clicks_affiliate_id;
+        DROP INDEX IF EXISTS idx_clicks_created_at;
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS clicks (
+    id UUID DEFAULT gen_random_uuid(),
     affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
-    ip_address VARCHAR(45),                        -- 訪客 IP（可匿名化）
+    ip_address VARCHAR(45),                        -- 訪客 IP（超過保存天數後匿名化）
     user_agent TEXT,                               -- 瀏覽器資訊
     referer TEXT,                                  -- 來源頁面
     landed_url TEXT,                               -- 到達頁面
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-);
+    source VARCHAR(20),                            -- 來源平台（facebook / instagram ...）
+    click_id VARCHAR(16),                          -- 點擊 ID（隨 ref 參數帶到商店，用於歸因；隨機產生）
+    device_id INTEGER,                             -- 以下四欄由 enrich-clicks 解析後寫入（click_dimensions.id）
+    browser_id INTEGER,
+    os_id INTEGER,
+    referrer_id INTEGER,
+    campaign_id INTEGER,                           -- 活動連結（campaign_links.id，一般短網址為 NULL）
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- 沒有對應月份分區的點擊先寫到這裡（正常情況下 ensure_click_partitions() 會預先建立；
+-- 落在這裡的點擊會在下次 ensure_click_partitions() 時搬到自己的月份分區）
+CREATE TABLE IF NOT EXISTS clicks_default PARTITION OF clicks DEFAULT;
+
+-- copy-and-swap：舊表的點擊先寫進 clicks_default（此時還沒有統計觸發器），
+-- 最後的 ensure_click_partitions() 會再搬到各自的月份分區；統計表以 rebuild-stats 重建
+DO $$
+BEGIN
+    IF to_regclass('clicks_unpartitioned') IS NOT NULL THEN
+        INSERT INTO clicks (id, affiliate_id, ip_address, user_agent, referer, landed_url, created_at)
+        SELECT id, affiliate_id, ip_address, user_agent, referer, landed_url, COALESCE(created_at, NOW())
+        FROM clicks_unpartitioned;
+        DROP TABLE clicks_unpartitioned;
+    END IF;
+END $$;
 
 -- 3. 推薦訂單表
-CREATE TABLE referral_orders (
+CREATE TABLE IF NOT EXISTS referral_orders (
     id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
     affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
     shopify_order_id VARCHAR(100) UNIQUE NOT NULL, -- Shopify 訂單 ID
@@ -52,8 +93,21 @@ CREATE TABLE referral_orders (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- 後來新增的欄位（既有資料庫升級時補上）
+ALTER TABLE referral_orders
+    ADD COLUMN IF NOT EXISTS click_id VARCHAR(16),                       -- 訂單帶來的點擊 ID
+    ADD COLUMN IF NOT EXISTS attributed_click_id UUID,                   -- 歸因到的點擊（clicks.id）
+    ADD COLUMN IF NOT EXISTS attributed_source VARCHAR(20),              -- 歸因到的來源平台
+    ADD COLUMN IF NOT EXISTS attributed_campaign_id INTEGER,             -- 歸因到的活動連結
+    ADD COLUMN IF NOT EXISTS attributed_at TIMESTAMP WITH TIME ZONE,     -- 歸因時間（NULL 表示尚未歸因）
+    ADD COLUMN IF NOT EXISTS fraud_score SMALLINT DEFAULT 0,             -- 詐騙分數（0-100，由 score-fraud 或確認前檢查寫入）
+    ADD COLUMN IF NOT EXISTS fraud_reasons TEXT[],                       -- self_referral / affiliate_customer / click_burst
+    ADD COLUMN IF NOT EXISTS fraud_checked_at TIMESTAMP WITH TIME ZONE,  -- 評分時間（NULL 表示尚未評分）
+    ADD COLUMN IF NOT EXISTS fraud_cleared_at TIMESTAMP WITH TIME ZONE,  -- 管理員確認放行的時間
+    ADD COLUMN IF NOT EXISTS commission_breakdown JSONB;                 -- 各商品明細的佣金計算（套用的規則、比例、金額）
+
 -- 4. 佣金發放記錄表
-CREATE TABLE payouts (
+CREATE TABLE IF NOT EXISTS payouts (
     id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
     affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
     amount DECIMAL(12,2) NOT NULL,                 -- 發放金額
@@ -66,32 +120,215 @@ CREATE TABLE payouts (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+ALTER TABLE payouts
+    ADD COLUMN IF NOT EXISTS run_id VARCHAR(40);                         -- 批次發放代碼（單筆發放為 NULL）
+
 -- 5. 系統設定表（可選，用於存放全域設定）
-CREATE TABLE settings (
+CREATE TABLE IF NOT EXISTS settings (
     key VARCHAR(100) PRIMARY KEY,
     value TEXT,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- 6. 各來源轉換統計（由 run_attribution() 維護）
+CREATE TABLE IF NOT EXISTS source_conversions (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    source VARCHAR(20) NOT NULL,                   -- 來源平台（direct 表示無來源）
+    clicks INTEGER DEFAULT 0,                      -- 點擊數
+    orders INTEGER DEFAULT 0,                      -- 歸因訂單數（不含取消/退款）
+    revenue DECIMAL(12,2) DEFAULT 0,               -- 歸因銷售額
+    commission DECIMAL(12,2) DEFAULT 0,            -- 歸因佣金
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (affiliate_id, source)
+);
+
+-- 7. 佣金帳本（只新增、不修改；每筆記錄對三種餘額的變動）
+CREATE TABLE IF NOT EXISTS commission_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    entry_type VARCHAR(20) NOT NULL,               -- opening / accrual / confirmation / reversal / payout
+    order_id UUID,                                 -- 相關的推薦訂單
+    payout_id UUID,                                -- 相關的發放記錄
+    accrued_delta DECIMAL(12,2) DEFAULT 0,         -- 未確認佣金的變動
+    pending_delta DECIMAL(12,2) DEFAULT 0,         -- 待發放佣金的變動
+    paid_delta DECIMAL(12,2) DEFAULT 0,            -- 已發放佣金的變動
+    note TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    UNIQUE (order_id, entry_type)                  -- 同一訂單的同一種記錄只寫一次（webhook 重送）
+);
+
+-- 8. 佣金餘額快照（由 take_commission_snapshots() 定期寫入）
+CREATE TABLE IF NOT EXISTS commission_snapshots (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    last_entry_id BIGINT NOT NULL,                 -- 已涵蓋的最後一筆帳本 ID
+    covered_until TIMESTAMP WITH TIME ZONE NOT NULL, -- 已涵蓋帳本記錄的最晚時間
+    accrued DECIMAL(12,2) DEFAULT 0,
+    pending DECIMAL(12,2) DEFAULT 0,
+    paid DECIMAL(12,2) DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (affiliate_id, last_entry_id)
+);
+
+-- 9. 每小時統計（由觸發器隨點擊與訂單即時累加）
+CREATE TABLE IF NOT EXISTS affiliate_stats_hourly (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,      -- 整點時間
+    clicks INTEGER DEFAULT 0,
+    orders INTEGER DEFAULT 0,                      -- 不含取消/退款
+    sales DECIMAL(14,2) DEFAULT 0,
+    commission DECIMAL(14,2) DEFAULT 0,
+    PRIMARY KEY (affiliate_id, bucket)
+);
+
+-- 10. 每日統計（以日本時間切日）
+CREATE TABLE IF NOT EXISTS affiliate_stats_daily (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    bucket DATE NOT NULL,
+    clicks INTEGER DEFAULT 0,
+    orders INTEGER DEFAULT 0,
+    sales DECIMAL(14,2) DEFAULT 0,
+    commission DECIMAL(14,2) DEFAULT 0,
+    PRIMARY KEY (affiliate_id, bucket)
+);
+
+-- 11. 排行榜（由 refresh_leaderboards() 從每日統計重算，每個期間與指標只保留前幾名）
+CREATE TABLE IF NOT EXISTS affiliate_leaderboards (
+    window_days INTEGER NOT NULL,                  -- 統計天數（7 / 30）
+    metric VARCHAR(20) NOT NULL,                   -- clicks / orders / sales / commission
+    rank INTEGER NOT NULL,
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    name VARCHAR(255),
+    value DECIMAL(14,2) DEFAULT 0,
+    refreshed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (window_days, metric, rank)
+);
+
+-- 12. 已封存點擊的彙總（分區刪除前寫入，讓各來源點擊數不因封存而減少）
+CREATE TABLE IF NOT EXISTS archived_click_rollups (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    source VARCHAR(20) NOT NULL,
+    clicks INTEGER DEFAULT 0,
+    PRIMARY KEY (affiliate_id, source)
+);
+
+-- 13. 點擊維度（裝置 / 瀏覽器 / 作業系統 / 來源網站），clicks 只存這裡的 id
+CREATE TABLE IF NOT EXISTS click_dimensions (
+    id SERIAL PRIMARY KEY,                         -- 來源網站的網域沒有上限，不能用 SMALLSERIAL
+    kind VARCHAR(20) NOT NULL,                     -- device / browser / os / referrer
+    value VARCHAR(100) NOT NULL,
+    UNIQUE (kind, value)
+);
+
+-- 14. 點擊暴增（同一代購業者、同一 IP 與 User-Agent 在短時間內大量點擊，由 score-fraud 寫入）
+CREATE TABLE IF NOT EXISTS click_bursts (
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    ip_address VARCHAR(45) NOT NULL,
+    ua_hash VARCHAR(16) NOT NULL,                  -- User-Agent 的 BLAKE2 雜湊
+    window_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    clicks INTEGER NOT NULL,
+    detected_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (affiliate_id, ip_address, ua_hash, window_start)
+);
+
+-- 15. 佣金規則（依商品 / 系列 / 品牌覆寫佣金比例；沒有符合的規則時使用代購業者的佣金比例）
+CREATE TABLE IF NOT EXISTS commission_rules (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    match_type VARCHAR(20) NOT NULL,               -- product / collection / vendor / all
+    match_value VARCHAR(255),                      -- 商品 ID、系列 ID 或品牌名稱（all 時為 NULL）
+    commission_rate DECIMAL(5,2) NOT NULL,         -- 佣金比例（%）
+    priority INTEGER DEFAULT 0,                    -- 數字大的優先
+    starts_at TIMESTAMP WITH TIME ZONE,            -- 生效期間（NULL 表示不限）
+    ends_at TIMESTAMP WITH TIME ZONE,
+    status VARCHAR(20) DEFAULT 'active',           -- active / inactive
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- 16. 活動連結（同一個代購業者區分不同貼文 / 活動：/<short_code>/c/<slug> 或活動自己的短網址）
+CREATE TABLE IF NOT EXISTS campaign_links (
+    id SERIAL PRIMARY KEY,
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    name VARCHAR(100) NOT NULL,
+    slug VARCHAR(40) NOT NULL,                     -- 網址用代碼（英數字與 -）
+    short_code VARCHAR(20) UNIQUE,                 -- 活動自己的短網址（可選）
+    source VARCHAR(20),                            -- 預設來源平台（網址沒有 ?s= 時使用）
+    target_path TEXT,                              -- 導向的商店路徑（如 products/xxx，NULL 為首頁）
+    status VARCHAR(20) DEFAULT 'active',           -- active / archived
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    UNIQUE (affiliate_id, slug)
+);
+
+-- 17. 各活動連結的統計（點擊由觸發器即時累加、不因點擊封存而減少；訂單由 run_attribution() 重算）
+CREATE TABLE IF NOT EXISTS campaign_stats (
+    campaign_id INTEGER PRIMARY KEY REFERENCES campaign_links(id) ON DELETE CASCADE,
+    affiliate_id UUID REFERENCES affiliates(id) ON DELETE CASCADE,
+    clicks INTEGER DEFAULT 0,
+    orders INTEGER DEFAULT 0,                      -- 歸因訂單數（不含取消/退款）
+    revenue DECIMAL(12,2) DEFAULT 0,
+    commission DECIMAL(12,2) DEFAULT 0,
+    last_click_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- 18. 短網址代碼（代購業者與活動連結共用同一個命名空間，由觸發器維護）
+CREATE TABLE IF NOT EXISTS short_codes (
+    code VARCHAR(20) PRIMARY KEY,
+    owner_table VARCHAR(20) NOT NULL               -- affiliates / campaign_links
+);
+
 -- 初始化預設設定
 INSERT INTO settings (key, value) VALUES 
     ('default_commission_rate', '5'),
     ('cookie_days', '30'),
-    ('min_payout_jpy', '20000');
+    ('min_payout_jpy', '20000')
+ON CONFLICT (key) DO NOTHING;
 
 -- ============================================
 -- 索引（提升查詢效能）
 -- ============================================
 
-CREATE INDEX idx_affiliates_ref_code ON affiliates(ref_code);
-CREATE INDEX idx_affiliates_short_code ON affiliates(short_code);
-CREATE INDEX idx_affiliates_status ON affiliates(status);
-CREATE INDEX idx_clicks_affiliate_id ON clicks(affiliate_id);
-CREATE INDEX idx_clicks_created_at ON clicks(created_at);
-CREATE INDEX idx_referral_orders_affiliate_id ON referral_orders(affiliate_id);
-CREATE INDEX idx_referral_orders_status ON referral_orders(status);
-CREATE INDEX idx_referral_orders_shopify_order_id ON referral_orders(shopify_order_id);
-CREATE INDEX idx_payouts_affiliate_id ON payouts(affiliate_id);
+CREATE INDEX IF NOT EXISTS idx_affiliates_ref_code ON affiliates(ref_code);
+CREATE INDEX IF NOT EXISTS idx_affiliates_short_code ON affiliates(short_code);
+CREATE INDEX IF NOT EXISTS idx_affiliates_status ON affiliates(status);
+CREATE INDEX IF NOT EXISTS idx_affiliates_created_at ON affiliates(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_affiliates_total_clicks ON affiliates(total_clicks);
+CREATE INDEX IF NOT EXISTS idx_affiliates_total_orders ON affiliates(total_orders);
+CREATE INDEX IF NOT EXISTS idx_affiliates_total_sales ON affiliates(total_sales);
+CREATE INDEX IF NOT EXISTS idx_affiliates_total_commission ON affiliates(total_commission);
+
+-- 後台代購業者搜尋（ILIKE '%關鍵字%'）使用 trigram 索引
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_affiliates_name_trgm ON affiliates USING GIN (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_affiliates_email_trgm ON affiliates USING GIN (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_affiliates_ref_code_trgm ON affiliates USING GIN (ref_code gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_affiliates_domain_trgm ON affiliates USING GIN (domain gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_clicks_affiliate_id ON clicks(affiliate_id);
+CREATE INDEX IF NOT EXISTS idx_clicks_created_at ON clicks(created_at);
+CREATE INDEX IF NOT EXISTS idx_referral_orders_affiliate_id ON referral_orders(affiliate_id);
+CREATE INDEX IF NOT EXISTS idx_referral_orders_status ON referral_orders(status);
+CREATE INDEX IF NOT EXISTS idx_referral_orders_shopify_order_id ON referral_orders(shopify_order_id);
+CREATE INDEX IF NOT EXISTS idx_payouts_affiliate_id ON payouts(affiliate_id);
+CREATE INDEX IF NOT EXISTS idx_clicks_affiliate_created_at ON clicks(affiliate_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_clicks_affiliate_source ON clicks(affiliate_id, source);
+CREATE INDEX IF NOT EXISTS idx_clicks_click_id ON clicks(click_id);
+CREATE INDEX IF NOT EXISTS idx_clicks_unenriched ON clicks(created_at) WHERE device_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_referral_orders_unattributed ON referral_orders(created_at) WHERE attributed_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_referral_orders_updated_at ON referral_orders(updated_at);
+CREATE INDEX IF NOT EXISTS idx_referral_orders_fraud_unchecked ON referral_orders(created_at)
+    WHERE fraud_checked_at IS NULL AND status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_click_bursts_detected_at ON click_bursts(detected_at);
+CREATE INDEX IF NOT EXISTS idx_affiliates_updated_at ON affiliates(updated_at);
+CREATE INDEX IF NOT EXISTS idx_payouts_created_at ON payouts(created_at);
+CREATE INDEX IF NOT EXISTS idx_payouts_run_id ON payouts(run_id) WHERE run_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_affiliates_pending_commission ON affiliates(pending_commission);
+CREATE INDEX IF NOT EXISTS idx_commission_ledger_affiliate ON commission_ledger(affiliate_id, id);
+CREATE INDEX IF NOT EXISTS idx_commission_snapshots_covered ON commission_snapshots(affiliate_id, covered_until);
+CREATE INDEX IF NOT EXISTS idx_affiliate_stats_hourly_bucket ON affiliate_stats_hourly(bucket);
+CREATE INDEX IF NOT EXISTS idx_affiliate_stats_daily_bucket ON affiliate_stats_daily(bucket);
+CREATE INDEX IF NOT EXISTS idx_campaign_links_affiliate ON campaign_links(affiliate_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_campaign_stats_affiliate ON campaign_stats(affiliate_id);
 
 -- ============================================
 -- 自動更新 updated_at 的觸發器
@@ -105,16 +342,955 @@ BEGIN
 END;
 $$ language 'plpgsql';
 
-CREATE TRIGGER update_affiliates_updated_at
+CREATE OR REPLACE TRIGGER update_affiliates_updated_at
     BEFORE UPDATE ON affiliates
     FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
 
-CREATE TRIGGER update_referral_orders_updated_at
+CREATE OR REPLACE TRIGGER update_referral_orders_updated_at
     BEFORE UPDATE ON referral_orders
     FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
 
+CREATE OR REPLACE TRIGGER update_commission_rules_updated_at
+    BEFORE UPDATE ON commission_rules
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE OR REPLACE TRIGGER update_campaign_links_updated_at
+    BEFORE UPDATE ON campaign_links
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- ============================================
+-- 短網址代碼共用命名空間
+-- 代購業者與活動連結的 short_code 寫入時先登記到 short_codes，
+-- 和另一張表的代碼重複時違反 short_codes_pkey（unique violation，呼叫端換一個代碼重試）
+-- ============================================
+
+CREATE OR REPLACE FUNCTION claim_short_code()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.short_code IS NOT NULL
+       AND (TG_OP = 'DELETE' OR NEW.short_code IS DISTINCT FROM OLD.short_code) THEN
+        DELETE FROM short_codes WHERE code = OLD.short_code;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+    IF NEW.short_code IS NOT NULL AND (TG_OP = 'INSERT' OR NEW.short_code IS DISTINCT FROM OLD.short_code) THEN
+        INSERT INTO short_codes (code, owner_table) VALUES (NEW.short_code, TG_TABLE_NAME);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER affiliates_claim_short_code
+    BEFORE INSERT OR UPDATE OF short_code OR DELETE ON affiliates
+    FOR EACH ROW
+    EXECUTE FUNCTION claim_short_code();
+
+CREATE OR REPLACE TRIGGER campaign_links_claim_short_code
+    BEFORE INSERT OR UPDATE OF short_code OR DELETE ON campaign_links
+    FOR EACH ROW
+    EXECUTE FUNCTION claim_short_code();
+
+-- 既有資料庫加上觸發器時登記已使用的代碼（新安裝時兩張表都是空的）
+INSERT INTO short_codes (code, owner_table)
+SELECT short_code, 'affiliates' FROM affiliates
+ON CONFLICT DO NOTHING;
+INSERT INTO short_codes (code, owner_table)
+SELECT short_code, 'campaign_links' FROM campaign_links WHERE short_code IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+-- ============================================
+-- 點擊歸因
+-- 把尚未歸因的訂單對應到點擊：優先使用訂單帶來的點擊 ID，
+-- 沒有的話取 window_days 天內該代購業者最後一次點擊；
+-- 再重新計算受影響代購業者的 source_conversions 與各活動連結的訂單統計
+-- ============================================
+
+CREATE OR REPLACE FUNCTION run_attribution(window_days INTEGER DEFAULT 30, batch_size INTEGER DEFAULT 5000)
+RETURNS JSONB AS $$
+DECLARE
+    last_run TIMESTAMP WITH TIME ZONE;
+    attributed INTEGER;
+    affected UUID[];
+BEGIN
+    SELECT value::TIMESTAMP WITH TIME ZONE INTO last_run FROM settings WHERE key = 'attribution_checkpoint';
+
+    WITH pending AS (
+        SELECT id, affiliate_id, click_id, COALESCE(order_created_at, created_at) AS ordered_at
+        FROM referral_orders
+        WHERE attributed_at IS NULL
+        ORDER BY created_at
+        LIMIT batch_size
+    ),
+    matched AS (
+        SELECT p.id,
+               COALESCE(exact.id, recent.id) AS matched_click_id,
+               COALESCE(exact.source, recent.source, 'direct') AS matched_source,
+               COALESCE(exact.campaign_id, recent.campaign_id) AS matched_campaign_id
+        FROM pending p
+        LEFT JOIN clicks exact
+               ON exact.click_id = p.click_id AND exact.affiliate_id = p.affiliate_id
+        LEFT JOIN LATERAL (
+            SELECT c.id, c.source, c.campaign_id
+            FROM clicks c
+            WHERE exact.id IS NULL
+              AND c.affiliate_id = p.affiliate_id
+              AND c.created_at <= p.ordered_at
+              AND c.created_at > p.ordered_at - make_interval(days => window_days)
+            ORDER BY c.created_at DESC
+            LIMIT 1
+        ) recent ON TRUE
+    ),
+    updated AS (
+        UPDATE referral_orders o
+        SET attributed_click_id = m.matched_click_id,
+            attributed_source = m.matched_source,
+            attributed_campaign_id = m.matched_campaign_id,
+            attributed_at = NOW()
+        FROM matched m
+        WHERE o.id = m.id
+        RETURNING o.affiliate_id
+    )
+    SELECT COUNT(*) INTO attributed FROM updated;
+
+    -- 本次歸因、上次執行後有新點擊或訂單狀態變更的代購業者
+    affected := ARRAY(
+        SELECT affiliate_id FROM referral_orders
+        WHERE updated_at > COALESCE(last_run, '-infinity')
+        UNION
+        SELECT affiliate_id FROM clicks
+        WHERE created_at > COALESCE(last_run, '-infinity')
+    );
+
+    DELETE FROM source_conversions WHERE affiliate_id = ANY(affected);
+    INSERT INTO source_conversions (affiliate_id, source, clicks, orders, revenue, commission)
+    SELECT affiliate_id, source, SUM(clicks), SUM(orders), SUM(revenue), SUM(commission)
+    FROM (
+        SELECT affiliate_id, COALESCE(source, 'direct') AS source, COUNT(*) AS clicks,
+               0 AS orders, 0 AS revenue, 0 AS commission
+        FROM clicks
+        WHERE affiliate_id = ANY(affected)
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT affiliate_id, source, clicks, 0, 0, 0
+        FROM archived_click_rollups
+        WHERE affiliate_id = ANY(affected)
+        UNION ALL
+        SELECT affiliate_id, attributed_source, 0, COUNT(*), SUM(order_total), SUM(commission_amount)
+        FROM referral_orders
+        WHERE affiliate_id = ANY(affected)
+          AND attributed_at IS NOT NULL
+          AND status NOT IN ('cancelled', 'refunded')
+        GROUP BY 1, 2
+    ) t
+    GROUP BY 1, 2;
+
+    -- 活動連結的點擊數由觸發器維護，這裡只重算訂單
+    UPDATE campaign_stats SET orders = 0, revenue = 0, commission = 0, updated_at = NOW()
+    WHERE affiliate_id = ANY(affected);
+    INSERT INTO campaign_stats AS s (campaign_id, affiliate_id, orders, revenue, commission)
+    SELECT o.attributed_campaign_id, o.affiliate_id, COUNT(*), SUM(o.order_total), SUM(o.commission_amount)
+    FROM referral_orders o
+    JOIN campaign_links l ON l.id = o.attributed_campaign_id
+    WHERE o.affiliate_id = ANY(affected)
+      AND o.attributed_at IS NOT NULL
+      AND o.status NOT IN ('cancelled', 'refunded')
+    GROUP BY 1, 2
+    ON CONFLICT (campaign_id) DO UPDATE
+    SET orders = EXCLUDED.orders, revenue = EXCLUDED.revenue, commission = EXCLUDED.commission, updated_at = NOW();
+
+    INSERT INTO settings (key, value) VALUES ('attribution_checkpoint', NOW()::TEXT)
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW();
+
+    RETURN jsonb_build_object('attributed', attributed, 'affiliate_ids', to_jsonb(affected));
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 對帳：從 referral_orders 與 payouts 重新計算 affiliates 上的金額欄位
+--   total_sales        = 未取消/退款訂單的金額
+--   total_commission   = 已確認/已發放訂單的佣金
+--   paid_commission    = 已完成的發放金額
+--   pending_commission = total_commission - paid_commission（不小於 0）
+-- ============================================
+
+-- 指定時間之後有變動的代購業者（since 為 NULL 時回傳全部）
+CREATE OR REPLACE FUNCTION affiliates_changed_since(since TIMESTAMP WITH TIME ZONE DEFAULT NULL)
+RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+        'now', NOW(),
+        'affiliate_ids', COALESCE(jsonb_agg(DISTINCT changed.affiliate_id), '[]'::JSONB)
+    )
+    FROM (
+        SELECT id AS affiliate_id FROM affiliates
+        WHERE updated_at > COALESCE(since, '-infinity')
+        UNION
+        SELECT affiliate_id FROM referral_orders
+        WHERE updated_at > COALESCE(since, '-infinity')
+        UNION
+        SELECT affiliate_id FROM payouts
+        WHERE created_at > COALESCE(since, '-infinity')
+    ) changed
+    WHERE changed.affiliate_id IS NOT NULL;
+$$ LANGUAGE sql STABLE;
+
+-- 一批代購業者目前的欄位值與正確值
+CREATE OR REPLACE FUNCTION compute_affiliate_totals(affiliate_ids UUID[])
+RETURNS TABLE (
+    id UUID,
+    name VARCHAR,
+    total_sales NUMERIC,
+    total_commission NUMERIC,
+    pending_commission NUMERIC,
+    paid_commission NUMERIC,
+    expected_total_sales NUMERIC,
+    expected_total_commission NUMERIC,
+    expected_pending_commission NUMERIC,
+    expected_paid_commission NUMERIC
+) AS $$
+    WITH order_totals AS (
+        SELECT o.affiliate_id,
+               SUM(o.order_total) FILTER (WHERE o.status NOT IN ('cancelled', 'refunded')) AS sales,
+               SUM(o.commission_amount) FILTER (WHERE o.status IN ('confirmed', 'paid')) AS earned
+        FROM referral_orders o
+        WHERE o.affiliate_id = ANY(affiliate_ids)
+        GROUP BY o.affiliate_id
+    ),
+    payout_totals AS (
+        SELECT p.affiliate_id, SUM(p.amount) AS paid
+        FROM payouts p
+        WHERE p.affiliate_id = ANY(affiliate_ids) AND p.status = 'completed'
+        GROUP BY p.affiliate_id
+    )
+    SELECT a.id, a.name,
+           a.total_sales, a.total_commission, a.pending_commission, a.paid_commission,
+           COALESCE(ot.sales, 0),
+           COALESCE(ot.earned, 0),
+           GREATEST(COALESCE(ot.earned, 0) - COALESCE(pt.paid, 0), 0),
+           COALESCE(pt.paid, 0)
+    FROM affiliates a
+    LEFT JOIN order_totals ot ON ot.affiliate_id = a.id
+    LEFT JOIN payout_totals pt ON pt.affiliate_id = a.id
+    WHERE a.id = ANY(affiliate_ids);
+$$ LANGUAGE sql STABLE;
+
+-- 一次寫回多筆修正後的金額，totals 為 [{id, total_sales, ...}, ...]
+CREATE OR REPLACE FUNCTION apply_affiliate_totals(totals JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE affiliates a
+    SET total_sales = t.total_sales,
+        total_commission = t.total_commission,
+        pending_commission = t.pending_commission,
+        paid_commission = t.paid_commission
+    FROM jsonb_to_recordset(totals) AS t(
+        id UUID, total_sales NUMERIC, total_commission NUMERIC,
+        pending_commission NUMERIC, paid_commission NUMERIC
+    )
+    WHERE a.id = t.id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 佣金帳本
+-- ============================================
+
+-- 帳本只能新增（刪除代購業者時的連帶刪除除外）
+CREATE OR REPLACE FUNCTION prevent_ledger_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF pg_trigger_depth() <= 1 THEN
+        RAISE EXCEPTION 'commission_ledger is append-only';
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER commission_ledger_append_only
+    BEFORE UPDATE OR DELETE ON commission_ledger
+    FOR EACH ROW
+    EXECUTE FUNCTION prevent_ledger_changes();
+
+-- 寫入帳本的交易持有共用的 advisory lock，直到 commit 才釋放；
+-- take_commission_snapshots() 取得獨佔鎖時，所有已取號的帳本記錄都已 commit（或 rollback）
+CREATE OR REPLACE FUNCTION lock_commission_ledger_for_write()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(hashtext('commission_ledger'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER commission_ledger_write_lock
+    BEFORE INSERT ON commission_ledger
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION lock_commission_ledger_for_write();
+
+-- 為上次快照後有新帳本記錄的代購業者寫入新快照，回傳寫入筆數
+-- 每輪從上一輪的最大帳本 ID 往後累加，只涵蓋連續的一段 ID：第一筆在最近 settle_seconds 秒內的記錄
+-- 之後全部留到下一輪（created_at 是交易開始時間，不代表取號順序），所以水位線不會越過任何還沒涵蓋的記錄。
+-- 以獨佔鎖與進行中的帳本寫入、以及其他同時執行的快照互斥
+CREATE OR REPLACE FUNCTION take_commission_snapshots(settle_seconds INTEGER DEFAULT 60)
+RETURNS INTEGER AS $$
+DECLARE
+    watermark BIGINT;
+    cutoff BIGINT;
+    inserted INTEGER;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('commission_ledger'));
+
+    SELECT COALESCE(MAX(last_entry_id), 0) INTO watermark FROM commission_snapshots;
+    SELECT MIN(id) INTO cutoff
+    FROM commission_ledger
+    WHERE id > watermark AND created_at >= NOW() - make_interval(secs => settle_seconds);
+
+    INSERT INTO commission_snapshots (affiliate_id, last_entry_id, covered_until, accrued, pending, paid)
+    SELECT t.affiliate_id,
+           t.last_entry_id,
+           GREATEST(t.covered_until, s.covered_until),
+           COALESCE(s.accrued, 0) + t.accrued,
+           COALESCE(s.pending, 0) + t.pending,
+           COALESCE(s.paid, 0) + t.paid
+    FROM (
+        SELECT affiliate_id,
+               MAX(id) AS last_entry_id,
+               MAX(created_at) AS covered_until,
+               SUM(accrued_delta) AS accrued,
+               SUM(pending_delta) AS pending,
+               SUM(paid_delta) AS paid
+        FROM commission_ledger
+        WHERE id > watermark
+          AND id < COALESCE(cutoff, 9223372036854775807)
+          AND affiliate_id IS NOT NULL
+        GROUP BY affiliate_id
+    ) t
+    LEFT JOIN LATERAL (
+        SELECT cs.covered_until, cs.accrued, cs.pending, cs.paid
+        FROM commission_snapshots cs
+        WHERE cs.affiliate_id = t.affiliate_id
+        ORDER BY cs.last_entry_id DESC
+        LIMIT 1
+    ) s ON TRUE;
+
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 導入帳本前就有佣金的代購業者寫入期初餘額（opening），讓帳本加總等於 affiliates 上的金額欄位：
+--   未確認 = 待確認訂單的佣金、待發放 = pending_commission、已發放 = paid_commission，扣掉帳本中已有的變動
+-- 日期記在該代購業者第一筆帳本記錄（沒有時為現在）之前；已經有期初記錄的代購業者略過，可重複執行
+CREATE OR REPLACE FUNCTION seed_commission_openings()
+RETURNS INTEGER AS $$
+DECLARE
+    inserted INTEGER;
+BEGIN
+    INSERT INTO commission_ledger (affiliate_id, entry_type, accrued_delta, pending_delta, paid_delta, note, created_at)
+    SELECT a.id,
+           'opening',
+           COALESCE(o.accrued, 0) - COALESCE(l.accrued, 0),
+           COALESCE(a.pending_commission, 0) - COALESCE(l.pending, 0),
+           COALESCE(a.paid_commission, 0) - COALESCE(l.paid, 0),
+           'seed_commission_openings',
+           LEAST(COALESCE(l.first_at, NOW()), COALESCE(a.created_at, NOW())) - INTERVAL '1 second'
+    FROM affiliates a
+    LEFT JOIN (
+        SELECT affiliate_id, SUM(commission_amount) AS accrued
+        FROM referral_orders WHERE status = 'pending'
+        GROUP BY affiliate_id
+    ) o ON o.affiliate_id = a.id
+    LEFT JOIN (
+        SELECT affiliate_id, SUM(accrued_delta) AS accrued, SUM(pending_delta) AS pending,
+               SUM(paid_delta) AS paid, MIN(created_at) AS first_at
+        FROM commission_ledger
+        GROUP BY affiliate_id
+    ) l ON l.affiliate_id = a.id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM commission_ledger e WHERE e.affiliate_id = a.id AND e.entry_type = 'opening'
+    );
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 指定時間點的佣金餘額：最近一次快照 + 之後的帳本記錄
+CREATE OR REPLACE FUNCTION commission_balance_as_of(
+    target_affiliate_id UUID,
+    as_of TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+)
+RETURNS JSONB AS $$
+    WITH base AS (
+        SELECT last_entry_id, accrued, pending, paid
+        FROM commission_snapshots
+        WHERE affiliate_id = target_affiliate_id AND covered_until <= as_of
+        ORDER BY last_entry_id DESC
+        LIMIT 1
+    ),
+    tail AS (
+        SELECT COUNT(*) AS entries,
+               COALESCE(SUM(accrued_delta), 0) AS accrued,
+               COALESCE(SUM(pending_delta), 0) AS pending,
+               COALESCE(SUM(paid_delta), 0) AS paid
+        FROM commission_ledger
+        WHERE affiliate_id = target_affiliate_id
+          AND id > COALESCE((SELECT last_entry_id FROM base), 0)
+          AND created_at <= as_of
+    )
+    SELECT jsonb_build_object(
+        'affiliate_id', target_affiliate_id,
+        'as_of', as_of,
+        'accrued', COALESCE((SELECT accrued FROM base), 0) + tail.accrued,
+        'pending', COALESCE((SELECT pending FROM base), 0) + tail.pending,
+        'paid', COALESCE((SELECT paid FROM base), 0) + tail.paid,
+        'snapshot_entry_id', (SELECT last_entry_id FROM base),
+        'tail_entries', tail.entries
+    )
+    FROM tail;
+$$ LANGUAGE sql STABLE;
+
+-- ============================================
+-- 批次發放：同一個交易內建立發放記錄、扣減待發放佣金並寫入帳本
+-- 金額為待發放佣金的整數部分（日圓轉帳），重新檢查門檻，重複送出不會重複發放
+-- ============================================
+
+CREATE OR REPLACE FUNCTION create_payout_run(
+    run_code VARCHAR,
+    affiliate_ids UUID[],
+    min_amount NUMERIC,
+    method VARCHAR DEFAULT NULL,
+    run_note TEXT DEFAULT NULL
+)
+RETURNS JSONB AS $$
+DECLARE
+    created JSONB;
+BEGIN
+    WITH eligible AS (
+        SELECT a.id, FLOOR(a.pending_commission) AS amount
+        FROM affiliates a
+        WHERE a.id = ANY(affiliate_ids)
+          AND a.pending_commission >= min_amount
+          AND FLOOR(a.pending_commission) > 0
+        FOR UPDATE
+    ),
+    inserted AS (
+        INSERT INTO payouts (affiliate_id, amount, currency, payment_method, note, status, run_id)
+        SELECT e.id, e.amount, 'JPY', method, run_note, 'completed', run_code
+        FROM eligible e
+        RETURNING id, affiliate_id, amount
+    ),
+    balances AS (
+        UPDATE affiliates a
+        SET pending_commission = GREATEST(a.pending_commission - i.amount, 0),
+            paid_commission = a.paid_commission + i.amount
+        FROM inserted i
+        WHERE a.id = i.affiliate_id
+        RETURNING a.id
+    ),
+    ledger AS (
+        INSERT INTO commission_ledger (affiliate_id, entry_type, payout_id, pending_delta, paid_delta, note)
+        SELECT i.affiliate_id, 'payout', i.id, -i.amount, i.amount, run_code
+        FROM inserted i
+        RETURNING id
+    )
+    SELECT COALESCE(jsonb_agg(jsonb_build_object(
+        'id', i.id, 'affiliate_id', i.affiliate_id, 'amount', i.amount
+    )), '[]'::JSONB)
+    INTO created
+    FROM inserted i;
+
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 時間序列統計
+-- 點擊與訂單寫入時由觸發器累加到每小時、每日統計表；
+-- 訂單改為取消/退款時扣回，恢復時再加回。訂單依 Shopify 下單時間歸入時段。
+-- ============================================
+
+CREATE OR REPLACE FUNCTION bump_stats_buckets(
+    target_affiliate_id UUID,
+    happened_at TIMESTAMP WITH TIME ZONE,
+    delta_clicks INTEGER,
+    delta_orders INTEGER,
+    delta_sales NUMERIC,
+    delta_commission NUMERIC
+)
+RETURNS VOID AS $$
+BEGIN
+    IF target_affiliate_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO affiliate_stats_hourly AS h (affiliate_id, bucket, clicks, orders, sales, commission)
+    VALUES (target_affiliate_id, date_trunc('hour', happened_at),
+            delta_clicks, delta_orders, delta_sales, delta_commission)
+    ON CONFLICT (affiliate_id, bucket) DO UPDATE
+    SET clicks = h.clicks + EXCLUDED.clicks,
+        orders = h.orders + EXCLUDED.orders,
+        sales = h.sales + EXCLUDED.sales,
+        commission = h.commission + EXCLUDED.commission;
+
+    INSERT INTO affiliate_stats_daily AS d (affiliate_id, bucket, clicks, orders, sales, commission)
+    VALUES (target_affiliate_id, (happened_at AT TIME ZONE 'Asia/Tokyo')::DATE,
+            delta_clicks, delta_orders, delta_sales, delta_commission)
+    ON CONFLICT (affiliate_id, bucket) DO UPDATE
+    SET clicks = d.clicks + EXCLUDED.clicks,
+        orders = d.orders + EXCLUDED.orders,
+        sales = d.sales + EXCLUDED.sales,
+        commission = d.commission + EXCLUDED.commission;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION clicks_stats_buckets()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM bump_stats_buckets(NEW.affiliate_id, NEW.created_at, 1, 0, 0, 0);
+
+    IF NEW.campaign_id IS NOT NULL THEN
+        INSERT INTO campaign_stats AS s (campaign_id, affiliate_id, clicks, last_click_at)
+        VALUES (NEW.campaign_id, NEW.affiliate_id, 1, NEW.created_at)
+        ON CONFLICT (campaign_id) DO UPDATE
+        SET clicks = s.clicks + 1,
+            last_click_at = GREATEST(s.last_click_at, EXCLUDED.last_click_at);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER clicks_stats_buckets
+    AFTER INSERT ON clicks
+    FOR EACH ROW
+    EXECUTE FUNCTION clicks_stats_buckets();
+
+CREATE OR REPLACE FUNCTION referral_orders_stats_buckets()
+RETURNS TRIGGER AS $$
+DECLARE
+    delta INTEGER := 0;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF NEW.status NOT IN ('cancelled', 'refunded') THEN
+            delta := 1;
+        END IF;
+    ELSIF (OLD.status IN ('cancelled', 'refunded')) <> (NEW.status IN ('cancelled', 'refunded')) THEN
+        delta := CASE WHEN NEW.status IN ('cancelled', 'refunded') THEN -1 ELSE 1 END;
+    END IF;
+
+    IF delta <> 0 THEN
+        PERFORM bump_stats_buckets(NEW.affiliate_id, COALESCE(NEW.order_created_at, NEW.created_at),
+                                   0, delta, delta * NEW.order_total, delta * NEW.commission_amount);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER referral_orders_stats_buckets
+    AFTER INSERT OR UPDATE OF status ON referral_orders
+    FOR EACH ROW
+    EXECUTE FUNCTION referral_orders_stats_buckets();
+
+-- 從原始資料重建統計表（初次導入或修復時使用）
+-- 已封存的點擊不在 clicks 裡，封存邊界（日本時間月初）之前的統計保留不動
+CREATE OR REPLACE FUNCTION rebuild_stats_buckets()
+RETURNS VOID AS $$
+DECLARE
+    boundary TIMESTAMP WITH TIME ZONE;
+BEGIN
+    SELECT value::TIMESTAMP WITH TIME ZONE INTO boundary FROM settings WHERE key = 'clicks_archived_before';
+    boundary := COALESCE(boundary, '-infinity');
+
+    DELETE FROM affiliate_stats_hourly WHERE bucket >= boundary;
+    DELETE FROM affiliate_stats_daily WHERE bucket >= (boundary AT TIME ZONE 'Asia/Tokyo')::DATE;
+
+    CREATE TEMP TABLE stats_events ON COMMIT DROP AS
+    SELECT affiliate_id, created_at AS happened_at, 1 AS clicks, 0 AS orders,
+           0::NUMERIC AS sales, 0::NUMERIC AS commission
+    FROM clicks
+    WHERE affiliate_id IS NOT NULL AND created_at >= boundary
+    UNION ALL
+    SELECT affiliate_id, COALESCE(order_created_at, created_at), 0, 1, order_total, commission_amount
+    FROM referral_orders
+    WHERE affiliate_id IS NOT NULL
+      AND status NOT IN ('cancelled', 'refunded')
+      AND COALESCE(order_created_at, created_at) >= boundary;
+
+    INSERT INTO affiliate_stats_hourly (affiliate_id, bucket, clicks, orders, sales, commission)
+    SELECT affiliate_id, date_trunc('hour', happened_at), SUM(clicks), SUM(orders), SUM(sales), SUM(commission)
+    FROM stats_events
+    GROUP BY 1, 2;
+
+    INSERT INTO affiliate_stats_daily (affiliate_id, bucket, clicks, orders, sales, commission)
+    SELECT affiliate_id, (happened_at AT TIME ZONE 'Asia/Tokyo')::DATE,
+           SUM(clicks), SUM(orders), SUM(sales), SUM(commission)
+    FROM stats_events
+    GROUP BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 查詢時間序列：granularity 為 hour 或 day，target_affiliate_id 為 NULL 時加總所有代購業者
+-- 回傳有資料的時段，[since, until)；day 以日本時間的日期比較
+CREATE OR REPLACE FUNCTION stats_timeseries(
+    target_affiliate_id UUID,
+    granularity TEXT,
+    since TIMESTAMP WITH TIME ZONE,
+    until TIMESTAMP WITH TIME ZONE
+)
+RETURNS TABLE (bucket TIMESTAMP WITH TIME ZONE, clicks BIGINT, orders BIGINT, sales NUMERIC, commission NUMERIC) AS $$
+    SELECT h.bucket, SUM(h.clicks), SUM(h.orders), SUM(h.sales), SUM(h.commission)
+    FROM affiliate_stats_hourly h
+    WHERE granularity = 'hour'
+      AND (target_affiliate_id IS NULL OR h.affiliate_id = target_affiliate_id)
+      AND h.bucket >= since AND h.bucket < until
+    GROUP BY h.bucket
+    UNION ALL
+    SELECT d.bucket::TIMESTAMP AT TIME ZONE 'Asia/Tokyo', SUM(d.clicks), SUM(d.orders), SUM(d.sales), SUM(d.commission)
+    FROM affiliate_stats_daily d
+    WHERE granularity = 'day'
+      AND (target_affiliate_id IS NULL OR d.affiliate_id = target_affiliate_id)
+      AND d.bucket >= (since AT TIME ZONE 'Asia/Tokyo')::DATE
+      AND d.bucket < (until AT TIME ZONE 'Asia/Tokyo')::DATE
+    GROUP BY d.bucket
+    ORDER BY 1;
+$$ LANGUAGE sql STABLE;
+
+-- ============================================
+-- 排行榜：最近 7 / 30 天（含今天，日本時間）各指標的前 top_k 名
+-- 只讀每日統計表，在同一個交易內整表替換，讀取端不會看到一半的結果
+-- ============================================
+
+CREATE OR REPLACE FUNCTION refresh_leaderboards(top_k INTEGER DEFAULT 10)
+RETURNS INTEGER AS $$
+DECLARE
+    written INTEGER;
+    today DATE := (NOW() AT TIME ZONE 'Asia/Tokyo')::DATE;
+BEGIN
+    -- 兩個 refresh 同時執行時各自 DELETE 後 INSERT 會撞到主鍵（或重複寫入），同一時間只讓一個執行
+    PERFORM pg_advisory_xact_lock(hashtext('refresh_leaderboards'));
+    DELETE FROM affiliate_leaderboards;
+
+    WITH windows(window_days) AS (
+        VALUES (7), (30)
+    ),
+    totals AS (
+        SELECT w.window_days, d.affiliate_id,
+               SUM(d.clicks) AS clicks, SUM(d.orders) AS orders,
+               SUM(d.sales) AS sales, SUM(d.commission) AS commission
+        FROM windows w
+        JOIN affiliate_stats_daily d ON d.bucket > today - w.window_days
+        GROUP BY w.window_days, d.affiliate_id
+    ),
+    ranked AS (
+        SELECT t.window_days, t.affiliate_id, m.metric, m.value,
+               ROW_NUMBER() OVER (PARTITION BY t.window_days, m.metric
+                                  ORDER BY m.value DESC, t.affiliate_id) AS rank
+        FROM totals t
+        CROSS JOIN LATERAL (VALUES
+            ('clicks', t.clicks::NUMERIC),
+            ('orders', t.orders::NUMERIC),
+            ('sales', t.sales),
+            ('commission', t.commission)
+        ) AS m(metric, value)
+        WHERE m.value > 0
+    )
+    INSERT INTO affiliate_leaderboards (window_days, metric, rank, affiliate_id, name, value)
+    SELECT r.window_days, r.metric, r.rank, r.affiliate_id, a.name, r.value
+    FROM ranked r
+    JOIN affiliates a ON a.id = r.affiliate_id
+    WHERE r.rank <= top_k;
+
+    GET DIAGNOSTICS written = ROW_COUNT;
+    RETURN written;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 詐騙評分（score-fraud 批次寫回）
+-- ============================================
+
+-- scores 為 [{"id", "fraud_score", "fraud_reasons": [...]}]
+CREATE OR REPLACE FUNCTION apply_fraud_scores(scores JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE referral_orders o
+    SET fraud_score = s.fraud_score,
+        fraud_reasons = ARRAY(SELECT jsonb_array_elements_text(s.fraud_reasons)),
+        fraud_checked_at = NOW()
+    FROM jsonb_to_recordset(scores) AS s(id UUID, fraud_score SMALLINT, fraud_reasons JSONB)
+    WHERE o.id = s.id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 點擊維度（enrich-clicks 批次解析 User-Agent 與來源網址後寫回）
+-- ============================================
+
+-- 取得維度 id，不存在的先建立；dims 為 [{"kind": ..., "value": ...}]
+CREATE OR REPLACE FUNCTION ensure_click_dimensions(dims JSONB)
+RETURNS TABLE (id INTEGER, kind VARCHAR, value VARCHAR) AS $$
+BEGIN
+    INSERT INTO click_dimensions (kind, value)
+    SELECT d.kind, d.value FROM jsonb_to_recordset(dims) AS d(kind VARCHAR, value VARCHAR)
+    ON CONFLICT ON CONSTRAINT click_dimensions_kind_value_key DO NOTHING;
+
+    RETURN QUERY
+    SELECT c.id, c.kind, c.value
+    FROM click_dimensions c
+    JOIN jsonb_to_recordset(dims) AS d(kind VARCHAR, value VARCHAR) ON d.kind = c.kind AND d.value = c.value;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 批次寫回維度 id；updates 為 [{"id", "created_at", "device_id", "browser_id", "os_id", "referrer_id"}]
+-- 帶上 created_at 讓更新只落在對應的月份分區
+CREATE OR REPLACE FUNCTION apply_click_dimensions(updates JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE clicks c
+    SET device_id = u.device_id,
+        browser_id = u.browser_id,
+        os_id = u.os_id,
+        referrer_id = u.referrer_id
+    FROM jsonb_to_recordset(updates) AS u(id UUID, created_at TIMESTAMP WITH TIME ZONE, device_id INTEGER,
+                                          browser_id INTEGER, os_id INTEGER, referrer_id INTEGER)
+    WHERE c.id = u.id AND c.created_at = u.created_at;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 依維度分組的點擊數；target_affiliate_id 為 NULL 時統計所有代購業者
+CREATE OR REPLACE FUNCTION click_dimension_breakdown(target_affiliate_id UUID, dimension TEXT,
+                                                     since TIMESTAMP WITH TIME ZONE, until TIMESTAMP WITH TIME ZONE)
+RETURNS TABLE (value VARCHAR, clicks BIGINT) AS $$
+    SELECT COALESCE(d.value, 'unknown'), COUNT(*)
+    FROM clicks c
+    LEFT JOIN click_dimensions d ON d.id = CASE dimension
+        WHEN 'device' THEN c.device_id
+        WHEN 'browser' THEN c.browser_id
+        WHEN 'os' THEN c.os_id
+        WHEN 'referrer' THEN c.referrer_id
+    END
+    WHERE c.created_at >= since AND c.created_at < until
+      AND (target_affiliate_id IS NULL OR c.affiliate_id = target_affiliate_id)
+      AND c.device_id IS NOT NULL
+    GROUP BY 1
+    ORDER BY 2 DESC;
+$$ LANGUAGE sql STABLE;
+
+-- ============================================
+-- 點擊分區與保存期限
+-- 每個日本時間的月份一個分區（clicks_y2024m01），由 ensure_click_partitions() 預先建立
+-- （共用索引的 refresher 每小時執行一次，retain-clicks 也會執行）。
+-- 保存期限外的分區由 `flask --app app retain-clicks` 匯出成壓縮檔後呼叫
+-- drop_click_partition() 刪除；刪除前先把點擊數併入 archived_click_rollups，
+-- 每小時 / 每日統計與代購業者的 total_clicks 不受影響。
+-- ============================================
+
+-- 建立本月起 months_ahead 個月的分區，以及 clicks_default 中已有點擊的每個月份的分區，回傳新建立的數量。
+-- 預設分區已有某個月的點擊時，不能直接 CREATE ... PARTITION OF（預設分區的範圍會被違反），
+-- 所以先建立獨立的表、把點擊搬過去並從預設分區刪除，再 ATTACH 成分區；
+-- 搬移不經過 clicks 本身，每小時 / 每日統計的觸發器不會重複累加。
+-- 以 advisory lock 避免 refresher 與 retain-clicks 同時執行
+CREATE OR REPLACE FUNCTION ensure_click_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER AS $$
+DECLARE
+    this_month DATE := date_trunc('month', NOW() AT TIME ZONE 'Asia/Tokyo')::DATE;
+    month_start DATE;
+    range_start TIMESTAMP WITH TIME ZONE;
+    range_end TIMESTAMP WITH TIME ZONE;
+    partition_name TEXT;
+    has_rows BOOLEAN;
+    created INTEGER := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_click_partitions'));
+
+    FOR month_start IN
+        SELECT (this_month + make_interval(months => i))::DATE FROM generate_series(0, months_ahead) AS i
+        UNION
+        SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'Asia/Tokyo')::DATE FROM clicks_default
+        ORDER BY 1
+    LOOP
+        partition_name := 'clicks_' || to_char(month_start, '"y"YYYY"m"MM');
+        CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+
+        range_start := month_start::TIMESTAMP AT TIME ZONE 'Asia/Tokyo';
+        range_end := (month_start + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'Asia/Tokyo';
+        SELECT EXISTS (SELECT 1 FROM clicks_default WHERE created_at >= range_start AND created_at < range_end)
+        INTO has_rows;
+
+        IF has_rows THEN
+            EXECUTE format('CREATE TABLE %I (LIKE clicks INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+            EXECUTE format('INSERT INTO %I SELECT * FROM clicks_default WHERE created_at >= %L AND created_at < %L',
+                           partition_name, range_start, range_end);
+            DELETE FROM clicks_default WHERE created_at >= range_start AND created_at < range_end;
+            EXECUTE format('ALTER TABLE clicks ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, range_start, range_end);
+        ELSE
+            EXECUTE format('CREATE TABLE %I PARTITION OF clicks FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, range_start, range_end);
+        END IF;
+        created := created + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_click_partitions(3);
+
+-- 所有月份分區與範圍（不含 clicks_default；其中的點擊由 ensure_click_partitions() 搬到月份分區後才會被封存）
+CREATE OR REPLACE FUNCTION list_click_partitions()
+RETURNS TABLE (name TEXT, range_start TIMESTAMP WITH TIME ZONE, range_end TIMESTAMP WITH TIME ZONE, estimated_rows BIGINT) AS $$
+    SELECT c.relname::TEXT,
+           (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'FROM \(''([^'']+)''\)'))[1]::TIMESTAMP WITH TIME ZONE,
+           (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::TIMESTAMP WITH TIME ZONE,
+           GREATEST(c.reltuples, 0)::BIGINT
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'clicks'::REGCLASS
+      AND c.relname <> 'clicks_default'
+    ORDER BY 2;
+$$ LANGUAGE sql STABLE;
+
+-- 刪除已封存的分區：筆數必須和封存檔一致，否則不刪除
+CREATE OR REPLACE FUNCTION drop_click_partition(partition_name TEXT, archived_rows BIGINT)
+RETURNS BIGINT AS $$
+DECLARE
+    partition RECORD;
+    actual BIGINT;
+BEGIN
+    SELECT * INTO partition FROM list_click_partitions() p WHERE p.name = partition_name;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'unknown click partition %', partition_name;
+    END IF;
+
+    EXECUTE format('SELECT COUNT(*) FROM %I', partition_name) INTO actual;
+    IF actual <> archived_rows THEN
+        RAISE EXCEPTION 'partition % has % rows but archive has %', partition_name, actual, archived_rows;
+    END IF;
+
+    EXECUTE format(
+        'INSERT INTO archived_click_rollups (affiliate_id, source, clicks)
+         SELECT affiliate_id, COALESCE(source, ''direct''), COUNT(*) FROM %I
+         WHERE affiliate_id IS NOT NULL GROUP BY 1, 2
+         ON CONFLICT (affiliate_id, source) DO UPDATE
+         SET clicks = archived_click_rollups.clicks + EXCLUDED.clicks',
+        partition_name);
+    EXECUTE format('DROP TABLE %I', partition_name);
+
+    INSERT INTO settings (key, value) VALUES ('clicks_archived_before', partition.range_end::TEXT)
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+    WHERE settings.value::TIMESTAMP WITH TIME ZONE < EXCLUDED.value::TIMESTAMP WITH TIME ZONE;
+
+    RETURN actual;
+END;
+$$ LANGUAGE plpgsql;
+
+-- IP 匿名化：IPv4 保留前 24 位元、IPv6 保留前 48 位元；無法解析的值清空
+CREATE OR REPLACE FUNCTION anonymize_ip(ip TEXT)
+RETURNS TEXT AS $$
+BEGIN
+    IF ip IS NULL THEN
+        RETURN NULL;
+    END IF;
+    RETURN host(network(set_masklen(ip::INET, CASE WHEN family(ip::INET) = 4 THEN 24 ELSE 48 END)));
+EXCEPTION WHEN OTHERS THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- 把超過 older_than_days 天的點擊 IP 匿名化，只處理上次執行之後才超過期限的點擊
+CREATE OR REPLACE FUNCTION anonymize_click_ips(older_than_days INTEGER DEFAULT 30)
+RETURNS INTEGER AS $$
+DECLARE
+    last_cutoff TIMESTAMP WITH TIME ZONE;
+    cutoff TIMESTAMP WITH TIME ZONE := NOW() - make_interval(days => older_than_days);
+    updated INTEGER;
+BEGIN
+    SELECT value::TIMESTAMP WITH TIME ZONE INTO last_cutoff FROM settings WHERE key = 'ip_anonymized_before';
+
+    UPDATE clicks
+    SET ip_address = anonymize_ip(ip_address)
+    WHERE created_at >= COALESCE(last_cutoff, '-infinity')
+      AND created_at < cutoff
+      AND ip_address IS NOT NULL;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+
+    INSERT INTO settings (key, value) VALUES ('ip_anonymized_before', cutoff::TEXT)
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW();
+
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- 獨立轉址程序的點擊寫入（ingest-clicks）
+-- ============================================
+
+-- batch 為 [{"affiliate_id", "ip_address", "user_agent", "referer", "landed_url", "source",
+--            "click_id", "campaign_id", "created_at"}]
+-- 同一個 click_id 已經寫入過（重跑中斷的批次）就略過；代購業者或活動連結已刪除的點擊不寫入活動
+-- 查詢既有點擊時限定 created_at 前後一天，只掃描對應的月份分區
+CREATE OR REPLACE FUNCTION ingest_clicks(batch JSONB)
+RETURNS JSONB AS $$
+DECLARE
+    inserted INTEGER;
+    affected UUID[];
+BEGIN
+    WITH incoming AS (
+        SELECT DISTINCT ON (c.click_id) c.*
+        FROM jsonb_to_recordset(batch) AS c(
+            affiliate_id UUID, ip_address VARCHAR(45), user_agent TEXT, referer TEXT, landed_url TEXT,
+            source VARCHAR(20), click_id VARCHAR(16), campaign_id INTEGER, created_at TIMESTAMP WITH TIME ZONE)
+        WHERE c.click_id IS NOT NULL AND c.created_at IS NOT NULL
+    ),
+    fresh AS (
+        SELECT i.affiliate_id, i.ip_address, i.user_agent, i.referer, i.landed_url, i.source,
+               i.click_id, l.id AS campaign_id, i.created_at
+        FROM incoming i
+        JOIN affiliates a ON a.id = i.affiliate_id
+        LEFT JOIN campaign_links l ON l.id = i.campaign_id AND l.affiliate_id = i.affiliate_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM clicks existing
+            WHERE existing.click_id = i.click_id
+              AND existing.created_at BETWEEN i.created_at - INTERVAL '1 day' AND i.created_at + INTERVAL '1 day'
+        )
+    ),
+    written AS (
+        INSERT INTO clicks (affiliate_id, ip_address, user_agent, referer, landed_url, source,
+                            click_id, campaign_id, created_at)
+        SELECT affiliate_id, ip_address, user_agent, referer, landed_url, source, click_id, campaign_id, created_at
+        FROM fresh
+        RETURNING affiliate_id
+    ),
+    counts AS (
+        SELECT affiliate_id, COUNT(*) AS n FROM written GROUP BY affiliate_id
+    ),
+    bumped AS (
+        UPDATE affiliates a
+        SET total_clicks = COALESCE(a.total_clicks, 0) + counts.n
+        FROM counts
+        WHERE a.id = counts.affiliate_id
+        RETURNING a.id, counts.n
+    )
+    SELECT COALESCE(SUM(n), 0), COALESCE(array_agg(id), '{}') INTO inserted, affected FROM bumped;
+
+    RETURN jsonb_build_object('inserted', inserted, 'affiliate_ids', to_jsonb(affected));
+END;
+$$ LANGUAGE plpgsql;
+
 -- ============================================
 -- Row Level Security (RLS) - 可選
 -- 如果需要讓代購業者只能看到自己的資料